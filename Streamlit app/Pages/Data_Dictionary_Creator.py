@@ -4,6 +4,9 @@ from st_aggrid import AgGrid, GridOptionsBuilder, GridUpdateMode # pip install s
 import os
 import numpy as np
 import data_dictionary_functions as ddf
+import cert_eval_functions as cef
+import dataset_functions as dsf
+import job_functions as jf
 from streamlit_js_eval import streamlit_js_eval
 import json
 import time
@@ -19,6 +22,8 @@ if 'state' not in st.session_state:
     st.session_state.state = None
 if 'definition' not in st.session_state:
     st.session_state.definition = None
+if 'refresh_column' not in st.session_state:
+    st.session_state.refresh_column = None
 
 def set_page(page):
     st.session_state.page = page
@@ -61,7 +66,8 @@ if st.session_state.page == "Upload":
        # file_names.append(file_name)
        file_type = file_name[file_name.rfind("."):]
        file_folder = "./Datasets/" + new_dataset_name
-       file_path = file_folder + "/" + file_name
+       # Datasets are stored in columnar form whatever the upload format
+       file_path = dsf.columnar_path(file_folder + "/" + file_name)
        
     if st.button("Submit"):
         if not os.path.exists(file_folder):
@@ -73,19 +79,20 @@ if st.session_state.state == 1:
     os.makedirs(file_folder)
     pbar = st.progress(0, text="Submitting...")
 
-    if file_type == ".csv":
-        pd.read_csv(uploaded_file).to_csv(file_path, index=False)
-    elif file_type == ".feather":
-        pd.read_feather(uploaded_file).to_csv(file_path, index=False)
-
-    pbar.progress(40, text="Submitting...")
+    # The upload is converted and profiled in one streaming pass
+    columns, profile, warnings = ddf.ingest_dataset(uploaded_file, file_type, file_path, 
+                                                    progress_callback = lambda fraction, text: pbar.progress(fraction * 0.9, text = text))
 
     ddf.add_file_to_master(master_file_list_path, new_dataset_name, file_path, new_dataset_description)
-    pbar.progress(60, text="Submitting...")
-    ddf.create_column_summary(file_path, file_type, "./Data Dictionary Output", new_dataset_name)
-    pbar.progress(100, text="Done")
+    ddf.write_column_summary(columns, profile, "./Data Dictionary Output", new_dataset_name)
+    pbar.progress(1.0, text="Done")
+    st.session_state.state = None
 
-    streamlit_js_eval(js_expressions="parent.window.location.reload()")
+    # Reloading would hide the warnings, the dataset list is refreshed on the next rerun anyway
+    for warning in warnings:
+        st.warning(warning)
+    if not warnings:
+        streamlit_js_eval(js_expressions="parent.window.location.reload()")
 
 if st.session_state.state == 2:
     st.write("A dataset exists with this name, please choose a new name or overwrite.")
@@ -93,28 +100,27 @@ if st.session_state.state == 2:
         pbar = st.progress(0, text="Submitting...")
 
         for filename in os.listdir("./Datasets/" + new_dataset_name):
-            file_path = os.path.join("./Datasets/" + new_dataset_name, filename)
+            old_file_path = os.path.join("./Datasets/" + new_dataset_name, filename)
             try:
-                if os.path.isfile(file_path) or os.path.islink(file_path):
-                    os.unlink(file_path)
+                if os.path.isfile(old_file_path) or os.path.islink(old_file_path):
+                    os.unlink(old_file_path)
             except Exception as e:
-                print('Failed to delete %s. Reason: %s' % (file_path, e))
+                print('Failed to delete %s. Reason: %s' % (old_file_path, e))
         
-        pbar.progress(10, text="Submitting...")
+        pbar.progress(0.1, text="Submitting...")
 
-        if file_type == ".csv":
-            pd.read_csv(uploaded_file).to_csv(file_path, index=False)
-        elif file_type == ".feather":
-            pd.read_feather(uploaded_file).to_csv(file_path, index=False)
-
-        pbar.progress(40, text="Submitting...")
+        columns, profile, warnings = ddf.ingest_dataset(uploaded_file, file_type, file_path, 
+                                                        progress_callback = lambda fraction, text: pbar.progress(0.1 + fraction * 0.8, text = text))
 
         ddf.add_file_to_master(master_file_list_path, new_dataset_name, file_path, new_dataset_description)
-        pbar.progress(60, text="Submitting...")
-        ddf.create_column_summary(file_path, file_type, "./Data Dictionary Output", new_dataset_name)
-        pbar.progress(100, text="Done.")
-        
-        streamlit_js_eval(js_expressions="parent.window.location.reload()")
+        ddf.write_column_summary(columns, profile, "./Data Dictionary Output", new_dataset_name)
+        pbar.progress(1.0, text="Done.")
+        st.session_state.state = None
+
+        for warning in warnings:
+            st.warning(warning)
+        if not warnings:
+            streamlit_js_eval(js_expressions="parent.window.location.reload()")
 
     
 
@@ -138,16 +144,48 @@ if st.session_state.page == "Review":
 
 # Data Dictionary Creator: If user clicks on Create New Definitions link
 if st.session_state.page == "Create":
-    column_summary = pd.read_csv("./Data Dictionary Output/" + selected_dataset + "/columns_summary.csv")
+    # Shared by every session until the files change, so they are only 
+    # read here; approving a definition saves an edited copy
+    column_summary = dsf.read_csv("./Data Dictionary Output/" + selected_dataset + "/columns_summary.csv")
     
-    dataset_description = pd.read_csv(master_file_list_path)
-    dataset_description = dataset_description[dataset_description["file_folder"] == selected_dataset].head(1)["file_description"][0]
+    dataset_description = ddf.dataset_entry(master_file_list_path, selected_dataset)["file_description"]
 
-    data_dictionary = pd.read_csv("./Data Dictionary Output/" + selected_dataset + "/" + selected_dataset + "_Data_Dictionary.csv")
+    data_dictionary = dsf.read_csv(ddf.data_dictionary_path("./Data Dictionary Output", selected_dataset))
     unapproved_columns = data_dictionary[data_dictionary["Approved"] == False]
     
     selected_model = st.multiselect("LLM model (select all that apply)", ["Cohere", "LLaMA2"], default = ["Cohere", "LLaMA2"]) # User can select both
 
+    # Draft every unapproved column in a worker process, many columns per 
+    # prompt, so reviewing is mostly approving
+    draft_jobs = [job for job in jf.list_jobs("draft_definitions", limit = 50) if job["params"]["dataset_name"] == selected_dataset]
+    job = draft_jobs[0] if draft_jobs != [] else None
+
+    draft_1, draft_2 = st.columns([3,1])
+    with draft_2:
+        if st.button("Draft All Definitions", use_container_width = True, disabled = job is not None and job["status"] in ["queued", "running"]):
+            jf.ensure_workers()
+            job = jf.get_job(jf.submit_job("draft_definitions", {"column_summary_path": "./Data Dictionary Output/" + selected_dataset + "/columns_summary.csv", 
+                                                "columns": list(unapproved_columns["Column Name"]), 
+                                                "dataset_description": dataset_description, 
+                                                "models": selected_model, 
+                                                "out_dir": "./Data Dictionary Output", 
+                                                "dataset_name": selected_dataset}, api_keys))
+        if job is not None and job["status"] in ["queued", "running"]:
+            st.button("Cancel", use_container_width = True, on_click = jf.cancel_job, args = [job["id"]])
+        st.button("Refresh", use_container_width = True)
+
+    with draft_1:
+        if job is not None:
+            st.progress(job["done"] / job["total"] if job["total"] else float(job["status"] == "done"), 
+                        text = "Drafting {}: {:.0f} of {:.0f} batches, {}".format(job["status"], job["done"], job["total"], job["message"] or ""))
+            if job["status"] == "failed":
+                st.write("".join(job["error"].strip().splitlines()[-1:]))
+            elif job["status"] == "done":
+                for error in job["result"]["errors"][-3:]:
+                    st.write(error)
+
+    drafts = ddf.load_definition_drafts("./Data Dictionary Output", selected_dataset)
+
     st.markdown("<p style= 'text-align: center;'>1 of " + str(len(unapproved_columns)) + "</p>", unsafe_allow_html= True)
 
     # Grab next unapproved column
@@ -184,6 +222,10 @@ if st.session_state.page == "Create":
 
     definitions = {}
 
+    # "Rerun Query" bypasses the LLM response cache for this column once
+    use_cache = st.session_state.refresh_column != column
+    st.session_state.refresh_column = None
+
     user_1, user_2 = st.columns([2,8])
     with user_1: 
         st.markdown("User/Existing Definition")
@@ -205,7 +247,10 @@ if st.session_state.page == "Create":
         with co_1:
             st.markdown("Cohere Definition")
 
-        co_definition = ddf.query_LLM(column_summary, column, dataset_description, "Cohere", api_keys["Cohere"])
+        if use_cache and (column, "Cohere") in drafts:
+            co_definition = json.dumps({"definition": drafts[(column, "Cohere")]})
+        else:
+            co_definition = ddf.query_LLM(column_summary, column, dataset_description, "Cohere", api_keys["Cohere"], use_cache)
 
         if co_definition == -1:
             co_definition = 'ID Column for the file. Definition not applicable.'
@@ -228,7 +273,10 @@ if st.session_state.page == "Create":
         with la_1:
             st.markdown("LLaMA2 Definition")
 
-        la_definition = ddf.query_LLM(column_summary, column, dataset_description, "LLaMA2", api_keys["LLaMA2"])
+        if use_cache and (column, "LLaMA2") in drafts:
+            la_definition = json.dumps({"definition": drafts[(column, "LLaMA2")]})
+        else:
+            la_definition = ddf.query_LLM(column_summary, column, dataset_description, "LLaMA2", api_keys["LLaMA2"], use_cache)
 
         try:
             la_definition = json.loads(la_definition)["definition"]
@@ -252,12 +300,14 @@ if st.session_state.page == "Create":
 
     with appr_2:
         if st.button("Approve", "approve_definition", use_container_width=True):
-            data_dictionary["Column Definition"][data_dictionary["Column Name"] == column] = definitions[definition_selection]
-            data_dictionary["Approved"][data_dictionary["Column Name"] == column] = True 
-            data_dictionary.to_csv("./Data Dictionary Output/" + selected_dataset + "/" + selected_dataset + "_Data_Dictionary.csv", index = False)
+            data_dictionary = ddf.approve_definition(data_dictionary, column, definitions[definition_selection])
+            data_dictionary.to_csv(ddf.data_dictionary_path("./Data Dictionary Output", selected_dataset), index = False)
+            # Rank the columns against the mandates again, now with this definition
+            cef.ensure_mandate_relevance(selected_dataset)
             st.session_state.page = "Create"
             st.rerun()
 
     if st.button("Rerun Query"):
-        st.cache_data.clear()
+        st.session_state.refresh_column = column
+        st.rerun()
 
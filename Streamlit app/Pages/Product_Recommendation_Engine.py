@@ -4,6 +4,12 @@ from st_aggrid import AgGrid, GridOptionsBuilder, GridUpdateMode # pip install s
 import os
 import numpy as np
 import cert_eval_functions as cef
+import dataset_functions as dsf
+import llm_functions as llm
+import rule_functions as rf
+import model_functions as mf
+import job_functions as jf
+import trace_functions as trf
 from streamlit_js_eval import streamlit_js_eval
 import json
 import time
@@ -12,8 +18,6 @@ import altair as alt
 st.markdown('# Product Recommendation Engine')
 st.sidebar.markdown('Product Certification Evaluator')
 
-st.cache_data.clear()
-
 if 'page' not in st.session_state:
     st.session_state.page = None
 if 'state' not in st.session_state:
@@ -30,6 +34,10 @@ if 'summary_path' not in st.session_state:
     st.session_state.summary_path = ""
 if 'rec' not in st.session_state:
     st.session_state.rec = None
+if 'classifiers' not in st.session_state:
+    st.session_state.classifiers = []
+if 'search_page' not in st.session_state:
+    st.session_state.search_page = 0
 
 def set_page(page):
     st.session_state.page = page
@@ -39,6 +47,16 @@ def set_page_save(page, detail_df, file_path):
     st.session_state.page = None
     st.session_state.product = []
     st.session_state.rec = None
+    del st.query_params["job"]
+
+def set_search_page(search_page):
+    st.session_state.search_page = max(search_page, 0)
+
+def submit_job(kind, params):
+    # Evaluations run in worker processes; the job id is kept in the URL so
+    # the job can be followed after a rerun or reload.
+    jf.ensure_workers()
+    st.query_params["job"] = str(jf.submit_job(kind, params, api_keys))
 
 # list of folders in ./Datasets
 datasets = np.sort(next(os.walk("./Datasets"))[1])
@@ -52,8 +70,7 @@ selected_dataset = st.selectbox("Select Product Dataset", datasets, index=0, pla
 # master csv of recs
 st.session_state.master_path = "./Product Certification/" + selected_dataset + "/product_mandate_recommendation.csv"
 st.session_state.summary_path = "./Product Certification/" + selected_dataset + "/product_recommendation_summary.csv"
-rec_file_columns = pd.read_csv(st.session_state.master_path).columns
-st.session_state.rec = pd.DataFrame([], columns = rec_file_columns)
+st.session_state.rec = pd.DataFrame([], columns = cef.RECOMMENDATION_COLUMNS)
 
 cohere_key = st.text_input("Cohere API Key", type = "password")
 replicate_key = st.text_input("Replicate API Key", type = "password")
@@ -67,96 +84,169 @@ st.session_state.certs = st.multiselect("ESG Certifications (select all that app
 
 st.session_state.models = st.multiselect("LLM model (select all that apply)", ["Cohere", "LLaMA2", "GPT-3.5"], default = ["Cohere"]) # User can select both
 
+# Without reasoning the LLMs stop generating as soon as they have given their verdict
+llm_reasoning = st.checkbox("Include LLM reasoning", value = True)
+# Grouping sends the product's attributes once for all of its mandates
+group_mandates = st.checkbox("Group mandates into one request per product", value = False)
+# Results whose mandate, product attributes, prompt and model are unchanged since they were saved are reused
+incremental = st.checkbox("Only re-evaluate results whose inputs changed", value = False)
+# Cascade: the selected models are asked in turn, cheapest first, and only uncertain verdicts go on to the next model
+cascade = st.checkbox("Cascade the models (ask the next model only when a verdict is uncertain)", value = False)
+# Spending caps at list prices (llm.PROVIDER_PRICES); mandates that would go over are skipped, cheapest requests are sent first
+product_budget = st.number_input("Spending cap per product (USD, 0 for none)", min_value = 0.0, value = 0.0, step = 0.01, format = "%.2f")
+
+# Classifiers trained in Models.ipynb score products locally, without API calls
+classifier_options = sorted(set(kind for cert in ["TCO", "Energy Star"] for kind in mf.available_classifiers(cert)))
+st.session_state.classifiers = st.multiselect("ML classifiers (select all that apply)", classifier_options, default = [], 
+                                              format_func = lambda kind: mf.CLASSIFIER_KINDS.get(kind, kind))
+
 st.divider()
 
 st.markdown("Search for a product by name and generate a recommendation for the selected ESG certifications.")
 
-products_df = pd.read_csv(master_file_list_path)
-products_df = pd.read_csv(products_df[products_df["file_folder"] == selected_dataset].head(1)["file_name"][0])
-
-mandates_df = pd.read_csv("./Product Certification/certification_mandates_revised.csv")
-mandate_column_full_df = pd.read_csv("./Product Certification/" + selected_dataset + "/mandate_column_relevance_full.csv")
-
-st.session_state.product = st.multiselect("Product Search:", products_df["name"], max_selections= 1) # User can search for product
+products_path = dsf.ensure_columnar(cef.get_dataset_file(master_file_list_path, selected_dataset))
+
+mandates_df = cef.load_mandates()
+mandate_column_full_df, mandate_index = cef.load_mandate_relevance(cef.ensure_mandate_relevance(selected_dataset))
+mandate_rules = rf.load_mandate_rules()
+
+# Products are matched on the server with the dataset's search index; only 
+# one page of matches is sent to the browser
+search_query = st.text_input("Product Search:", placeholder = "Product name, id or category", on_change = set_search_page, args = [0])
+st.session_state.product = []
+if search_query.strip() != "":
+    matches, matches_total = dsf.search_products(products_path, search_query, offset = st.session_state.search_page * dsf.SEARCH_PAGE_SIZE)
+    pages_total = max((matches_total - 1) // dsf.SEARCH_PAGE_SIZE + 1, 1)
+    product_row = st.selectbox("{} matching products (page {} of {})".format(matches_total, st.session_state.search_page + 1, pages_total), 
+                               matches.index, index = None, placeholder = "Select product", 
+                               format_func = lambda row: "{} ({}, {})".format(matches.loc[row, "name"], matches.loc[row, "category_label"], matches.loc[row, "id"]))
+    search_previous, search_next = st.columns(2)
+    with search_previous:
+        st.button("Previous", use_container_width = True, on_click = set_search_page, args = [st.session_state.search_page - 1], 
+                  disabled = st.session_state.search_page == 0)
+    with search_next:
+        st.button("Next", use_container_width = True, on_click = set_search_page, args = [st.session_state.search_page + 1], 
+                  disabled = st.session_state.search_page + 1 >= pages_total)
+    if product_row is not None:
+        product_row = int(product_row)
+        st.session_state.product = [str(matches.loc[product_row, "name"])]
 
 if st.session_state.product != []:
-    product_df = products_df[products_df["name"] == st.session_state.product[0]]
+    # Only the selected row and the columns the mandates refer to are read from the dataset
+    product_df = dsf.load_products(products_path, [product_row], 
+                                   dsf.mandate_columns(mandate_column_full_df, dsf.dataset_columns(products_path), rf.rule_columns(mandate_rules)))
 
 if st.session_state.product != []:
+    with st.expander("Recommendation history (newest first)"):
+        st.dataframe(cef.load_recommendations(st.session_state.master_path, {"id": product_df["id"].iloc[0]}, limit = 100))
+
     st.button("Generate Recommendation", use_container_width = True, on_click=set_page, args=["Generate New"])
+    st.button("Preview Re-evaluation", use_container_width = True, on_click=set_page, args=["Preview"])
 
-if st.session_state.page == "Generate New":
+st.divider()
 
-    try: 
-        st.markdown("<h5 style= 'text-align: center;'>Product Name: " + st.session_state.product[0] + "</h5>", unsafe_allow_html= True)
-    except:
-        st.markdown("")
+st.markdown("Or certify every product in the selected dataset. Progress is saved after each batch of products, so an interrupted run resumes where it stopped.")
+restart_catalog = st.checkbox("Start over (ignore saved progress)")
+catalog_budget = st.number_input("Spending cap for the catalog run (USD, 0 for none); the run stops when it is reached", 
+                                 min_value = 0.0, value = 0.0, step = 1.0, format = "%.2f")
+st.button("Certify Entire Catalog", use_container_width = True, on_click=set_page, args=["Catalog"])
+st.button("Preview Catalog Re-evaluation", use_container_width = True, on_click=set_page, args=["Catalog Preview"])
+
+if st.session_state.page == "Catalog Preview":
+    st.markdown("Results an incremental catalog run would reuse (unchanged) or evaluate again:")
+    st.dataframe(cef.catalog_reevaluation_report(selected_dataset, st.session_state.certs, st.session_state.models, master_file_list_path, 
+                                                 reasoning = llm_reasoning, group_mandates = group_mandates))
+    st.session_state.page = None
 
-    for cert in st.session_state.certs:
+if st.session_state.page == "Preview" and st.session_state.product != []:
+    jobs = cef.build_mandate_jobs(product_df, mandates_df, mandate_index, st.session_state.certs, st.session_state.models, mandate_rules, 
+                                  llm_reasoning, group_mandates)
+    plan = cef.reevaluation_plan(jobs, st.session_state.master_path)
+    st.markdown("{} out of {} results would be reused; the rest would be evaluated again:".format((plan["status"] == "unchanged").sum(), plan.shape[0]))
+    st.dataframe(plan[cef.REEVALUATION_PLAN_COLUMNS])
+    st.session_state.page = None
 
-        output_data = []
-        
-        cert_cols = st.columns(len(st.session_state.models) + 1)
-        cert_cols_i = 1
+if st.session_state.page == "Catalog":
+    submit_job("certify_catalog", {"dataset_name": selected_dataset, 
+                                   "certs": st.session_state.certs, 
+                                   "models": st.session_state.models, 
+                                   "master_file_list_path": master_file_list_path, 
+                                   "restart": restart_catalog, 
+                                   "reasoning": llm_reasoning, 
+                                   "group_mandates": group_mandates, 
+                                   "incremental": incremental, 
+                                   "budget": catalog_budget or None, 
+                                   "product_budget": product_budget or None, 
+                                   "cascade": cascade, 
+                                   "classifiers": st.session_state.classifiers})
+    st.session_state.page = None
 
-        mandates_cert = mandates_df[mandates_df["Certification"] == cert]
+if st.session_state.page == "Generate New":
+    submit_job("recommend_product", {"dataset_name": selected_dataset, 
+                                     "product_row": int(product_row), 
+                                     "certs": st.session_state.certs, 
+                                     "models": st.session_state.models, 
+                                     "master_file_list_path": master_file_list_path, 
+                                     "reasoning": llm_reasoning, 
+                                     "group_mandates": group_mandates, 
+                                     "incremental": incremental, 
+                                     "budget": product_budget or None, 
+                                     "cascade": cascade, 
+                                     "classifiers": st.session_state.classifiers})
+    st.session_state.page = None
 
-        for LLM in st.session_state.models:
-            progress_text = "Querying {} for {} recommendation...{} out of {} complete."
-            cert_progress = st.progress(0, text=progress_text.format(LLM, cert, 0, mandates_cert.shape[0]))
-            start_time = time.time()
-            for mandate in range(mandates_cert.shape[0]):
+job = jf.get_job(int(st.query_params["job"])) if "job" in st.query_params else None
 
-                mandate_df = mandates_cert.iloc[[mandate]]
-                mandate_column_df = mandate_column_full_df[mandate_column_full_df["Certification"] == cert]
-                mandate_column_df = mandate_column_df[mandate_column_df["Mandate Number"] == mandate_df["Mandate Number"].item()]
+if job is not None and job["status"] in ["queued", "running"]:
+    if job["kind"] == "certify_catalog":
+        progress_text = "{:.0f} out of {:.0f} products certified."
+    else:
+        progress_text = "{:.0f} out of {:.0f} mandates evaluated."
+    st.progress(job["done"] / job["total"] if job["total"] else 0.0, 
+                text = "Waiting for a worker..." if job["status"] == "queued" else progress_text.format(job["done"], job["total"]))
+    # Responses still being generated, shown as they stream in
+    if job["message"]:
+        st.text(job["message"])
+    st.button("Cancel", on_click = jf.cancel_job, args = [job["id"]])
 
-                # st.dataframe(product_df)
-                #st.dataframe(mandate_df)
-                #st.dataframe(mandate_column_df)
+if job is not None and job["status"] in ["failed", "cancelled"]:
+    st.error("Job {} {}. {}".format(job["id"], job["status"], "".join((job["error"] or "").strip().splitlines()[-1:])))
 
-                prompt, llm_response_full = cef.query_LLM(mandate_df, mandate_column_df, product_df, LLM, api_keys[LLM])
+if job is not None and job["status"] == "done" and job["kind"] == "certify_catalog":
+    st.success("{} out of {} products certified. Results were saved to the recommendation history.".format(job["result"]["products_done"], 
+                                                                                                          job["result"]["products_total"]))
+    if job["params"].get("budget") and job["result"]["products_done"] < job["result"]["products_total"]:
+        st.warning("The run stopped at its spending cap of ${:.2f}; certify the catalog again to continue.".format(job["params"]["budget"]))
 
-                if llm_response_full == "LIMIT RATE":
-                    st.cache_data.clear()
-                    time.sleep(61)
-                    prompt, llm_response_full = cef.query_LLM(mandate_df, mandate_column_df, product_df, LLM, api_keys[LLM])
-                    #st.markdown(llm_response_full)
+if job is not None and job["status"] == "done" and job["kind"] == "recommend_product":
+    st.session_state.rec = pd.DataFrame(job["result"]["rec"]["data"], columns = job["result"]["rec"]["columns"])
+    st.session_state.rec["rec_datetime"] = pd.to_datetime(st.session_state.rec["rec_datetime"])
+    summary_df = pd.DataFrame(job["result"]["summary"]["data"], columns = job["result"]["summary"]["columns"])
 
-                if llm_response_full == "ServiceUnavailableError":
-                    st.cache_data.clear()
-                    time.sleep(10)
-                    prompt, llm_response_full = cef.query_LLM(mandate_df, mandate_column_df, product_df, LLM, api_keys[LLM])
+    st.markdown("<h5 style= 'text-align: center;'>Product Name: " + str(summary_df["product"].iloc[0]) + "</h5>", unsafe_allow_html= True)
+    skipped = summary_df["mandates skipped"].sum() if "mandates skipped" in summary_df.columns else 0
+    st.markdown("<p style= 'text-align: center;'>Cost: ${:.4f}{}</p>".format(summary_df["cost"].sum(), 
+                "; {} mandates skipped to stay within the spending cap".format(skipped) if skipped else ""), unsafe_allow_html = True)
 
-                cert_progress.progress(((mandate + 1) / mandates_cert.shape[0]), text=progress_text.format(LLM, cert, (mandate + 1), mandates_cert.shape[0]))
-                
-                if "TRUE" in llm_response_full or "does meet" in llm_response_full:
-                    llm_response = "True"
-                elif "more info" in llm_response_full.lower() or "not provided" in llm_response_full.lower() or "cannot determine" in llm_response_full.lower():
-                    llm_response = "N/A"
-                else: 
-                    llm_response = "False"
+    # A cascade's results are logged under a single model
+    result_models = [cef.CASCADE_MODEL] if job["params"].get("cascade") else job["params"]["models"]
 
-                #st.markdown(llm_response)
+    for cert in job["params"]["certs"]:
 
-                cef.log_response(st.session_state.rec, product_df, mandate_df, prompt, llm_response_full, llm_response, LLM)
-                #st.dataframe(st.session_state.rec)
-            cert_progress.empty()
-            
-            elapsed_time = time.time() - start_time
+        output_data = []
+        
+        cert_cols = st.columns(len(result_models) + 1)
+        cert_cols_i = 1
 
+        for LLM in result_models:
             with cert_cols[cert_cols_i]:
-                output = st.session_state.rec[st.session_state.rec["Certification"] == cert][st.session_state.rec["model"] == LLM]
+                output = st.session_state.rec[(st.session_state.rec["Certification"] == cert) & (st.session_state.rec["model"] == LLM)]
                 passed, failed, na, rec_per = cef.output_responses(output, cert, LLM)
-                summary_df = pd.DataFrame([[st.session_state.product[0], LLM, cert, passed, failed, na, rec_per, round(elapsed_time), 0]],
-                            columns = ["product", "model", "cert", "mandates passed", "mandates failed", "mandates na", "percentage_passed", "time", "cost"])
-
-                cef.save_recommendation(st.session_state.summary_path, summary_df)
                 output_data.append(rec_per)
                 cert_cols_i += 1
 
         with cert_cols[0]:
-            if np.min(output_data) >= 55:
+            if np.min(output_data) >= cef.CANDIDATE_THRESHOLD:
                 text_color = "green"
                 recommendation = "##### Good Candidate"
             else:
@@ -166,10 +256,51 @@ if st.session_state.page == "Generate New":
             st.markdown("##### :{}[{}%]".format(text_color, np.min(output_data))) 
             st.markdown(recommendation)
 
+    # The classifiers chosen when the job was submitted, not the current selection
+    if job["params"].get("classifiers", []) != []:
+        st.markdown("ML classifier predictions:")
+        classifier_scores = [mf.score_dataset_rows(products_path, [job["params"]["product_row"]], cert, kind) 
+                             for cert in job["params"]["certs"] 
+                             for kind in job["params"]["classifiers"] if kind in mf.available_classifiers(cert)]
+        if classifier_scores != []:
+            st.dataframe(pd.concat(classifier_scores, ignore_index = True)[["cert", "model", "prediction", "score"]])
+
+    if job["params"].get("cascade"):
+        st.markdown("Mandates decided by each tier of the cascade:")
+        st.dataframe(st.session_state.rec.groupby(["Certification", "tier"]).size().unstack(fill_value = 0))
+
     st.markdown("Details:")
     st.dataframe(st.session_state.rec)
 
+    with st.expander("Provider rate limiting, response cache and usage (since the worker started)"):
+        st.dataframe(pd.DataFrame(job["result"]["rate_limits"]).T)
+        st.dataframe(pd.DataFrame([job["result"]["cache"]]))
+        if job["result"].get("usage"):
+            st.dataframe(pd.DataFrame(job["result"]["usage"]).T)
+
+    # Where the run's time went, from its trace (see trace_functions)
+    if job["result"].get("trace") and os.path.exists(job["result"]["trace"]):
+        with st.expander("Diagnostics: time per stage and per mandate"):
+            spans = trf.read_trace(job["result"]["trace"])
+            st.markdown("Stages (wall clock; a stage includes the stages it runs, and stages on parallel requests overlap):")
+            st.dataframe(trf.stage_summary(spans).round(3))
+            st.markdown("Mandates, slowest first:")
+            st.dataframe(trf.mandate_summary(spans).round(3))
+            with open(job["result"]["trace"]) as f:
+                st.download_button("Download trace (JSON lines)", f.read(), file_name = os.path.basename(job["result"]["trace"]))
+            st.download_button("Download trace (Chrome trace format, for chrome://tracing or Perfetto)", 
+                               json.dumps(trf.chrome_trace(spans), default = str), 
+                               file_name = os.path.splitext(os.path.basename(job["result"]["trace"]))[0] + ".json")
+
     st.button("Export", 
             use_container_width = True, 
             on_click=set_page_save, 
-            args=["Export", st.session_state.rec, st.session_state.master_path])
\ No newline at end of file
+            args=["Export", st.session_state.rec, st.session_state.master_path])
+
+with st.expander("Recent jobs"):
+    st.dataframe(pd.DataFrame(jf.list_jobs(limit = 20), columns = jf.JOB_COLUMNS)[["id", "kind", "status", "done", "total", "submitted", "finished"]])
+
+# Poll the job until it completes; any widget interaction reruns sooner
+if job is not None and job["status"] in ["queued", "running"]:
+    time.sleep(jf.JOB_POLL_SECONDS)
+    st.rerun()
@@ -0,0 +1,281 @@
+# Accuracy and latency benchmark of the certification recommendations. A
+# labeled sample of products is run through the mandate evaluation of
+# each LLM (as in cef.recommend_product) and through each saved ML
+# classifier, and the verdicts are compared with the products' actual
+# certifications. Run from the "Streamlit app" folder:
+#
+#     python benchmarks/certification_benchmark.py Notebooks --products 20 --mock
+#
+# --mock answers the LLM requests from benchmarks/mock_llm_server.py, so no
+# API keys or network are needed; the LLM accuracy is then meaningless,
+# but latency, throughput, tokens and cost follow the real request pattern.
+# Tokens and cost are those metered by llm_functions for every model (the
+# billed tokens where a provider reports them, counted ones otherwise); 
+# with --mock and no network, tokens are counted approximately (see
+# approximate_offline_encoding).
+# Without it, the keys are read from COHERE_API_KEY, REPLICATE_API_TOKEN and
+# OPENAI_API_KEY. Labels are the products' "Sustainability certificates"
+# unless --labels gives a CSV with an id column and the 0/1 columns of
+# LABEL_COLUMNS, as in the Models.ipynb train/test files. --cascade adds a
+# run of the models as a cascade (see cef.evaluate_cascade).
+#
+# Results are written as JSON (default benchmarks/results/) to compare runs.
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import warnings
+
+import numpy as np
+import pandas as pd
+
+from sklearn.metrics import accuracy_score, f1_score, precision_score, recall_score
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import cert_eval_functions as cef
+import dataset_functions as dsf
+import llm_functions as llm
+import model_functions as mf
+import rule_functions as rf
+
+import mock_llm_server
+
+LABEL_COLUMNS = {"Energy Star": "ENERGY_STAR", "TCO": "TCO"}
+
+# How each certification is named in "Sustainability certificates"
+CERTIFICATE_NAMES = {"Energy Star": "ENERGY STAR", "TCO": "TCO"}
+
+RESULT_COLUMNS = ["system", "model", "cert", "products", "accuracy", "precision", "recall", "f1", "latency_p50", "latency_p95",
+                  "throughput", "input_tokens", "output_tokens", "cost", "requests", "errors"]
+
+def approximate_offline_encoding(encoding_name: str = "cl100k_base"):
+    # tiktoken downloads its BPE ranks on first use; offline, the mock run
+    # counts tokens with mock_llm_server.ApproximateEncoding instead
+    try:
+        llm.get_encoding(encoding_name)
+    except Exception as e:
+        warnings.warn("Token encoding {} unavailable ({}); counting tokens approximately".format(encoding_name, type(e).__name__))
+        llm.get_encoding = mock_llm_server.ApproximateEncoding
+
+def product_labels(products: pd.DataFrame, certs: list, labels_path: str = None) -> dict:
+    # {cert: array of bools, one per product}: whether each product holds cert
+    if labels_path is None:
+        certificates = products["Sustainability certificates.42513"].fillna("").astype(str).str.upper()
+        return {cert: certificates.str.contains(CERTIFICATE_NAMES[cert], regex = False).to_numpy() for cert in certs}
+
+    labels = pd.read_csv(labels_path, dtype = {"id": str}).drop_duplicates("id").set_index("id")
+    return {cert: labels[LABEL_COLUMNS[cert]].reindex(products["id"].to_numpy()).fillna(0).astype(bool).to_numpy() for cert in certs}
+
+def sample_rows(products_path: str, n: int, seed: int = 0, labels_path: str = None) -> list:
+    # Row numbers of n products picked at random, among the labeled ones
+    # when there is a labels file
+    index = dsf.load_product_index(products_path)
+    if labels_path is not None:
+        index = index[index["id"].isin(pd.read_csv(labels_path, dtype = {"id": str})["id"])]
+    rows = index.index.to_numpy()
+    rng = np.random.default_rng(seed)
+    return sorted(rng.choice(rows, size = min(n, len(rows)), replace = False).tolist())
+
+def run_llm(product_df: pd.DataFrame, mandates_df: pd.DataFrame, mandate_index: dict, rules: pd.DataFrame, certs: list,
+            model: str, api_keys: dict, reasoning: bool = True, group_mandates: bool = False, tiers: list = None):
+    # Evaluate the products one after the other, each against the mandates
+    # of every cert at once, as the app does; with tiers, as a cascade of
+    # those models logged under model. Returns one record per (product, 
+    # cert) and the total time taken. Tokens and cost are the metered usage
+    # of the requests (see cef.evaluate_metered); a cascade's are those of 
+    # every tier it asked.
+    records = []
+    started = time.perf_counter()
+    for p in range(product_df.shape[0]):
+        product = product_df.iloc[[p]]
+        jobs = cef.build_mandate_jobs(product, mandates_df, mandate_index, certs, tiers[:1] if tiers else [model], rules, 
+                                      reasoning, group_mandates)
+
+        # Time until the last mandate of each cert completed
+        start_time = time.perf_counter()
+        elapsed_times = {}
+        results = [None] * len(jobs)
+        if tiers:
+            evaluation = cef.evaluate_cascade(jobs, api_keys, tiers, reasoning = reasoning, group_mandates = group_mandates)
+        else:
+            evaluation = cef.evaluate_mandate_jobs(jobs, api_keys, reasoning = reasoning, group_mandates = group_mandates)
+        for i, result in evaluation:
+            results[i] = result
+            elapsed_times[jobs[i]["cert"]] = time.perf_counter() - start_time
+
+        rec = pd.DataFrame([], columns = cef.RECOMMENDATION_COLUMNS)
+        for job, (prompt, llm_response_full, llm_response, verdict) in zip(jobs, results):
+            cef.log_response(rec, job["product"], job["mandate_df"], prompt, llm_response_full, llm_response, model, verdict, job["fingerprint"],
+                             cef.job_tier(job))
+
+        for cert in certs:
+            _, _, _, rec_per = cef.count_recommendations(rec, cert, model)
+            evaluated = [(job, result) for job, result in zip(jobs, results) if job["cert"] == cert]
+            usage = pd.DataFrame([job.get("usage", {}) for job, _ in evaluated], columns = ["requests", "cached", "input_tokens", "output_tokens", "cost"])
+            records.append({"id": product["id"].item(), "cert": cert, "prediction": rec_per >= cef.CANDIDATE_THRESHOLD, "score": rec_per,
+                            "latency": elapsed_times.get(cert, 0.0), "input_tokens": usage["input_tokens"].sum(), 
+                            "output_tokens": usage["output_tokens"].sum(), "cost": usage["cost"].sum(),
+                            "requests": usage["requests"].sum() - usage["cached"].sum(), "errors": request_errors(evaluated)})
+    return records, time.perf_counter() - started
+
+def request_errors(evaluated: list) -> int:
+    # Failed LLM requests behind (job, result) pairs
+    return sum(job.get("rule") is None and result[1].startswith(cef.ERROR_RESPONSES) for job, result in evaluated)
+
+def run_classifier(products_path: str, rows: list, cert: str, kind: str):
+    # Score the products one at a time, for the latency of a single
+    # recommendation, and then all at once, for throughput. Returns one
+    # record per product and the time taken by the batch.
+    mf.score_dataset_rows(products_path, rows[:1], cert, kind)
+
+    records = []
+    for row in rows:
+        start_time = time.perf_counter()
+        scores = mf.score_dataset_rows(products_path, [row], cert, kind)
+        records.append({"id": scores["id"].item(), "cert": cert, "prediction": bool(scores["prediction"].item()),
+                        "score": float(scores["score"].item()), "latency": time.perf_counter() - start_time,
+                        "input_tokens": 0, "output_tokens": 0, "cost": 0.0, "requests": 0, "errors": 0})
+
+    start_time = time.perf_counter()
+    mf.score_dataset_rows(products_path, rows, cert, kind)
+    return records, time.perf_counter() - start_time
+
+def summarize(system: str, model: str, records: pd.DataFrame, labels: dict, total_time: float) -> list:
+    # One result row per cert. Latency is per product; throughput is in
+    # products per second over all certs; tokens and cost are per product.
+    rows = []
+    for cert, cert_records in records.groupby("cert", sort = False):
+        actual = labels[cert]
+        predicted = cert_records["prediction"].astype(bool).to_numpy()
+        rows.append([system, model, cert, len(cert_records),
+                     accuracy_score(actual, predicted),
+                     precision_score(actual, predicted, zero_division = 0),
+                     recall_score(actual, predicted, zero_division = 0),
+                     f1_score(actual, predicted, zero_division = 0),
+                     np.percentile(cert_records["latency"], 50),
+                     np.percentile(cert_records["latency"], 95),
+                     len(cert_records) / total_time if total_time > 0 else None,
+                     cert_records["input_tokens"].mean(), cert_records["output_tokens"].mean(), cert_records["cost"].mean(),
+                     cert_records["requests"].mean(),
+                     int(cert_records["errors"].sum())])
+    return rows
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output = True, text = True, check = True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Benchmark LLM and ML certification recommendations against known certifications.")
+    parser.add_argument("dataset", help = "dataset folder name under ./Datasets")
+    parser.add_argument("--products", type = int, default = 20, help = "number of products sampled")
+    parser.add_argument("--seed", type = int, default = 0)
+    parser.add_argument("--labels", default = None, help = "CSV of id and 0/1 certification columns (" + ", ".join(LABEL_COLUMNS.values()) + ")")
+    parser.add_argument("--certs", nargs = "+", default = ["TCO", "Energy Star"], choices = ["TCO", "Energy Star"])
+    parser.add_argument("--models", nargs = "+", default = ["Cohere", "LLaMA2", "GPT-3.5"], choices = ["Cohere", "LLaMA2", "GPT-3.5"])
+    parser.add_argument("--classifiers", nargs = "*", default = None, help = "classifier kinds to run (default: all saved)")
+    parser.add_argument("--no-reasoning", action = "store_true", help = "stop LLM responses at the verdict")
+    parser.add_argument("--group-mandates", action = "store_true", help = "send each product's mandates in as few requests as fit")
+    parser.add_argument("--cascade", action = "store_true", help = "also run the models as a cascade, cheapest first")
+    parser.add_argument("--use-cache", action = "store_true", help = "answer repeated requests from the LLM response cache")
+    parser.add_argument("--mock", action = "store_true", help = "answer LLM requests from a local mock server")
+    parser.add_argument("--mock-latency", type = float, default = mock_llm_server.DEFAULT_LATENCY, help = "mock seconds before the first token")
+    parser.add_argument("--mock-tokens-per-second", type = float, default = mock_llm_server.DEFAULT_TOKENS_PER_SECOND)
+    parser.add_argument("--output", default = None, help = "results file (default: benchmarks/results/certification_<time>.json)")
+    args = parser.parse_args()
+
+    products_path = dsf.ensure_columnar(cef.get_dataset_file("./file_list.csv", args.dataset))
+    mandates_df = cef.load_mandates()
+    mandate_column_full_df, mandate_index = cef.load_mandate_relevance(cef.ensure_mandate_relevance(args.dataset))
+    rules = rf.load_mandate_rules()
+
+    rows = sample_rows(products_path, args.products, args.seed, args.labels)
+    product_df = dsf.load_products(products_path, rows,
+                                   dsf.mandate_columns(mandate_column_full_df, dsf.dataset_columns(products_path), rf.rule_columns(rules)))
+    labels = product_labels(product_df, args.certs, args.labels)
+    print("{} products from {}: {}".format(len(rows), args.dataset,
+                                          ", ".join("{} {} certified".format(int(labels[cert].sum()), cert) for cert in args.certs)))
+
+    server = None
+    if args.mock:
+        approximate_offline_encoding()
+        server = mock_llm_server.start_server(latency = args.mock_latency, tokens_per_second = args.mock_tokens_per_second)
+        llm.PROVIDER_BASE_URLS.update(mock_llm_server.base_urls(server))
+        # The mock is not throttled
+        for limits in llm.PROVIDER_RATE_LIMITS.values():
+            limits.update({"requests_per_minute": 1e9, "tokens_per_minute": 1e12})
+        api_keys = {model: "mock" for model in args.models}
+    else:
+        api_keys = {"Cohere": os.environ.get("COHERE_API_KEY", ""),
+                    "LLaMA2": os.environ.get("REPLICATE_API_TOKEN", ""),
+                    "GPT-3.5": os.environ.get("OPENAI_API_KEY", "")}
+
+    results = []
+    predictions = []
+    with tempfile.TemporaryDirectory() as cache_dir:
+        if not args.use_cache:
+            llm.LLM_CACHE_PATH = os.path.join(cache_dir, "llm_cache.sqlite")
+
+        for model in args.models:
+            records, total_time = run_llm(product_df, mandates_df, mandate_index, rules, args.certs, model, api_keys,
+                                          not args.no_reasoning, args.group_mandates)
+            records = pd.DataFrame(records)
+            results += summarize("LLM", model, records, labels, total_time)
+            predictions += records.assign(system = "LLM", model = model).to_dict("records")
+            print("{}: {:.1f}s".format(model, total_time))
+
+        if args.cascade:
+            # Its own cache, so the first tier is not answered from the run above
+            if not args.use_cache:
+                llm.LLM_CACHE_PATH = os.path.join(cache_dir, "cascade_cache.sqlite")
+            tiers = cef.cascade_tiers(args.models)
+            records, total_time = run_llm(product_df, mandates_df, mandate_index, rules, args.certs, cef.CASCADE_MODEL, api_keys,
+                                          not args.no_reasoning, args.group_mandates, tiers)
+            records = pd.DataFrame(records)
+            results += summarize("LLM", cef.CASCADE_MODEL + " (" + " > ".join(tiers) + ")", records, labels, total_time)
+            predictions += records.assign(system = "LLM", model = cef.CASCADE_MODEL).to_dict("records")
+            print("{}: {:.1f}s".format(cef.CASCADE_MODEL, total_time))
+
+    for cert in args.certs:
+        kinds = mf.available_classifiers(cert)
+        for kind in kinds if args.classifiers is None else [kind for kind in args.classifiers if kind in kinds]:
+            records, total_time = run_classifier(products_path, rows, cert, kind)
+            records = pd.DataFrame(records)
+            results += summarize("ML", mf.CLASSIFIER_KINDS.get(kind, kind), records, {cert: labels[cert]}, total_time)
+            predictions += records.assign(system = "ML", model = mf.CLASSIFIER_KINDS.get(kind, kind)).to_dict("records")
+
+    if server is not None:
+        server.shutdown()
+
+    results = pd.DataFrame(results, columns = RESULT_COLUMNS)
+    with pd.option_context("display.width", 200, "display.max_columns", None, "display.float_format", "{:.4g}".format):
+        print(results.to_string(index = False))
+
+    output_path = args.output or "./benchmarks/results/certification_{}.json".format(time.strftime("%Y%m%d-%H%M%S"))
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok = True)
+    run = {"dataset": args.dataset,
+           "products": len(rows),
+           "seed": args.seed,
+           "labels": args.labels or "Sustainability certificates.42513",
+           "certs": args.certs,
+           "reasoning": not args.no_reasoning,
+           "group_mandates": args.group_mandates,
+           "cascade_min_confidence": cef.CASCADE_MIN_CONFIDENCE if args.cascade else None,
+           "use_cache": args.use_cache,
+           "mock": {"latency": args.mock_latency, "tokens_per_second": args.mock_tokens_per_second} if args.mock else None,
+           "candidate_threshold": cef.CANDIDATE_THRESHOLD,
+           "prices": llm.PROVIDER_PRICES,
+           "commit": git_commit(),
+           "python": platform.python_version(),
+           "time": time.strftime("%Y-%m-%dT%H:%M:%S")}
+    with open(output_path, "w") as f:
+        json.dump({"run": run,
+                   "results": json.loads(results.to_json(orient = "records")),
+                   "rate_limits": llm.rate_limit_stats(),
+                   "predictions": json.loads(pd.DataFrame(predictions).to_json(orient = "records"))}, f, indent = 1)
+    print("Results written to {}".format(output_path))
@@ -0,0 +1,86 @@
+# Benchmark for ddf.create_column_summary on a synthetic wide/tall product
+# dataset shaped like the IceCat exports (attribute columns, each with a
+# ".unit" twin). Run from the "Streamlit app" folder:
+#
+#     python benchmarks/column_summary_benchmark.py --rows 5000 --attributes 2000 --legacy
+#
+# --legacy also times the previous per-column loop for comparison.
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import data_dictionary_functions as ddf
+
+def synthetic_dataset(rows: int, attributes: int, seed: int = 0) -> pd.DataFrame:
+    # Mix of numeric, boolean and text attributes with ~60% missing values,
+    # which is typical of the wide product catalogs.
+    rng = np.random.default_rng(seed)
+    data = {"id": ["Prod_{}".format(i) for i in range(rows)], 
+            "name": ["Product {}".format(i) for i in range(rows)]}
+    for a in range(attributes):
+        missing = rng.random(rows) < 0.6
+        kind = a % 3
+        if kind == 0:
+            values = pd.Series(rng.integers(1, 50, rows) * 0.5)
+            units = pd.Series(rng.choice(["W", "kg", "GB", "mm"], rows))
+        elif kind == 1:
+            values = pd.Series(rng.random(rows) < 0.5, dtype = object)
+            units = pd.Series([np.nan] * rows, dtype = object)
+        else:
+            values = pd.Series(rng.choice(["Intel", "AMD", "Qualcomm", "Apple", "MediaTek"], rows))
+            units = pd.Series([np.nan] * rows, dtype = object)
+        data["Attribute {}.{}".format(a, 1000 + a)] = values.mask(missing)
+        data["Attribute {}.{}.unit".format(a, 1000 + a)] = units.mask(missing)
+    return pd.DataFrame(data)
+
+def legacy_profile(data: pd.DataFrame, data_dictionary_df: pd.DataFrame, columns: list):
+    # The per-column loop create_column_summary used before the vectorized profiler
+    for c in columns:
+        try:
+            col_unit = data[c + ".unit"].value_counts().nlargest(1).index[0]
+        except:
+            col_unit = "N/A"
+        col_vals = str([str(val) for val in data[c].value_counts().nlargest(5).index.values]).replace("]", "").replace("[", "")
+        if data[c].dtype == float or data[c].dtype == int:
+            col_min = str(data[c].min())
+            col_max = str(data[c].max())
+        else:
+            col_min = "N/A"
+            col_max = "N/A"
+        data_dictionary_df.loc[data_dictionary_df["Column Name Raw"] == c, "Column Unit"] = col_unit
+        data_dictionary_df.loc[data_dictionary_df["Column Name Raw"] == c, "Column Top Values"] = col_vals
+        data_dictionary_df.loc[data_dictionary_df["Column Name Raw"] == c, "Column Min"] = col_min
+        data_dictionary_df.loc[data_dictionary_df["Column Name Raw"] == c, "Column Max"] = col_max
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Benchmark the data dictionary column profiler.")
+    parser.add_argument("--rows", type = int, default = 5000)
+    parser.add_argument("--attributes", type = int, default = 2000)
+    parser.add_argument("--jobs", type = int, nargs = "+", default = [1, 4], help = "process counts to time")
+    parser.add_argument("--legacy", action = "store_true", help = "also time the previous per-column loop")
+    args = parser.parse_args()
+
+    data = synthetic_dataset(args.rows, args.attributes)
+    _, columns_to_query = ddf.clean_column_names(data.columns)
+    columns = [c for c, _ in columns_to_query]
+    print("Dataset: {} rows x {} columns ({} attributes)".format(data.shape[0], data.shape[1], len(columns)))
+
+    with tempfile.TemporaryDirectory() as out_dir:
+        for n_jobs in args.jobs:
+            start = time.perf_counter()
+            profile = ddf.profile_columns(data, columns, n_jobs = n_jobs)
+            profiled = time.perf_counter()
+            ddf.write_column_summary(list(data.columns), profile, out_dir, "Benchmark")
+            print("vectorized, n_jobs={}: profile {:.2f}s, build and write {:.2f}s".format(n_jobs, profiled - start, time.perf_counter() - profiled))
+
+    if args.legacy:
+        data_dictionary_df = pd.DataFrame({"Column Name Raw": data.columns, "Column Top Values": "", "Column Unit": "", "Column Min": "", "Column Max": ""})
+        start = time.perf_counter()
+        legacy_profile(data, data_dictionary_df, columns)
+        print("legacy loop: {:.2f}s".format(time.perf_counter() - start))
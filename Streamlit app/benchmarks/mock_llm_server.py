@@ -0,0 +1,227 @@
+# Local stand-in for the Cohere, Replicate and OpenAI APIs used by
+# llm_functions, so benchmarks run offline and without API keys. Replies
+# are verdict JSON objects like the ones the mandate prompts ask for,
+# decided by a hash of the model and prompt (the same request always gets
+# the same verdict) and delayed like a real model: a fixed latency before
+# the first token, then a steady number of tokens per second. Responses
+# report their billed tokens, as the real APIs do: streams in their final
+# event (OpenAI only when asked with stream_options).
+# Run from the
+# "Streamlit app" folder:
+#
+#     python benchmarks/mock_llm_server.py --port 8765 --latency 0.5
+#
+# and point the app at it:
+#
+#     COHERE_BASE_URL=http://127.0.0.1:8765 REPLICATE_BASE_URL=http://127.0.0.1:8765
+#     OPENAI_BASE_URL=http://127.0.0.1:8765/v1 streamlit run Home_Page.py
+#
+# certification_benchmark.py --mock starts one itself.
+import argparse
+import hashlib
+import json
+import re
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_LATENCY = 0.3
+DEFAULT_TOKENS_PER_SECOND = 80
+DEFAULT_PASS_RATE = 0.8
+
+# Mandates of a grouped prompt (see cef.build_group_prompt), else the
+# mandate of a single prompt (see cef.prepare_mandate_query)
+GROUP_MANDATE_PATTERN = re.compile(r"^\d+\. .*? Certification Mandate (.+?):", re.MULTILINE)
+MANDATE_PATTERN = re.compile(r"^Mandate (.+?):", re.MULTILINE)
+
+def _unit(text: str) -> float:
+    # Number in [0, 1) decided by text
+    return int(hashlib.sha256(text.encode("utf-8")).hexdigest()[:8], 16) / 16 ** 8
+
+def mock_verdict(prompt: str, mandate: str, pass_rate: float = DEFAULT_PASS_RATE) -> dict:
+    draw = _unit(prompt + "\n" + mandate)
+    if draw < pass_rate:
+        recommendation = "TRUE"
+    elif draw < pass_rate + (1 - pass_rate) * 0.8:
+        recommendation = "FALSE"
+    else:
+        recommendation = "MORE INFO NEEDED"
+    return {"recommendation": recommendation,
+            "confidence": round(0.5 + _unit(mandate + prompt) / 2, 2),
+            "reasoning": "Mock assessment of mandate {}.".format(mandate),
+            "cited_attributes": []}
+
+def mock_reply(prompt: str, pass_rate: float = DEFAULT_PASS_RATE) -> str:
+    # JSON reply to a mandate prompt: {"verdicts": [...]} for a grouped
+    # prompt, a single verdict otherwise
+    numbers = GROUP_MANDATE_PATTERN.findall(prompt)
+    if numbers:
+        return json.dumps({"verdicts": [dict(mandate = number, **mock_verdict(prompt, number, pass_rate)) for number in numbers]})
+    mandate = MANDATE_PATTERN.search(prompt)
+    return json.dumps(mock_verdict(prompt, mandate.group(1) if mandate else "", pass_rate))
+
+def reply_pieces(reply: str) -> list:
+    # The reply split roughly into tokens, as streamed
+    return re.findall(r"\S+\s*|\s+", reply)
+
+def count_tokens(text: str) -> int:
+    # Tokens billed for text: about one per four characters, as for English
+    return max(1, (len(text) + 3) // 4)
+
+class ApproximateEncoding:
+    # Stand-in for a tiktoken encoding when its BPE ranks cannot be 
+    # downloaded (no network): "tokens" are pieces of up to four word 
+    # characters or one symbol, with their leading space, which counts 
+    # English text close to cl100k_base.
+    PIECES = re.compile(r"\s?\w{1,4}|\s?[^\w\s]|\s+")
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def encode(self, text: str) -> list:
+        return self.PIECES.findall(text)
+
+    def decode(self, tokens: list) -> str:
+        return "".join(tokens)
+
+class MockHandler(BaseHTTPRequestHandler):
+    # Set on the server: latency, tokens_per_second, pass_rate, requests
+    def log_message(self, format, *args):
+        pass
+
+    def _read_json(self) -> dict:
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def _send_json(self, body: dict, status: int = 200):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _stream(self, content_type: str, lines):
+        # Stream lines as they are produced; the body ends when the
+        # connection closes
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Connection", "close")
+        self.end_headers()
+        for line in lines:
+            self.wfile.write(line.encode("utf-8"))
+            self.wfile.flush()
+        self.close_connection = True
+
+    def _reply(self, model: str, prompt: str):
+        # Wait out the latency and yield the reply piece by piece at the
+        # configured rate
+        with self.server.lock:
+            self.server.requests += 1
+        time.sleep(self.server.latency)
+        for piece in reply_pieces(mock_reply(str(model) + "\n" + prompt, self.server.pass_rate)):
+            time.sleep(1 / self.server.tokens_per_second)
+            yield piece
+
+    def do_POST(self):
+        body = self._read_json()
+        path = self.path.split("?")[0].rstrip("/")
+
+        if path.endswith("/generate"):
+            # Cohere generate; streamed as one JSON event per line
+            reply = self._reply(body.get("model"), body.get("prompt", ""))
+            if body.get("stream"):
+                def events():
+                    text = ""
+                    for piece in reply:
+                        text += piece
+                        yield json.dumps({"event_type": "text-generation", "text": piece, "is_finished": False}) + "\n"
+                    yield json.dumps({"event_type": "stream-end", "is_finished": True, "finish_reason": "COMPLETE",
+                                      "response": {"id": "mock", "generations": [{"id": "mock", "text": text, "finish_reason": "COMPLETE"}],
+                                                   "meta": {"billed_units": {"input_tokens": count_tokens(body.get("prompt", "")), 
+                                                                             "output_tokens": count_tokens(text)}}}}) + "\n"
+                self._stream("application/stream+json", events())
+            else:
+                text = "".join(reply)
+                self._send_json({"id": "mock", "generations": [{"id": "mock", "text": text}], "prompt": body.get("prompt", ""),
+                                 "meta": {"billed_units": {"input_tokens": count_tokens(body.get("prompt", "")), "output_tokens": count_tokens(text)}}})
+
+        elif path.endswith("/chat/completions"):
+            # OpenAI chat completions; streamed as server-sent events
+            prompt = "\n\n".join(message.get("content", "") for message in body.get("messages", []))
+            reply = self._reply(body.get("model"), prompt)
+            if body.get("stream"):
+                def events():
+                    text = ""
+                    for piece in reply:
+                        text += piece
+                        yield "data: " + json.dumps({"id": "mock", "object": "chat.completion.chunk", "model": body.get("model"),
+                                                     "choices": [{"index": 0, "delta": {"content": piece}, "finish_reason": None}]}) + "\n\n"
+                    if (body.get("stream_options") or {}).get("include_usage"):
+                        yield "data: " + json.dumps({"id": "mock", "object": "chat.completion.chunk", "model": body.get("model"), "choices": [],
+                                                     "usage": {"prompt_tokens": count_tokens(prompt), "completion_tokens": count_tokens(text),
+                                                               "total_tokens": count_tokens(prompt) + count_tokens(text)}}) + "\n\n"
+                    yield "data: [DONE]\n\n"
+                self._stream("text/event-stream", events())
+            else:
+                text = "".join(reply)
+                self._send_json({"id": "mock", "object": "chat.completion", "model": body.get("model"),
+                                 "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+                                 "usage": {"prompt_tokens": count_tokens(prompt), "completion_tokens": count_tokens(text),
+                                           "total_tokens": count_tokens(prompt) + count_tokens(text)}})
+
+        elif path.endswith("/predictions"):
+            # Replicate predictions, completed before the response is sent
+            input = body.get("input", {})
+            output = list(self._reply(body.get("version"), input.get("system_prompt", "") + "\n\n" + input.get("prompt", "")))
+            self._send_json({"id": "mock", "model": "mock/mock", "version": body.get("version", "mock"), "status": "succeeded",
+                             "input": input, "output": output, "logs": "", "error": None, "metrics": {},
+                             "created_at": "2024-01-01T00:00:00Z", "urls": {}}, 201)
+        else:
+            self._send_json({"message": "Not found: " + self.path}, 404)
+
+    def do_GET(self):
+        path = self.path.split("?")[0].rstrip("/")
+        if "/versions/" in path:
+            # Replicate model version: its output is a stream of strings
+            self._send_json({"id": path.split("/")[-1], "created_at": "2024-01-01T00:00:00Z", "cog_version": "0.8.0",
+                             "openapi_schema": {"components": {"schemas": {"Output": {"type": "array", "items": {"type": "string"},
+                                                                                      "x-cog-array-type": "iterator"}}}}})
+        else:
+            self._send_json({"message": "Not found: " + self.path}, 404)
+
+def start_server(port: int = 0, latency: float = DEFAULT_LATENCY, tokens_per_second: float = DEFAULT_TOKENS_PER_SECOND,
+                 pass_rate: float = DEFAULT_PASS_RATE) -> ThreadingHTTPServer:
+    # Serve on 127.0.0.1 from a background thread; port 0 picks a free
+    # port (see server.server_address). Stop with server.shutdown().
+    server = ThreadingHTTPServer(("127.0.0.1", port), MockHandler)
+    server.daemon_threads = True
+    server.latency = latency
+    server.tokens_per_second = tokens_per_second
+    server.pass_rate = pass_rate
+    server.requests = 0
+    server.lock = threading.Lock()
+    threading.Thread(target = server.serve_forever, daemon = True).start()
+    return server
+
+def base_urls(server: ThreadingHTTPServer) -> dict:
+    # llm.PROVIDER_BASE_URLS pointing at server
+    url = "http://{}:{}".format(*server.server_address[:2])
+    return {"Cohere": url, "LLaMA2": url, "GPT-3.5": url + "/v1"}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Mock Cohere, Replicate and OpenAI API server.")
+    parser.add_argument("--port", type = int, default = 8765)
+    parser.add_argument("--latency", type = float, default = DEFAULT_LATENCY, help = "seconds before the first token")
+    parser.add_argument("--tokens-per-second", type = float, default = DEFAULT_TOKENS_PER_SECOND)
+    parser.add_argument("--pass-rate", type = float, default = DEFAULT_PASS_RATE, help = "share of mandates judged compliant")
+    args = parser.parse_args()
+
+    server = start_server(args.port, args.latency, args.tokens_per_second, args.pass_rate)
+    print("Mock LLM server on http://127.0.0.1:{}".format(args.port))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
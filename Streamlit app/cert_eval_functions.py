@@ -3,30 +3,103 @@ import numpy as np
 import re 
 import time
 import os
+import threading
 
-import cohere
 from datetime import datetime
 
-import tiktoken
-
-import replicate
 import json
+import ast
+import hashlib
+import sqlite3
+import functools
+from contextlib import closing
 import streamlit as st
 
 import altair as alt
-import openai
 
-def num_tokens_from_string(string: str, encoding_name: str) -> int:
-    """Returns the number of tokens in a text string."""
-    encoding = tiktoken.get_encoding(encoding_name)
-    num_tokens = len(encoding.encode(string))
-    return num_tokens
+import llm_functions as llm
+import dataset_functions as dsf
+import rule_functions as rf
+import relevance_functions as rlf
+import data_dictionary_functions as ddf
+import trace_functions as trf
+from llm_functions import num_tokens_from_string
+
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+# Maximum number of requests in flight at once for each provider.
+PROVIDER_CONCURRENCY = {"Cohere": 2, "LLaMA2": 4, "GPT-3.5": 8}
+
+# How often streaming responses are reported while jobs are in flight.
+STREAM_REFRESH_SECONDS = 0.25
+
+MANDATES_PATH = "./Product Certification/certification_mandates_revised.csv"
+DATA_DICTIONARY_DIR = "./Data Dictionary Output"
+
+# Columns written by log_response, in order.
+RECOMMENDATION_COLUMNS = ["id", "name", "category_id", "category_label", "Sustainability certificates.42513", 
+                          "Certification", "Mandate Number", "Mandate title", "Mandate Description", 
+                          "prompt", "response", "recommendation", "model", "rec_datetime", 
+                          "confidence", "reasoning", "cited_attributes", "fingerprint", "tier"]
+
+# A product is a good candidate for a certification when every model 
+# finds it passes at least this percentage of the mandates.
+CANDIDATE_THRESHOLD = 55
+
+# cost is in USD; mandates skipped were not evaluated for lack of budget.
+SUMMARY_COLUMNS = ["product", "model", "cert", "mandates passed", "mandates failed", "mandates na", "percentage_passed", "time", "cost", 
+                   "mandates skipped"]
+
+# Columns indexed in the results store, where the table has them.
+STORE_INDEX_COLUMNS = ["id", "Certification", "model", "rec_datetime", "product", "cert"]
 
-def log_response(current_log: pd.DataFrame, product_df: pd.DataFrame, mandate_df: pd.DataFrame, llm_prompt: str, llm_response_full: str, llm_response: str, LLM: str):
+# Number of products read from the dataset and evaluated per batch in catalog mode.
+CATALOG_CHUNK_SIZE = 50
+
+# Bump when the wording of prepare_mandate_query or build_group_prompt 
+# changes, so results obtained with the old prompts count as changed.
+PROMPT_TEMPLATE_VERSION = 1
+
+# Columns of a re-evaluation plan (see reevaluation_plan).
+REEVALUATION_PLAN_COLUMNS = ["id", "name", "Certification", "Mandate Number", "model", "status"]
+
+# Reply tokens expected from a mandate request with and without reasoning,
+# for cost estimates (see estimate_unit_cost).
+ESTIMATED_REPLY_TOKENS = 200
+ESTIMATED_VERDICT_TOKENS = 40
+
+# Response of a job its budget could not afford; it was not sent and is
+# neither logged nor saved.
+BUDGET_SKIPPED_RESPONSE = "Skipped: over budget"
+
+# Cascade mode (see evaluate_cascade): the selected models are asked from
+# the cheapest to the dearest at llm.PROVIDER_PRICES for a job of 
+# CASCADE_JOB_TOKENS input and output tokens (see cascade_tiers), and a 
+# mandate goes on to the next model only while its verdict is uncertain: 
+# unreadable, "more information needed" or less confident than 
+# CASCADE_MIN_CONFIDENCE.
+CASCADE_JOB_TOKENS = {"input": 1500, "output": 200}
+CASCADE_MIN_CONFIDENCE = 0.7
+
+# Model under which cascade results are logged and summarized; their "tier"
+# records the model, or "Rule", that decided each mandate.
+CASCADE_MODEL = "Cascade"
+
+def log_response(current_log: pd.DataFrame, product_df: pd.DataFrame, mandate_df: pd.DataFrame, llm_prompt: str, llm_response_full: str, llm_response: str, LLM: str, 
+                 verdict: dict = None, fingerprint: str = None, tier: str = None):
     # id | name | category_id | category_label | Sustainability certificates.42513 | 
     # Certification | Mandate Number | Mandate title | Mandate Description |
-    # prompt | response | recommendation | model | rec_datetime
+    # prompt | response | recommendation | model | rec_datetime |
+    # confidence | reasoning | cited_attributes (from verdict, see parse_response) |
+    # fingerprint (of the job's inputs, see job_fingerprint) | 
+    # tier (what decided the mandate, see job_tier)
+    verdict = verdict or {}
     
+    with trf.span("log_response"):
+        _log_response(current_log, product_df, mandate_df, llm_prompt, llm_response_full, llm_response, LLM, verdict, fingerprint, tier)
+
+def _log_response(current_log: pd.DataFrame, product_df: pd.DataFrame, mandate_df: pd.DataFrame, llm_prompt: str, llm_response_full: str, 
+                  llm_response: str, LLM: str, verdict: dict, fingerprint: str, tier: str):
     id = product_df["id"].item()
     name = product_df["name"].item()
     category_id = product_df["category_id"].item()
@@ -39,48 +112,151 @@ def log_response(current_log: pd.DataFrame, product_df: pd.DataFrame, mandate_df
     mandate_desc = mandate_df["Mandate Description"].item()
 
     current_log.loc[current_log.shape[0] + 1] = [id, name, category_id, category_label, certs, cert, mandate_no, mandate_title, 
-                                                mandate_desc, llm_prompt, llm_response_full, llm_response, LLM, datetime.now()]
+                                                mandate_desc, llm_prompt, llm_response_full, llm_response, LLM, datetime.now(), 
+                                                verdict.get("confidence"), verdict.get("reasoning"), ", ".join(verdict.get("cited_attributes", [])), 
+                                                fingerprint, tier]
+
+def _store_location(file_path: str):
+    # Results that used to be kept in <folder>/<name>.csv live in table <name> 
+    # of <folder>/recommendations.sqlite.
+    folder, file_name = os.path.split(file_path)
+    return os.path.join(folder, "recommendations.sqlite"), os.path.splitext(file_name)[0]
+
+def _table_columns(con: sqlite3.Connection, table: str) -> list:
+    return [row[1] for row in con.execute('PRAGMA table_info("{}")'.format(table))]
+
+def _store_connection(file_path: str):
+    # Open the results store for file_path. The first time a table is used, 
+    # the history in the existing CSV is imported (oldest first, so rowid 
+    # order is chronological).
+    db_path, table = _store_location(file_path)
+    if not os.path.exists(os.path.dirname(db_path)):
+        os.makedirs(os.path.dirname(db_path), exist_ok = True)
+    con = sqlite3.connect(db_path, timeout = 30)
+    con.execute("PRAGMA journal_mode=WAL")
+
+    if not _table_columns(con, table) and os.path.exists(file_path):
+        con.execute("BEGIN IMMEDIATE")
+        if not _table_columns(con, table):
+            pd.read_csv(file_path).iloc[::-1].to_sql(table, con, index = False)
+            _create_store_indexes(con, table)
+        con.commit()
+    return con, table
+
+def _create_store_indexes(con: sqlite3.Connection, table: str):
+    for col in set(STORE_INDEX_COLUMNS) & set(_table_columns(con, table)):
+        con.execute('CREATE INDEX IF NOT EXISTS "{0}_{1}" ON "{0}" ("{1}")'.format(table, col))
 
 def save_recommendation(file_path: str, new_recommendation: pd.DataFrame):
     # id | name | category_id | category_label | Sustainability certificates.42513 | 
     # Certification | Mandate Number | Mandate title | Mandate Description |
     # prompt | response | recommendation | model | rec_datetime
 
-    df = pd.read_csv(file_path)
-    df = pd.concat([new_recommendation, df])
-    df.to_csv(file_path, index = False)
+    # Appends to the results store in a single transaction; existing rows are 
+    # never read or rewritten. Columns the table does not have yet are added.
+    with trf.span("save_recommendation", table = os.path.basename(file_path), rows = new_recommendation.shape[0]):
+        con, table = _store_connection(file_path)
+        with closing(con):
+            con.execute("BEGIN IMMEDIATE")
+            columns = _table_columns(con, table)
+            for col in new_recommendation.columns:
+                if columns and col not in columns:
+                    con.execute('ALTER TABLE "{}" ADD COLUMN "{}"'.format(table, col))
+            new_recommendation.to_sql(table, con, if_exists = "append", index = False)
+            _create_store_indexes(con, table)
+            con.commit()
+
+def load_recommendations(file_path: str, filters: dict = None, limit: int = 100, offset: int = 0) -> pd.DataFrame:
+    # Newest-first page of saved results, optionally filtered on exact column 
+    # values, e.g. {"id": product_id, "model": "Cohere"}.
+    filters = filters or {}
+    con, table = _store_connection(file_path)
+    with closing(con):
+        if not _table_columns(con, table):
+            return pd.DataFrame()
+        where = " AND ".join('"{}" = ?'.format(col) for col in filters)
+        query = 'SELECT * FROM "{}"{} ORDER BY rowid DESC LIMIT ? OFFSET ?'.format(table, " WHERE " + where if where else "")
+        return pd.read_sql_query(query, con, params = list(filters.values()) + [limit, offset])
+
+def mandate_relevance_path(dataset_name: str) -> str:
+    return "./Product Certification/" + dataset_name + "/mandate_column_relevance_full.csv"
+
+def ensure_mandate_relevance(dataset_name: str) -> str:
+    # Path of the dataset's relevance file, ranked from its data dictionary
+    # when missing or out of date (see rlf.ensure_mandate_relevance).
+    return rlf.ensure_mandate_relevance(mandate_relevance_path(dataset_name), MANDATES_PATH, 
+                                        ddf.data_dictionary_path(DATA_DICTIONARY_DIR, dataset_name))
+
+def compile_mandate_index(mandate_column_full_df: pd.DataFrame) -> dict:
+    # {(Certification, Mandate Number): {"columns": raw column names, 
+    #  "names": display names}}, both as arrays in relevance order. Mandate 
+    # numbers are keyed as strings so "5.3" and 5.3 match.
+    index = {}
+    for (cert, number), rows in mandate_column_full_df.groupby(["Certification", "Mandate Number"], sort = False):
+        rows = rows.dropna(subset = ["Column Name Raw"])
+        index[(cert, str(number))] = {"columns": rows["Column Name Raw"].to_numpy(dtype = object), 
+                                      "names": rows["Column Name"].astype(str).to_numpy(dtype = object)}
+    return index
+
+def _read_mandate_relevance(file_path: str):
+    mandate_column_full_df = pd.read_csv(file_path)
+    return mandate_column_full_df, compile_mandate_index(mandate_column_full_df)
+
+def load_mandate_relevance(file_path: str):
+    # The relevance table and its compiled index, read once and shared until
+    # the file changes.
+    return dsf.cached_load(file_path, _read_mandate_relevance)
+
+def load_mandates() -> pd.DataFrame:
+    # The certification mandates, shared until the file changes
+    return dsf.read_csv(MANDATES_PATH)
+
+def extract_mandate_attributes(products: pd.DataFrame, mandate: dict, top_k: int = 5) -> np.ndarray:
+    # For every product (row) the "Name: value unit" lines of the first top_k
+    # relevant columns that have a value, as one string per product. 
+    # Relevant columns missing from products are skipped.
+    if mandate is None:
+        return np.full(products.shape[0], "", dtype = object)
+    present = np.array([col in products.columns for col in mandate["columns"]], dtype = bool)
+    columns, names = mandate["columns"][present], mandate["names"][present]
+    if len(columns) == 0:
+        return np.full(products.shape[0], "", dtype = object)
+
+    values = products[list(columns)]
+    has_value = values.notna().to_numpy()
+    keep = has_value & (np.cumsum(has_value, axis = 1) <= top_k)
+
+    units = pd.DataFrame({col: products[col + ".unit"] if col + ".unit" in products.columns else None for col in columns}, index = products.index)
+    units = np.where(units.notna(), " " + units.to_numpy(dtype = object).astype(str).astype(object), "")
+
+    lines = names + ": " + values.to_numpy(dtype = object).astype(str).astype(object) + units + "\n"
+    return np.where(keep, lines, "").sum(axis = 1).astype(object)
 
-def prepare_mandate_query(mandate_df: pd.DataFrame, product: pd.DataFrame):
-    # Take in the mandate information and columns relevant to the mandate, 
-    # parse through the product data to ensure that accurate information 
-    # will be sent to the LLM.
+def prepare_mandate_query(mandate_df: pd.DataFrame, product: pd.DataFrame, product_attributes: str, mandate_description: str = None):
+    # Build the mandate/product section of the prompt. 
 
     # EXPECTS:
-    # mandate_df: mandate definition and column mapping 
-    #     columns: Certification, Mandate Number, Mandate title, Mandate Description, Column Name Raw, Column Name, Column Rank
+    # mandate_df: the mandate's row of the certification mandates
+    #     columns: Certification, Mandate Number, Mandate title, Mandate Description
     
-    # product: product dataset
-    #     columns: name, and column names corresponding to Column Name Raw from mandate_df
+    # product: the product's row of the dataset
+    #     columns: name, category_label
+
+    # product_attributes: the product's relevant attributes, one per line,
+    # as produced by extract_mandate_attributes
+
+    # mandate_description: replaces the mandate's own description, e.g. a
+    # compacted one
+
+    if mandate_description is None:
+        mandate_description = mandate_df.iloc[0]["Mandate Description"]
 
     mandate_header = "MANDATE\n\n{} Certification\nMandate {}: {}".format(mandate_df.iloc[0]["Certification"], mandate_df.iloc[0]["Mandate Number"], mandate_df.iloc[0]["Mandate title"])
-    mandate_description = "\nMandate Description: \n{}".format(mandate_df.iloc[0]["Mandate Description"])
+    mandate_description = "\nMandate Description: \n{}".format(mandate_description)
 
     product_name = "\n\nPRODUCT\n\nName: {} ({})".format(product.iloc[0]["name"], product.iloc[0]["category_label"])
 
-    product_attributes = 0
-    product_attribute_string = "\n"
-    i = mandate_df.index[0]
-    while product_attributes < 5 and i < mandate_df.index[-1]:
-        col = mandate_df["Column Name Raw"][i]
-        if not pd.isna(product[col][0]):
-            col_unit = product[col + ".unit"][0]
-            if pd.isna(col_unit):
-                col_unit = ""
-            else:
-                col_unit = " " + str(col_unit)
-            product_attribute_string += str(mandate_df["Column Name"][i]) + ": " + str(product[col][0]) + str(col_unit) + "\n"
-            product_attributes += 1
-        i += 1
+    product_attribute_string = "\n" + product_attributes
 
     final_query = "\nIs the product \"{}\" compliant with the {} Certification Mandate {}: {}?".format(product.iloc[0]["name"], 
                                                                                                             mandate_df.iloc[0]["Certification"], 
@@ -89,79 +265,947 @@ def prepare_mandate_query(mandate_df: pd.DataFrame, product: pd.DataFrame):
 
     return mandate_header + mandate_description + product_name + product_attribute_string + final_query
 
-@st.cache_data  
-def query_LLM(mandate_df: pd.DataFrame, mandate_column_df: pd.DataFrame, product: pd.DataFrame, LLM: str, LLM_token: str):
+# Static instructions, sent once per request as the provider's system message
+# instead of being repeated in every prompt.
+MANDATE_SYSTEM_PROMPT = """You are a subject matter expert for assessing the eligibility of IT products for sustainability certifications. Given a certification mandate, assess whether the product meets the mandate using the product attributes. Provide your assessment as ONLY a valid JSON object (no other text is necessary) with the following keys, in this order:
+- "recommendation": "TRUE" if the product is compliant, "FALSE" if the product is not compliant, "MORE INFO NEEDED" if there is not enough information provided
+- "confidence": your confidence in the recommendation, a number from 0 to 1
+- "reasoning": your reasoning for the recommendation
+- "cited_attributes": a list of the names of the product attributes your reasoning relies on"""
+
+MANDATE_GROUP_SYSTEM_PROMPT = """You are a subject matter expert for assessing the eligibility of IT products for sustainability certifications. Given a product and a numbered list of certification mandates, assess whether the product meets each mandate using the product attributes. Provide your assessment as ONLY a valid JSON object (no other text is necessary) of the form {"verdicts": [...]}, with one entry per mandate in the order listed. Each entry has the following keys:
+- "mandate": the mandate number as given
+- "recommendation": "TRUE" if the product is compliant, "FALSE" if the product is not compliant, "MORE INFO NEEDED" if there is not enough information provided
+- "confidence": your confidence in the recommendation, a number from 0 to 1
+- "reasoning": your reasoning for the recommendation
+- "cited_attributes": a list of the names of the product attributes your reasoning relies on"""
+
+# Prompt size limits, in tokens. A mandate description is cut to 
+# MANDATE_DESCRIPTION_TOKENS; a single mandate prompt is then held to 
+# PROMPT_TOKEN_BUDGET by shortening the description further and dropping
+# the last attributes. Grouped requests pack mandates until the prompt plus
+# GROUP_TOKENS_PER_MANDATE of reply per mandate reaches GROUP_TOKEN_BUDGET.
+MANDATE_DESCRIPTION_TOKENS = 300
+PROMPT_TOKEN_BUDGET = 1500
+MIN_DESCRIPTION_TOKENS = 60
+GROUP_TOKEN_BUDGET = 3500
+GROUP_TOKENS_PER_MANDATE = 150
+GROUP_MAX_MANDATES = 10
+
+def group_max_tokens(mandates: int) -> int:
+    # Reply token limit of a grouped request
+    return max(1024, 2 * GROUP_TOKENS_PER_MANDATE * mandates)
+
+def compact_description(mandate_description, max_tokens: int = MANDATE_DESCRIPTION_TOKENS) -> str:
+    # Whitespace collapsed (descriptions carry tables and line-wrapped 
+    # paragraphs) and cut to max_tokens.
+    return llm.truncate_to_tokens(" ".join(str(mandate_description).split()), max_tokens)
 
-    payload = prepare_mandate_query(mandate_column_df, product)
+def build_mandate_prompt(mandate_df: pd.DataFrame, product: pd.DataFrame, product_attributes: str, 
+                         token_budget: int = PROMPT_TOKEN_BUDGET) -> str:
+    # The user prompt for one mandate, held to token_budget tokens.
+    description = compact_description(mandate_df.iloc[0]["Mandate Description"])
+    attributes = product_attributes.splitlines(keepends = True)
+    prompt = prepare_mandate_query(mandate_df, product, "".join(attributes), description)
 
-    prompt = """You are a subject matter expert for assessing the eligibility of IT products for sustainability certifications. 
-    Given the following certification mandate, assess whether the product meets the mandate using the product attributes. Provide 
-    the following as your assessment:
+    overflow = num_tokens_from_string(prompt, "cl100k_base") - token_budget
+    if overflow > 0:
+        description_tokens = num_tokens_from_string(description, "cl100k_base")
+        description = llm.truncate_to_tokens(description, max(description_tokens - overflow, MIN_DESCRIPTION_TOKENS))
+        prompt = prepare_mandate_query(mandate_df, product, "".join(attributes), description)
+    while attributes and num_tokens_from_string(prompt, "cl100k_base") > token_budget:
+        attributes = attributes[:-1]
+        prompt = prepare_mandate_query(mandate_df, product, "".join(attributes), description)
+    return prompt
 
-    - Recommendation: TRUE if the product is compliant, FALSE if the product is not compliant or if more information is needed
+def build_group_prompt(group_jobs: list) -> str:
+    # The user prompt for several mandates of one product: the product and
+    # the union of the mandates' attributes once, then the mandates.
+    product = group_jobs[0]["product"]
+    attributes = dict.fromkeys(line for job in group_jobs for line in job["attributes"].splitlines() if line)
 
-    - Reasoning: Your reasoning for the recommendation.
+    prompt = "PRODUCT\n\nName: {} ({})\n{}\n\nMANDATES\n".format(product.iloc[0]["name"], product.iloc[0]["category_label"], "\n".join(attributes))
+    for n, job in enumerate(group_jobs):
+        mandate = job["mandate_df"].iloc[0]
+        prompt += "\n{}. {} Certification Mandate {}: {}\nMandate Description: {}\n".format(n + 1, mandate["Certification"], mandate["Mandate Number"], 
+                                                                                           mandate["Mandate title"], compact_description(mandate["Mandate Description"]))
+    return prompt + "\nIs the product \"{}\" compliant with each of these mandates?".format(product.iloc[0]["name"])
 
-    {}
+def pack_mandate_groups(jobs: list, token_budget: int = GROUP_TOKEN_BUDGET, max_mandates: int = GROUP_MAX_MANDATES) -> list:
+    # Split the (index, job) pairs of one product, certification and model 
+    # into groups whose prompt plus expected reply fits token_budget.
+    groups = []
+    group = []
+    for i, job in jobs:
+        candidate = group + [(i, job)]
+        tokens = num_tokens_from_string(build_group_prompt([j for _, j in candidate]), "cl100k_base") + GROUP_TOKENS_PER_MANDATE * len(candidate)
+        if group and (tokens > token_budget or len(candidate) > max_mandates):
+            groups.append(group)
+            candidate = [(i, job)]
+        group = candidate
+    if group:
+        groups.append(group)
+    return groups
 
-    If there is not enough information provided, respond with "MORE INFO NEEDED" and your reasoning. 
-    """.format(payload)
+# "Recommendation: TRUE" etc., as asked for by the query_LLM prompt
+VERDICT_PATTERN = re.compile(r"Recommendation\W*(TRUE|FALSE|MORE INFO NEEDED)\b", re.IGNORECASE)
 
-    #st.markdown(prompt)
+def parse_verdict(llm_response: str):
+    # "True", "False" or "N/A" from the structured verdict line of a 
+    # (possibly partial) response; None until the verdict is complete.
+    match = VERDICT_PATTERN.search(llm_response)
+    if match is None:
+        return None
+    return {"TRUE": "True", "FALSE": "False", "MORE INFO NEEDED": "N/A"}[match.group(1).upper()]
 
-    if LLM == "Cohere":
-        model = cohere.Client(api_key = LLM_token)
+# A confidence followed by what ends the number, so "0.8" of "0.85" is not
+# taken for the whole value
+CONFIDENCE_PATTERN = re.compile(r"Confidence\W*([0-9.]+)\s*[,}\n]", re.IGNORECASE)
+
+def verdict_complete(llm_response: str) -> bool:
+    # Whether a partial response holds its verdict and the confidence that
+    # follows it (or is a whole object), so generation can stop there 
+    # without losing what needs_escalation reads.
+    if parse_verdict(llm_response) is None:
+        return False
+    return CONFIDENCE_PATTERN.search(llm_response) is not None or _load_object(llm_response) is not None
+
+def query_LLM(mandate_df: pd.DataFrame, product_attributes: str, product: pd.DataFrame, LLM: str, LLM_token: str, 
+              reasoning: bool = True, on_text = None):
+    # The response is streamed; on_text(text so far) is called as it 
+    # arrives. Without reasoning, generation stops once the verdict and its
+    # confidence are in (see verdict_complete). The returned prompt 
+    # includes the system message.
+
+    with trf.span("prepare_prompt"):
+        payload = build_mandate_prompt(mandate_df, product, product_attributes)
+    prompt = MANDATE_SYSTEM_PROMPT + "\n\n" + payload
+
+    return prompt, _stream_query(LLM, payload, LLM_token, on_text = on_text, system = MANDATE_SYSTEM_PROMPT, 
+                                 stop = None if reasoning else verdict_complete)
+
+def query_mandate_group(group_jobs: list, LLM: str, LLM_token: str, on_text = None):
+    # One request for several mandates of one product (see build_group_prompt).
+    # Grouped responses are not stopped early. The returned prompt includes 
+    # the system message.
+    with trf.span("prepare_prompt", mandates = len(group_jobs)):
+        payload = build_group_prompt(group_jobs)
+    prompt = MANDATE_GROUP_SYSTEM_PROMPT + "\n\n" + payload
+
+    return prompt, _stream_query(LLM, payload, LLM_token, on_text = on_text, system = MANDATE_GROUP_SYSTEM_PROMPT, 
+                                 max_tokens = group_max_tokens(len(group_jobs)))
+
+def _stream_query(LLM: str, payload: str, LLM_token: str, **kwargs) -> str:
+    # The streamed JSON response, or one of ERROR_RESPONSES if the provider
+    # could not be queried.
+    try:
+        return llm.generate_stream(LLM, payload, LLM_token, json_mode = True, **kwargs)
+    except llm.RateLimitError:
+        return "LIMIT RATE"
+    except llm.ServiceUnavailableError:
+        return "ServiceError"
+    except Exception as e:
+        if LLM == "GPT-3.5":
+            return "Error in OpenAI Response:{}".format(e)
+        return "Error in {} response: {}".format(LLM, e)
+
+# Responses query_LLM returns when the provider could not be queried
+ERROR_RESPONSES = ("LIMIT RATE", "ServiceError", "Error in ")
+
+MAX_REASKS = 1
+
+REASK_PROMPT = """The following assessment of a product against a certification mandate could not be read. Rewrite it as ONLY a valid JSON object (no other text is necessary) with the keys "recommendation" ("TRUE", "FALSE" or "MORE INFO NEEDED"), "confidence" (a number from 0 to 1), "reasoning" and "cited_attributes" (a list of the product attribute names the reasoning relies on). Do not change the assessment.
+
+ASSESSMENT:
+{}
+"""
+
+def _normalize_recommendation(value):
+    if isinstance(value, bool):
+        return "True" if value else "False"
+    value = str(value).strip().upper()
+    if value in ["TRUE", "YES", "COMPLIANT"]:
+        return "True"
+    if value in ["FALSE", "NO", "NOT COMPLIANT"]:
+        return "False"
+    if value in ["MORE INFO NEEDED", "MORE INFORMATION NEEDED", "N/A", "UNKNOWN"]:
+        return "N/A"
+    return None
+
+def _normalize_confidence(value):
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return None
+    if 1 < value <= 100:
+        value = value / 100
+    return min(max(value, 0.0), 1.0)
+
+def _load_object(llm_response: str):
+    # The outermost {...} of a response as a dict, read as JSON or as a 
+    # Python literal; None if there is none.
+    start, end = llm_response.find("{"), llm_response.rfind("}")
+    if start == -1 or end <= start:
+        return None
+    for loads in [json.loads, ast.literal_eval]:
         try:
-            output = model.generate(prompt = prompt, 
-                                    model = 'command', 
-                                    max_tokens = 1024, 
-                                    temperature = 0.0)
-            
-            output = output.generations[0].text
-            
-            if "," in output[-3:]:
-                output = output[:output.rfind(",")] + output[-1:]
-
-            #st.markdown(output)
-
-            return prompt, output
-        except Exception as e:
-            if "You are using a Trial key" in str(e):
-                return prompt, "LIMIT RATE"
-            else:
-                return prompt, "Error in Cohere response: {}".format(e)
-    elif LLM == "LLaMA2":
-        os.environ['REPLICATE_API_TOKEN'] = LLM_token
+            fields = loads(llm_response[start:end + 1])
+            return fields if isinstance(fields, dict) else None
+        except (ValueError, SyntaxError):
+            continue
+    return None
+
+def _verdict_fields(fields):
+    # Typed verdict from the fields of a parsed response object, or None
+    # without a recognizable recommendation.
+    if not isinstance(fields, dict):
+        return None
+    fields = {str(key).strip().lower().replace(" ", "_"): value for key, value in fields.items()}
+    recommendation = _normalize_recommendation(fields.get("recommendation"))
+    if recommendation is None:
+        return None
+    cited = fields.get("cited_attributes") or []
+    if isinstance(cited, str):
+        cited = [attr.strip() for attr in cited.split(",") if attr.strip()]
+    return {"recommendation": recommendation, 
+            "confidence": _normalize_confidence(fields.get("confidence")), 
+            "reasoning": str(fields.get("reasoning") or ""), 
+            "cited_attributes": [str(attr) for attr in cited]}
+
+def parse_response(llm_response: str):
+    # Typed verdict from a response: {"recommendation": "True"/"False"/"N/A",
+    # "confidence": 0-1 or None, "reasoning": str, "cited_attributes": [str]}.
+    # The JSON object asked for by query_LLM is preferred; Python-style dicts
+    # and "Recommendation: ..." text are accepted too. None if no verdict 
+    # can be found.
+    verdict = _verdict_fields(_load_object(llm_response))
+    if verdict is not None:
+        return verdict
+
+    recommendation = parse_verdict(llm_response)
+    if recommendation is None:
+        return None
+    reasoning = re.search(r"Reasoning\W*(.*)", llm_response, re.IGNORECASE | re.DOTALL)
+    confidence = re.search(r"Confidence\W*([0-9.]+)", llm_response, re.IGNORECASE)
+    return {"recommendation": recommendation, 
+            "confidence": _normalize_confidence(confidence.group(1)) if confidence else None, 
+            "reasoning": reasoning.group(1).strip() if reasoning else "", 
+            "cited_attributes": []}
+
+def parse_group_response(llm_response: str, numbers: list):
+    # (verdicts, entries) for a grouped response, in the order of numbers 
+    # (the mandate numbers asked about): each mandate's typed verdict and
+    # its entry as JSON text, or None where the mandate has no readable 
+    # verdict. Entries are matched on their "mandate" number, or on their 
+    # position when the number is missing.
+    fields = _load_object(llm_response)
+    entries = fields.get("verdicts") if isinstance(fields, dict) else None
+    if not isinstance(entries, list):
+        return [None] * len(numbers), [None] * len(numbers)
+
+    numbers = [str(number) for number in numbers]
+    matched = {}
+    for position, entry in enumerate(entries):
+        if not isinstance(entry, dict):
+            continue
+        number = str(entry.get("mandate", "")).strip()
+        if number not in numbers and position < len(numbers) and numbers[position] not in matched:
+            number = numbers[position]
+        if number in numbers and number not in matched:
+            matched[number] = entry
+
+    verdicts = [_verdict_fields(matched.get(number)) for number in numbers]
+    entries = [json.dumps(matched[number]) if verdict is not None else None for number, verdict in zip(numbers, verdicts)]
+    return verdicts, entries
+
+def classify_response(llm_response_full: str) -> str:
+    # Map a raw LLM response onto the recommendation values stored in the log:
+    # "True", "False" or "N/A" (more information needed). The structured
+    # verdict line is used when present.
+    verdict = parse_verdict(llm_response_full)
+    if verdict is not None:
+        return verdict
+    if "TRUE" in llm_response_full or "does meet" in llm_response_full:
+        return "True"
+    elif "more info" in llm_response_full.lower() or "not provided" in llm_response_full.lower() or "cannot determine" in llm_response_full.lower():
+        return "N/A"
+    else: 
+        return "False"
 
-        query = replicate.run("meta/llama-2-70b-chat:02e509c789964a7ea8736978a43525956ef40397be9033abf9fd2badfe68c9e3",
-                                input={"prompt": prompt})
-        
-        output = ""
-        for item in query:
-            output = output + item
+def job_fingerprint(job: dict) -> str:
+    # Content fingerprint of everything a job's result depends on: the 
+    # mandate row, the product and the attribute values put in the prompt,
+    # the rule decision, the prompt mode (reasoning, grouped mandates) and 
+    # the templates it uses, and the model. A saved result with the same 
+    # fingerprint would be obtained again. Rule decisions do not depend on
+    # the prompt mode.
+    mandate = job["mandate_df"].iloc[0]
+    product = job["product"].iloc[0]
+    if job.get("rule") is not None:
+        mode = None
+    elif job.get("group_mandates", False):
+        # Mandates a grouped reply misses are asked about on their own
+        mode = [job.get("reasoning", True), True, MANDATE_GROUP_SYSTEM_PROMPT, MANDATE_SYSTEM_PROMPT]
+    else:
+        mode = [job.get("reasoning", True), False, MANDATE_SYSTEM_PROMPT]
+    content = [{str(col): str(value) for col, value in mandate.items()}, 
+               [str(product["name"]), str(product["category_label"])], 
+               str(job["attributes"]), 
+               None if job.get("rule") is None else [str(value) for value in job["rule"]], 
+               [PROMPT_TEMPLATE_VERSION, MANDATE_DESCRIPTION_TOKENS, PROMPT_TOKEN_BUDGET], 
+               mode, 
+               job["model"]]
+    return hashlib.sha256(json.dumps(content).encode("utf-8")).hexdigest()[:16]
 
+def build_mandate_jobs(product_df: pd.DataFrame, mandates_df: pd.DataFrame, mandate_index: dict, certs: list, models: list, 
+                       rules: pd.DataFrame = None, reasoning: bool = True, group_mandates: bool = False):
+    # One job per (product, certification, model, mandate), listed in the order 
+    # the results should be logged. Each job holds everything query_LLM needs,
+    # and the prompt mode it will be evaluated with (for its fingerprint).
+    # The attributes of all products are extracted at once per mandate. 
+    # Where the rules decide a mandate for a product, the job carries the
+    # decision in "rule" and the LLM is not queried.
+    mandates = {cert: mandates_df[mandates_df["Certification"] == cert] for cert in certs}
+    rule_results = rf.evaluate_mandate_rules(product_df, rules[rules["Certification"].isin(certs)]) if rules is not None else {}
+    attributes = {}
+    for cert in certs:
+        for number in mandates[cert]["Mandate Number"]:
+            key = (cert, str(number))
+            attributes[key] = extract_mandate_attributes(product_df, mandate_index.get(key))
+
+    jobs = []
+    for p in range(product_df.shape[0]):
+        product = product_df.iloc[[p]]
+        for cert in certs:
+            for LLM in models:
+                for mandate in range(mandates[cert].shape[0]):
+                    mandate_df = mandates[cert].iloc[[mandate]]
+                    key = (cert, str(mandate_df["Mandate Number"].item()))
+
+                    rule = None
+                    if key in rule_results and rule_results[key][0][p] is not None:
+                        rule = (rule_results[key][0][p], rule_results[key][1][p])
+
+                    job = {"product": product, 
+                           "cert": cert, 
+                           "model": LLM, 
+                           "mandate_df": mandate_df, 
+                           "attributes": attributes[key][p], 
+                           "rule": rule, 
+                           "reasoning": reasoning, 
+                           "group_mandates": group_mandates}
+                    job["fingerprint"] = job_fingerprint(job)
+                    jobs.append(job)
+    return jobs
+
+def evaluate_mandate(job: dict, LLM_token: str, reasoning: bool = True, on_text = None):
+    # Run a single job and parse the response into (prompt, response, 
+    # recommendation, verdict). Executed on worker threads, so it must not 
+    # draw anything on the page. Throttling, retries and response caching 
+    # are handled in llm_functions. An unparsable response is not evaluated
+    # again: the model is only asked to restate it in the expected format.
+    with trf.span("evaluate_mandate", cert = job["cert"], mandate = job["mandate_df"]["Mandate Number"].item(), model = job["model"], 
+                  rule = job.get("rule") is not None) as attributes:
+        result = _evaluate_mandate(job, LLM_token, reasoning, on_text)
+        attributes["recommendation"] = result[2]
+        return result
+
+def _evaluate_mandate(job: dict, LLM_token: str, reasoning: bool, on_text):
+    if job.get("rule") is not None:
+        decision, explanation = job["rule"]
+        verdict = {"recommendation": decision, "confidence": 1.0, "reasoning": explanation, 
+                   "cited_attributes": [line.split(":")[0] for line in explanation.splitlines() if line]}
+        return "RULE\n\n" + explanation, "Decided by rule, {} was not queried:\n{}".format(job["model"], explanation), decision, verdict
+
+    prompt, llm_response_full = query_LLM(job["mandate_df"], job["attributes"], job["product"], job["model"], LLM_token, 
+                                          reasoning, on_text)
+
+    with trf.span("parse_verdict"):
+        verdict = parse_response(llm_response_full)
+    if verdict is None and not llm_response_full.startswith(ERROR_RESPONSES):
+        for attempt in range(MAX_REASKS):
+            try:
+                with trf.span("reask", attempt = attempt):
+                    verdict = parse_response(llm.generate(job["model"], REASK_PROMPT.format(llm_response_full), LLM_token, 
+                                                          max_tokens = 512, json_mode = True))
+            except Exception:
+                break
+            if verdict is not None:
+                break
+
+    if verdict is None:
+        return prompt, llm_response_full, classify_response(llm_response_full), None
+    return prompt, llm_response_full, verdict["recommendation"], verdict
+
+def evaluate_mandate_group(group_jobs: list, LLM_token: str, reasoning: bool = True, on_text = None) -> list:
+    # Run jobs of one product, certification and model as a single request
+    # and return one (prompt, response, recommendation, verdict) per job; 
+    # each job's response is its entry of the grouped reply. Mandates the 
+    # reply misses are asked about again on their own.
+    if len(group_jobs) == 1:
+        return [evaluate_mandate(group_jobs[0], LLM_token, reasoning, on_text)]
+
+    numbers = [job["mandate_df"]["Mandate Number"].item() for job in group_jobs]
+    with trf.span("evaluate_mandate_group", cert = group_jobs[0]["cert"], mandate = ", ".join(map(str, numbers)), 
+                  model = group_jobs[0]["model"], mandates = len(group_jobs)):
+        prompt, llm_response_full = query_mandate_group(group_jobs, group_jobs[0]["model"], LLM_token, on_text)
+        if llm_response_full.startswith(ERROR_RESPONSES):
+            return [(prompt, llm_response_full, classify_response(llm_response_full), None) for _ in group_jobs]
+
+        with trf.span("parse_verdict", mandates = len(group_jobs)):
+            verdicts, entries = parse_group_response(llm_response_full, numbers)
+    results = []
+    for job, verdict, entry in zip(group_jobs, verdicts, entries):
+        if verdict is None:
+            results.append(evaluate_mandate(job, LLM_token, reasoning))
+        else:
+            results.append((prompt, entry, verdict["recommendation"], verdict))
+    return results
+
+def group_mandate_jobs(jobs: list) -> list:
+    # Lists of (job index, job) to send as one request each: the LLM jobs of
+    # every product, certification and model, packed by pack_mandate_groups.
+    units = {}
+    for i, job in enumerate(jobs):
+        if job.get("rule") is None:
+            units.setdefault((job["product"]["id"].item(), job["cert"], job["model"]), []).append((i, job))
+    return [group for unit in units.values() for group in pack_mandate_groups(unit)]
+
+class Budget:
+    # A spending cap in USD shared by the jobs carrying it (job["budget"]).
+    # Before a request is sent its estimated cost is reserved; once it is 
+    # done the reservation is settled at the actual cost. A request that 
+    # does not fit next to the requests in flight waits for them to settle,
+    # and is refused only if spending alone leaves no room for it, so how 
+    # much gets done does not depend on concurrency. The parent budget 
+    # (e.g. a dataset budget for a product budget) must afford it too. 
+    # Requests that cost nothing (cached responses) are always allowed.
+    def __init__(self, limit: float, parent = None):
+        self.limit = limit
+        self.parent = parent
+        self.spent = 0.0
+        self.reserved = 0.0
+        self.in_flight = 0
+        self.refused = 0
+        self.condition = threading.Condition()
+
+    def reserve(self, amount: float, block: bool = True):
+        # True once amount is reserved, False if it is refused. Without 
+        # block, returns None instead of waiting for requests in flight.
+        with self.condition:
+            while amount > 0 and self.spent + self.reserved + amount > self.limit:
+                if self.in_flight == 0 or self.spent + amount > self.limit:
+                    self.refused += 1
+                    return False
+                if not block:
+                    return None
+                self.condition.wait()
+            self.reserved += amount
+            self.in_flight += 1
+        reserved = True if self.parent is None else self.parent.reserve(amount, block)
+        if reserved is not True:
+            self.settle(amount, 0.0, parent = False)
+        return reserved
+
+    def settle(self, reserved: float, cost: float, parent: bool = True):
+        with self.condition:
+            self.reserved -= reserved
+            self.in_flight -= 1
+            self.spent += cost
+            self.condition.notify_all()
+        if parent and self.parent is not None:
+            self.parent.settle(reserved, cost)
+
+def estimate_unit_cost(group_jobs: list, reasoning: bool = True) -> float:
+    # Expected USD cost of sending jobs as one request (see 
+    # evaluate_mandate_group): nothing if the response is cached, otherwise
+    # the prompt tokens plus the expected reply at the model's prices.
+    model = group_jobs[0]["model"]
+    if len(group_jobs) == 1:
+        job = group_jobs[0]
+        system, payload = MANDATE_SYSTEM_PROMPT, build_mandate_prompt(job["mandate_df"], job["product"], job["attributes"])
+        reply_tokens = ESTIMATED_REPLY_TOKENS if reasoning else ESTIMATED_VERDICT_TOKENS
+        max_tokens = 1024
+    else:
+        system, payload = MANDATE_GROUP_SYSTEM_PROMPT, build_group_prompt(group_jobs)
+        reply_tokens = GROUP_TOKENS_PER_MANDATE * len(group_jobs)
+        max_tokens = group_max_tokens(len(group_jobs))
+    if llm.is_cached(model, payload, system, json_mode = True, stopped = len(group_jobs) == 1 and not reasoning, max_tokens = max_tokens):
+        return 0.0
+    return llm.request_cost(model, num_tokens_from_string(system + "\n\n" + payload, "cl100k_base"), reply_tokens)
+
+def evaluate_metered(group_jobs: list, LLM_token: str, reasoning: bool = True, on_text = None, estimate: float = 0.0) -> list:
+    # evaluate_mandate_group, once the jobs' budget has reserved estimate 
+    # for them (see Budget.reserve); the reservation is settled at the 
+    # actual cost. Each job's share of the tokens and cost of its requests
+    # (see llm.metered) is stored in job["usage"].
+    budget = group_jobs[0].get("budget")
+    with llm.metered() as usage:
         try:
-            return prompt, output
-        except:
-            return prompt, "Error"
-    elif LLM == "GPT-3.5":
-        openai.api_key = LLM_token
-
-        try: 
-            output = openai.ChatCompletion.create(
-                model="gpt-3.5-turbo",
-                messages=[
-                    {"role": "user", "content": prompt}
-                ]
-            )
-        except Exception as e:
-            if "ServiceUnavailableError" in str(e):
-                return prompt, "ServiceError"
+            results = evaluate_mandate_group(group_jobs, LLM_token, reasoning, on_text)
+        finally:
+            if budget is not None:
+                budget.settle(estimate, usage["cost"])
+    for job in group_jobs:
+        job["usage"] = {stat: value / len(group_jobs) for stat, value in usage.items()}
+    return results
+
+def assign_budgets(jobs: list, budget: Budget = None, product_budget: float = None):
+    # Set job["budget"]: with product_budget, one Budget of that many USD per
+    # product, drawing on budget; otherwise budget itself.
+    products = {}
+    for job in jobs:
+        if product_budget is None:
+            job["budget"] = budget
+        else:
+            job["budget"] = products.setdefault(job["product"]["id"].item(), Budget(product_budget, budget))
+
+def is_skipped(result) -> bool:
+    return result[1] == BUDGET_SKIPPED_RESPONSE
+
+def tally_usage(jobs: list, results: list, key) -> dict:
+    # {key(job): (USD cost, jobs skipped for lack of budget)}
+    tally = {}
+    for job, result in zip(jobs, results):
+        cost, skipped = tally.get(key(job), (0.0, 0))
+        tally[key(job)] = (cost + job.get("usage", {}).get("cost", 0.0), skipped + is_skipped(result))
+    return tally
+
+def evaluate_mandate_jobs(jobs: list, api_keys: dict, provider_concurrency: dict = PROVIDER_CONCURRENCY, 
+                         reasoning: bool = True, on_stream = None, group_mandates: bool = False):
+    # Fan the jobs out over one bounded thread pool per provider and yield 
+    # (job index, (prompt, response, recommendation, verdict)) as each job completes. 
+    # Completion order is arbitrary; callers use the index to restore job order.
+    # Jobs decided by rules complete immediately. Without reasoning, each 
+    # response stops at its verdict. on_stream({job index: text so far}) 
+    # is called on the caller's thread while responses are streaming in, 
+    # so it may draw on the page. With group_mandates, the mandates of a 
+    # product are sent together (see evaluate_mandate_group) and a grouped
+    # response streams under the index of its first job. Jobs run in the 
+    # caller's trace (see trace_functions.in_context).
+    # Jobs carrying a budget (see Budget) are sent cheapest first, which
+    # evaluates as many mandates as the budget affords; those it cannot
+    # afford complete with BUDGET_SKIPPED_RESPONSE. Budgets are reserved 
+    # here in that order, so the same mandates are skipped whatever the 
+    # concurrency.
+    for i, job in enumerate(jobs):
+        if job.get("rule") is not None:
+            yield i, evaluate_mandate(job, None)
+
+    if group_mandates:
+        units = group_mandate_jobs(jobs)
+    else:
+        units = [[(i, job)] for i, job in enumerate(jobs) if job.get("rule") is None]
+    estimates = [0.0] * len(units)
+    if any(unit[0][1].get("budget") is not None for unit in units):
+        with trf.span("estimate_costs", units = len(units)):
+            estimates = [estimate_unit_cost([job for _, job in unit], reasoning) for unit in units]
+        order = sorted(range(len(units)), key = lambda u: estimates[u])
+        units, estimates = [units[u] for u in order], [estimates[u] for u in order]
+    executors = {LLM: ThreadPoolExecutor(max_workers = provider_concurrency.get(LLM, 1)) 
+                 for LLM in set(unit[0][1]["model"] for unit in units)}
+    try:
+        streams = {}
+        futures = {}
+        pending = set()
+        queue = list(zip(units, estimates))
+        while queue or pending:
+            # Send units while their budget can tell whether it affords them,
+            # waiting on the budget only when none of ours are in flight
+            while queue:
+                unit, estimate = queue[0]
+                budget = unit[0][1].get("budget")
+                reserved = True if budget is None else budget.reserve(estimate, block = not pending)
+                if reserved is None:
+                    break
+                queue.pop(0)
+                if reserved:
+                    future = executors[unit[0][1]["model"]].submit(trf.in_context(evaluate_metered), [job for _, job in unit], api_keys[unit[0][1]["model"]], 
+                                                                   reasoning, functools.partial(streams.__setitem__, unit[0][0]), estimate)
+                    futures[future] = (unit, estimate)
+                    pending.add(future)
+                else:
+                    for i, _ in unit:
+                        yield i, ("", BUDGET_SKIPPED_RESPONSE, None, None)
+            if not pending:
+                continue
+            done, pending = wait(pending, timeout = STREAM_REFRESH_SECONDS, return_when = FIRST_COMPLETED)
+            for future in done:
+                unit, _ = futures[future]
+                streams.pop(unit[0][0], None)
+                for (i, _), result in zip(unit, future.result()):
+                    yield i, result
+            if on_stream is not None and pending:
+                on_stream(dict(streams))
+    finally:
+        # Units that never started (the caller stopped early) give their
+        # reservation back; running ones settle it when they finish
+        for future in pending:
+            unit, estimate = futures[future]
+            budget = unit[0][1].get("budget")
+            if future.cancel() and budget is not None:
+                budget.settle(estimate, 0.0)
+        for executor in executors.values():
+            executor.shutdown(wait = False, cancel_futures = True)
+
+def job_tier(job: dict) -> str:
+    # What decides a job: "Rule" or its model
+    return "Rule" if job.get("rule") is not None else job["model"]
+
+def cascade_tiers(models: list) -> list:
+    # models in the order a cascade asks them: by the price of a job, then
+    # by rate limit. Models without a price go last.
+    def order(model):
+        if model not in llm.PROVIDER_PRICES:
+            return (1, 0.0, 0.0)
+        cost = llm.request_cost(model, CASCADE_JOB_TOKENS["input"], CASCADE_JOB_TOKENS["output"])
+        return (0, cost, -llm.PROVIDER_RATE_LIMITS.get(model, {}).get("requests_per_minute", 0))
+    return sorted(models, key = order)
+
+def needs_escalation(result) -> bool:
+    prompt, llm_response_full, recommendation, verdict = result
+    if llm_response_full == BUDGET_SKIPPED_RESPONSE:
+        return False
+    if verdict is None:
+        return True
+    confidence = verdict.get("confidence")
+    return recommendation == "N/A" or (confidence is not None and confidence < CASCADE_MIN_CONFIDENCE)
+
+def _tier_job(job: dict, model: str) -> dict:
+    tier_job = dict(job, model = model)
+    tier_job.pop("usage", None)
+    tier_job["fingerprint"] = job_fingerprint(tier_job)
+    return tier_job
+
+def _add_usage(usage: dict, more: dict) -> dict:
+    return {stat: usage.get(stat, 0) + more.get(stat, 0) for stat in set(usage) | set(more)}
+
+def evaluate_cascade(jobs: list, api_keys: dict, tiers: list, **kwargs):
+    # Evaluate jobs, built for tiers[0], with the models of tiers in turn: 
+    # mandates whose verdict is uncertain (see needs_escalation) are asked 
+    # again of the next model, the others are decided. As each mandate is 
+    # decided, jobs[i] is replaced by the job of the tier that decided it,
+    # with the usage of every tier asked, and (i, result) is yielded. 
+    # kwargs are passed on to evaluate_mandate_jobs.
+    pending = list(range(len(jobs)))
+    carried = {}
+    for t, model in enumerate(tiers):
+        tier_jobs = [jobs[i] if t == 0 else _tier_job(jobs[i], model) for i in pending]
+        escalated = []
+        for j, result in evaluate_mandate_jobs(tier_jobs, api_keys, **kwargs):
+            i = pending[j]
+            usage = _add_usage(carried.pop(i, {}), tier_jobs[j].get("usage", {}))
+            if t + 1 < len(tiers) and tier_jobs[j].get("rule") is None and needs_escalation(result):
+                carried[i] = usage
+                escalated.append(i)
             else:
-                return prompt, "Error in OpenAI Response:{}".format(e)
+                jobs[i] = dict(tier_jobs[j], usage = usage)
+                yield i, result
+        pending = sorted(escalated)
+        if not pending:
+            break
+
+def result_model(job: dict, cascade: bool = False) -> str:
+    # The model a job's result is logged under
+    return CASCADE_MODEL if cascade else job["model"]
+
+def _result_key(product_id, cert, mandate_number, LLM) -> tuple:
+    return (str(product_id), str(cert), str(mandate_number), str(LLM))
+
+def load_saved_results(file_path: str, ids: list) -> dict:
+    # Latest saved result with a fingerprint for every (id, Certification, 
+    # Mandate Number, model) of the given products, as a dict of column values.
+    con, table = _store_connection(file_path)
+    with closing(con):
+        columns = _table_columns(con, table)
+        if "fingerprint" not in columns:
+            return {}
+        select = ", ".join('"{}"'.format(col) for col in ["id", "Certification", "Mandate Number", "model", "fingerprint", "prompt", "response", 
+                                                          "recommendation", "confidence", "reasoning", "cited_attributes"] if col in columns)
+        saved = {}
+        ids = list(dict.fromkeys(ids))
+        # SQLite limits the number of query parameters
+        for offset in range(0, len(ids), 500):
+            batch = ids[offset:offset + 500]
+            query = 'SELECT {} FROM "{}" WHERE "fingerprint" IS NOT NULL AND "id" IN ({}) ORDER BY rowid'.format(select, table, ", ".join("?" * len(batch)))
+            for row in pd.read_sql_query(query, con, params = batch).to_dict("records"):
+                saved[_result_key(row["id"], row["Certification"], row["Mandate Number"], row["model"])] = row
+        return saved
+
+def reevaluation_plan(jobs: list, file_path: str) -> pd.DataFrame:
+    # One row per job (in job order) with its status against the results 
+    # saved in file_path: "new" (nothing saved), "changed" (its inputs differ
+    # from the saved result's), "failed" (the saved response is a provider 
+    # error) or "unchanged". Unchanged rows carry the saved result, which 
+    # evaluate_stale_jobs reuses.
+    saved = load_saved_results(file_path, [job["product"]["id"].item() for job in jobs])
+    rows = []
+    for job in jobs:
+        product = job["product"].iloc[0]
+        number = job["mandate_df"]["Mandate Number"].item()
+        row = saved.get(_result_key(product["id"], job["cert"], number, job["model"]))
+        if row is None:
+            status = "new"
+        elif row["fingerprint"] != job["fingerprint"]:
+            status = "changed"
+        elif str(row["response"]).startswith(ERROR_RESPONSES):
+            status = "failed"
+        else:
+            status = "unchanged"
+        rows.append([product["id"], product["name"], job["cert"], number, job["model"], status, row if status == "unchanged" else None])
+    return pd.DataFrame(rows, columns = REEVALUATION_PLAN_COLUMNS + ["saved"])
+
+def saved_result(row: dict):
+    # (prompt, response, recommendation, verdict) of a saved result
+    cited = row.get("cited_attributes")
+    confidence = row.get("confidence")
+    verdict = {"recommendation": str(row["recommendation"]), 
+               "confidence": None if confidence is None or pd.isna(confidence) else float(confidence), 
+               "reasoning": "" if row.get("reasoning") is None else str(row["reasoning"]), 
+               "cited_attributes": [attr for attr in str(cited).split(", ") if attr] if isinstance(cited, str) else []}
+    return row["prompt"], row["response"], str(row["recommendation"]), verdict
 
+def evaluate_stale_jobs(jobs: list, plan: pd.DataFrame, api_keys: dict, **kwargs):
+    # Like evaluate_mandate_jobs, but jobs left unchanged in plan (see 
+    # reevaluation_plan) yield their saved result instead of being evaluated.
+    stale = []
+    for i, (status, row) in enumerate(zip(plan["status"], plan["saved"])):
+        if status == "unchanged":
+            yield i, saved_result(row)
+        else:
+            stale.append(i)
 
-        return prompt, output['choices'][0]['message']['content']
+    for j, result in evaluate_mandate_jobs([jobs[i] for i in stale], api_keys, **kwargs):
+        yield stale[j], result
+
+def get_dataset_file(master_file_list_path: str, dataset_name: str) -> str:
+    # File of the dataset's newest entry in the master file list
+    return ddf.dataset_entry(master_file_list_path, dataset_name)["file_name"]
+
+def catalog_checkpoint_path(dataset_name: str) -> str:
+    return "./Product Certification/" + dataset_name + "/catalog_checkpoint.json"
+
+def load_catalog_checkpoint(checkpoint_path: str, certs: list, models: list) -> set:
+    # Ids of products already certified for this selection of certs and models.
+    # A checkpoint written for a different selection does not apply.
+    if not os.path.exists(checkpoint_path):
+        return set()
+    with open(checkpoint_path) as f:
+        checkpoint = json.load(f)
+    if checkpoint["certs"] != sorted(certs) or checkpoint["models"] != sorted(models):
+        return set()
+    return set(checkpoint["completed"])
+
+def save_catalog_checkpoint(checkpoint_path: str, certs: list, models: list, completed: set):
+    # Write to a temporary file first so an interrupted save never leaves a 
+    # truncated checkpoint behind.
+    with dsf.replacing(checkpoint_path) as temp_path:
+        with open(temp_path, "w") as f:
+            json.dump({"certs": sorted(certs), "models": sorted(models), "completed": sorted(completed)}, f)
+
+def certify_catalog(dataset_name: str, certs: list, models: list, api_keys: dict, master_file_list_path: str = "./file_list.csv", 
+                    chunk_size: int = CATALOG_CHUNK_SIZE, restart: bool = False, progress_callback = None, reasoning: bool = True, 
+                    group_mandates: bool = False, incremental: bool = False, budget: float = None, product_budget: float = None, 
+                    cascade: bool = False):
+    # Evaluate every product of a dataset against all mandates of the selected
+    # certifications. Products are streamed from the dataset in chunks; after 
+    # each chunk the results are appended to the product_mandate_recommendation
+    # and product_recommendation_summary results and the checkpoint is updated, so
+    # an interrupted run resumes with the first unfinished chunk.
+    # progress_callback(products_done, products_total) is called after each chunk.
+    # Without reasoning, LLM responses stop at the verdict. With 
+    # group_mandates, each product's mandates are sent in as few requests 
+    # as fit the prompt budget. An incremental run goes over every product 
+    # again but only evaluates and saves the results that are stale (see 
+    # reevaluation_plan); the summaries still cover all mandates.
+    # budget caps the run's spending and product_budget each product's, in
+    # USD (see Budget); requests are sent cheapest first. Once the run's
+    # budget refuses a request, the chunk's results are saved and the run
+    # stops; products left incomplete are evaluated when it is resumed.
+    # With cascade, the models are asked in turn (see evaluate_cascade) and
+    # results are saved under CASCADE_MODEL; a cascade run is never 
+    # incremental, repeated questions being answered from the response cache.
+    incremental = incremental and not cascade
+    tiers = cascade_tiers(models) if cascade else None
+    result_models = [CASCADE_MODEL] if cascade else models
+    products_path = dsf.ensure_columnar(get_dataset_file(master_file_list_path, dataset_name))
+    rec_path = "./Product Certification/" + dataset_name + "/product_mandate_recommendation.csv"
+    summary_path = "./Product Certification/" + dataset_name + "/product_recommendation_summary.csv"
+    checkpoint_path = catalog_checkpoint_path(dataset_name)
+
+    mandates_df = load_mandates()
+    mandate_column_full_df, mandate_index = load_mandate_relevance(ensure_mandate_relevance(dataset_name))
+    rules = rf.load_mandate_rules()
+
+    completed = set() if restart or incremental else load_catalog_checkpoint(checkpoint_path, certs, models + [CASCADE_MODEL] * cascade)
+    products_total = dsf.open_dataset(products_path, ["id"]).num_rows
+    product_columns = dsf.mandate_columns(mandate_column_full_df, dsf.dataset_columns(products_path), rf.rule_columns(rules))
+    run_budget = None if budget is None else Budget(budget)
+
+    for chunk in dsf.iter_product_chunks(products_path, chunk_size, product_columns):
+        chunk = chunk[~chunk["id"].astype(str).isin(completed)]
+        if chunk.empty:
+            continue
+
+        with trf.span("catalog_chunk", products = chunk.shape[0]):
+            jobs = build_mandate_jobs(chunk, mandates_df, mandate_index, certs, tiers[:1] if cascade else models, rules, 
+                                      reasoning, group_mandates)
+            assign_budgets(jobs, run_budget, product_budget)
+            if cascade:
+                evaluation = evaluate_cascade(jobs, api_keys, tiers, reasoning = reasoning, group_mandates = group_mandates)
+            elif incremental:
+                plan = reevaluation_plan(jobs, rec_path)
+                evaluation = evaluate_stale_jobs(jobs, plan, api_keys, reasoning = reasoning, group_mandates = group_mandates)
+            else:
+                evaluation = evaluate_mandate_jobs(jobs, api_keys, reasoning = reasoning, group_mandates = group_mandates)
+
+            # Time until the last mandate of each (product, cert, model) completed
+            start_time = time.time()
+            elapsed_times = {}
+            results = [None] * len(jobs)
+            for i, result in evaluation:
+                results[i] = result
+                elapsed_times[(jobs[i]["product"]["id"].item(), jobs[i]["cert"], result_model(jobs[i], cascade))] = time.time() - start_time
+
+            chunk_rec = pd.DataFrame([], columns = RECOMMENDATION_COLUMNS)
+            for job, (prompt, llm_response_full, llm_response, verdict) in zip(jobs, results):
+                if llm_response_full != BUDGET_SKIPPED_RESPONSE:
+                    log_response(chunk_rec, job["product"], job["mandate_df"], prompt, llm_response_full, llm_response, result_model(job, cascade), 
+                                 verdict, job["fingerprint"], job_tier(job))
+
+            usage = tally_usage(jobs, results, lambda job: (job["product"]["id"].item(), job["cert"], result_model(job, cascade)))
+            summary = []
+            for i in range(chunk.shape[0]):
+                product = chunk.iloc[[i]]
+                product_rec = chunk_rec[chunk_rec["id"] == product["id"].item()]
+                for cert in certs:
+                    for LLM in result_models:
+                        passed, failed, na, rec_per = count_recommendations(product_rec, cert, LLM)
+                        cost, skipped = usage.get((product["id"].item(), cert, LLM), (0.0, 0))
+                        summary.append([product["name"].item(), LLM, cert, passed, failed, na, rec_per, 
+                                        round(elapsed_times.get((product["id"].item(), cert, LLM), 0)), round(cost, 6), skipped])
+
+            if incremental:
+                stale = [status != "unchanged" for status, result in zip(plan["status"], results) if not is_skipped(result)]
+                save_recommendation(rec_path, chunk_rec[stale])
+            else:
+                save_recommendation(rec_path, chunk_rec)
+            save_recommendation(summary_path, pd.DataFrame(summary, columns = SUMMARY_COLUMNS))
+
+            budget_reached = run_budget is not None and run_budget.refused > 0
+            if budget_reached:
+                incomplete = set(str(job["product"]["id"].item()) for job, result in zip(jobs, results) if is_skipped(result))
+                completed.update(set(chunk["id"].astype(str)) - incomplete)
+            else:
+                completed.update(chunk["id"].astype(str))
+            save_catalog_checkpoint(checkpoint_path, certs, models + [CASCADE_MODEL] * cascade, completed)
+
+        if progress_callback is not None:
+            progress_callback(len(completed), products_total)
+        if budget_reached:
+            break
+
+    return len(completed), products_total
+
+def recommend_product(dataset_name: str, product_row: int, certs: list, models: list, api_keys: dict, 
+                      master_file_list_path: str = "./file_list.csv", reasoning: bool = True, group_mandates: bool = False, 
+                      incremental: bool = False, progress_callback = None, budget: float = None, cascade: bool = False):
+    # Evaluate one product (by row number in the dataset) against all mandates
+    # of certs with every model. Returns the results in job order, as logged
+    # by log_response, and one summary row per (cert, model) with its cost;
+    # the summaries are saved, the results only when the user exports them.
+    # With a budget (USD), requests are sent cheapest first and those that
+    # would go over it are skipped (see evaluate_mandate_jobs); skipped
+    # mandates are left out of the results.
+    # progress_callback(jobs done, jobs total, {job index: text so far}) is 
+    # called as jobs complete and while responses stream in. Each stage is
+    # a span of the active trace, if any (see trace_functions). With 
+    # cascade, the models are asked in turn (see evaluate_cascade) and 
+    # results are logged and summarized under CASCADE_MODEL; incremental 
+    # is then ignored, repeated questions being answered from the response
+    # cache.
+    incremental = incremental and not cascade
+    tiers = cascade_tiers(models) if cascade else None
+    result_models = [CASCADE_MODEL] if cascade else models
+    rec_path = "./Product Certification/" + dataset_name + "/product_mandate_recommendation.csv"
+    summary_path = "./Product Certification/" + dataset_name + "/product_recommendation_summary.csv"
+
+    with trf.span("load_inputs", dataset = dataset_name, product_row = product_row):
+        products_path = dsf.ensure_columnar(get_dataset_file(master_file_list_path, dataset_name))
+        mandates_df = load_mandates()
+        mandate_column_full_df, mandate_index = load_mandate_relevance(ensure_mandate_relevance(dataset_name))
+        rules = rf.load_mandate_rules()
+        product_df = dsf.load_products(products_path, [product_row], 
+                                       dsf.mandate_columns(mandate_column_full_df, dsf.dataset_columns(products_path), rf.rule_columns(rules)))
+
+    with trf.span("build_jobs") as attributes:
+        jobs = build_mandate_jobs(product_df, mandates_df, mandate_index, certs, tiers[:1] if cascade else models, rules, 
+                                  reasoning, group_mandates)
+        attributes.update(jobs = len(jobs), rule_jobs = sum(job.get("rule") is not None for job in jobs))
+    assign_budgets(jobs, None if budget is None else Budget(budget))
+    on_stream = None
+    if progress_callback is not None:
+        on_stream = lambda streams: progress_callback(sum(result is not None for result in results), len(jobs), streams)
+    if cascade:
+        evaluation = evaluate_cascade(jobs, api_keys, tiers, reasoning = reasoning, on_stream = on_stream, group_mandates = group_mandates)
+    elif incremental:
+        evaluation = evaluate_stale_jobs(jobs, reevaluation_plan(jobs, rec_path), api_keys, reasoning = reasoning, 
+                                         on_stream = on_stream, group_mandates = group_mandates)
+    else:
+        evaluation = evaluate_mandate_jobs(jobs, api_keys, reasoning = reasoning, on_stream = on_stream, group_mandates = group_mandates)
+
+    # Time until the last mandate of each (cert, model) completed
+    start_time = time.time()
+    elapsed_times = {}
+    results = [None] * len(jobs)
+    with trf.span("evaluate", jobs = len(jobs), group_mandates = group_mandates, incremental = incremental, cascade = cascade):
+        for i, result in evaluation:
+            results[i] = result
+            elapsed_times[(jobs[i]["cert"], result_model(jobs[i], cascade))] = time.time() - start_time
+            if progress_callback is not None:
+                progress_callback(sum(result is not None for result in results), len(jobs), {})
+
+    # Log in job order so the output does not depend on completion order
+    rec = pd.DataFrame([], columns = RECOMMENDATION_COLUMNS)
+    with trf.span("log_results", rows = len(jobs)):
+        for job, (prompt, llm_response_full, llm_response, verdict) in zip(jobs, results):
+            if llm_response_full != BUDGET_SKIPPED_RESPONSE:
+                log_response(rec, job["product"], job["mandate_df"], prompt, llm_response_full, llm_response, result_model(job, cascade), 
+                             verdict, job["fingerprint"], job_tier(job))
+
+    usage = tally_usage(jobs, results, lambda job: (job["cert"], result_model(job, cascade)))
+    summary = []
+    for cert in certs:
+        for LLM in result_models:
+            passed, failed, na, rec_per = count_recommendations(rec, cert, LLM)
+            cost, skipped = usage.get((cert, LLM), (0.0, 0))
+            summary.append([product_df["name"].item(), LLM, cert, passed, failed, na, rec_per, round(elapsed_times.get((cert, LLM), 0)), 
+                            round(cost, 6), skipped])
+    summary = pd.DataFrame(summary, columns = SUMMARY_COLUMNS)
+    save_recommendation(summary_path, summary)
+    return rec, summary
+
+def catalog_reevaluation_report(dataset_name: str, certs: list, models: list, master_file_list_path: str = "./file_list.csv", 
+                                chunk_size: int = CATALOG_CHUNK_SIZE, reasoning: bool = True, group_mandates: bool = False) -> pd.DataFrame:
+    # Dry run of an incremental certify_catalog with the same prompt mode:
+    # the number of results per Certification, model and status that it 
+    # would reuse or evaluate. Nothing is queried or saved.
+    products_path = dsf.ensure_columnar(get_dataset_file(master_file_list_path, dataset_name))
+    rec_path = "./Product Certification/" + dataset_name + "/product_mandate_recommendation.csv"
+
+    mandates_df = load_mandates()
+    mandate_column_full_df, mandate_index = load_mandate_relevance(ensure_mandate_relevance(dataset_name))
+    rules = rf.load_mandate_rules()
+    product_columns = dsf.mandate_columns(mandate_column_full_df, dsf.dataset_columns(products_path), rf.rule_columns(rules))
+
+    counts = []
+    for chunk in dsf.iter_product_chunks(products_path, chunk_size, product_columns):
+        plan = reevaluation_plan(build_mandate_jobs(chunk, mandates_df, mandate_index, certs, models, rules, reasoning, group_mandates), rec_path)
+        counts.append(plan.groupby(["Certification", "model", "status"]).size())
+
+    if counts == []:
+        return pd.DataFrame([], columns = ["Certification", "model", "status", "results"])
+    return pd.concat(counts).groupby(level = [0, 1, 2]).sum().rename("results").reset_index()
 
 @st.cache_data  
 def query_LLM_TESTER(mandate_df: pd.DataFrame, product: pd.DataFrame, LLM: str, LLM_token: str):
@@ -170,16 +1214,19 @@ def query_LLM_TESTER(mandate_df: pd.DataFrame, product: pd.DataFrame, LLM: str,
     return (np.random.rand(1) > .3)[0]
 
 
-def output_responses(output_df: pd.DataFrame, cert: str, LLM: str):
-    df = output_df[output_df["Certification"] == cert][output_df["model"] == LLM]
+def count_recommendations(output_df: pd.DataFrame, cert: str, LLM: str):
+    df = output_df[(output_df["Certification"] == cert) & (output_df["model"] == LLM)]
     mandates_passed = df[df["recommendation"] == "True"].shape[0]
     mandates_failed = df[df["recommendation"] == "False"].shape[0]
     mandates_na = df[df["recommendation"] == "N/A"].shape[0]
-    mandates_total = len(df["recommendation"])
     try:
         percent_passsed = round(mandates_passed / (mandates_passed + mandates_failed) * 100)
     except:
         percent_passsed = 100
+    return mandates_passed, mandates_failed, mandates_na, percent_passsed
+
+def output_responses(output_df: pd.DataFrame, cert: str, LLM: str):
+    mandates_passed, mandates_failed, mandates_na, percent_passsed = count_recommendations(output_df, cert, LLM)
     st.markdown("{} assessement:".format(LLM))
 
     t1 = [cert, "Passed", mandates_passed, 1, "green"]
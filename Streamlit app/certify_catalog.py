@@ -0,0 +1,61 @@
+# Headless catalog certification. Run from the "Streamlit app" folder:
+#
+#     python certify_catalog.py Notebooks --certs TCO "Energy Star" --models Cohere GPT-3.5
+#
+# API keys are read from COHERE_API_KEY, REPLICATE_API_TOKEN and OPENAI_API_KEY.
+# Progress is checkpointed per chunk; rerunning the same command resumes.
+# With --incremental only results whose inputs changed are evaluated again;
+# add --dry-run to only report how many that would be. With --trace the run
+# is traced and the time per stage printed at the end (see trace_functions).
+# --budget caps the run's spending in USD at list prices and stops the run
+# when it is reached; rerunning resumes. --product-budget caps each product.
+# --cascade asks the models in turn, cheapest first, and sends a mandate on
+# to the next model only when its verdict is uncertain.
+import argparse
+import os
+
+import cert_eval_functions as cef
+import trace_functions as trf
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Certify every product in a dataset against the certification mandates.")
+    parser.add_argument("dataset", help = "dataset folder name under ./Datasets")
+    parser.add_argument("--certs", nargs = "+", default = ["TCO", "Energy Star"], choices = ["TCO", "Energy Star"])
+    parser.add_argument("--models", nargs = "+", default = ["Cohere"], choices = ["Cohere", "LLaMA2", "GPT-3.5"])
+    parser.add_argument("--chunk-size", type = int, default = cef.CATALOG_CHUNK_SIZE, help = "products evaluated per checkpoint")
+    parser.add_argument("--restart", action = "store_true", help = "ignore the saved checkpoint and start from the first product")
+    parser.add_argument("--incremental", action = "store_true", help = "go over every product, reusing saved results whose inputs are unchanged")
+    parser.add_argument("--dry-run", action = "store_true", help = "report what an incremental run would evaluate, without running it")
+    parser.add_argument("--cascade", action = "store_true", help = "ask the next model only when a verdict is uncertain")
+    parser.add_argument("--budget", type = float, default = None, help = "stop once the run has spent this many USD")
+    parser.add_argument("--product-budget", type = float, default = None, help = "spend at most this many USD per product")
+    parser.add_argument("--trace", default = None, help = "save a trace of the run to this JSON lines file")
+    args = parser.parse_args()
+
+    api_keys = {"Cohere": os.environ.get("COHERE_API_KEY", ""), 
+                "LLaMA2": os.environ.get("REPLICATE_API_TOKEN", ""), 
+                "GPT-3.5": os.environ.get("OPENAI_API_KEY", "")}
+
+    if args.dry_run:
+        print(cef.catalog_reevaluation_report(args.dataset, args.certs, args.models, chunk_size = args.chunk_size).to_string(index = False))
+        raise SystemExit
+
+    def report(products_done, products_total):
+        print("{} out of {} products certified.".format(products_done, products_total), flush = True)
+
+    if args.trace is None:
+        cef.certify_catalog(args.dataset, args.certs, args.models, api_keys, chunk_size = args.chunk_size, 
+                            restart = args.restart, progress_callback = report, incremental = args.incremental, 
+                            budget = args.budget, product_budget = args.product_budget, cascade = args.cascade)
+        raise SystemExit
+
+    trace = None
+    try:
+        with trf.start_trace("certify_catalog", dataset = args.dataset) as trace:
+            cef.certify_catalog(args.dataset, args.certs, args.models, api_keys, chunk_size = args.chunk_size, 
+                                restart = args.restart, progress_callback = report, incremental = args.incremental, 
+                                budget = args.budget, product_budget = args.product_budget, cascade = args.cascade)
+    finally:
+        if trace is not None:
+            trf.write_trace(trace, args.trace)
+            print(trf.stage_summary(trf.read_trace(args.trace)).round(3).to_string(index = False))
@@ -4,38 +4,56 @@ import re
 import time
 import os
 
-import cohere
 from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+import threading
 
-import tiktoken
-
-import replicate
 import json
+import pyarrow as pa
 import streamlit as st
 
-def num_tokens_from_string(string: str, encoding_name: str) -> int:
-    """Returns the number of tokens in a text string."""
-    encoding = tiktoken.get_encoding(encoding_name)
-    num_tokens = len(encoding.encode(string))
-    return num_tokens  
-
-def add_file_to_master(master_file_list_path: str, new_dataset_name: str, file_path: str, new_dataset_description: str):
-    file_list = pd.read_csv(master_file_list_path)
-    file_list = pd.concat([pd.DataFrame([[new_dataset_name, 
-                                          file_path, 
-                                          new_dataset_description, 
-                                          datetime.now()]], 
-                                          columns = file_list.columns), file_list])
-    file_list.to_csv(master_file_list_path, index = False)
-
+import llm_functions as llm
+import dataset_functions as dsf
+from llm_functions import num_tokens_from_string
 
-def create_column_summary(in_path: str, file_type: str, out_dir: str, dataset_name: str):
-    if file_type == ".csv":
-        data = pd.read_csv(in_path)
-    elif file_type == ".feather":
-        data = pd.read_feather(in_path)
+# Batched definition generation: columns are packed into one prompt until
+# the prompt plus the expected answers reach DEFINITION_BATCH_TOKENS.
+DEFINITION_MODELS = ["Cohere", "LLaMA2"]
+DEFINITION_BATCH_TOKENS = 3500
+DEFINITION_TOKENS_PER_COLUMN = 120
+DEFINITION_BATCH_MAX_COLUMNS = 25
+DEFINITION_CONCURRENCY = {"Cohere": 2, "LLaMA2": 4}
 
-    columns = data.columns
+def add_file_to_master(master_file_list_path: str, new_dataset_name: str, file_path: str, new_dataset_description: str):
+    # Append a single row, stamped with its upload time, instead of 
+    # rewriting the whole list (see dataset_entry).
+    needs_newline = False
+    with open(master_file_list_path, "rb") as f:
+        if f.seek(0, os.SEEK_END) > 0:
+            f.seek(-1, os.SEEK_END)
+            needs_newline = f.read(1) != b"\n"
+
+    with open(master_file_list_path, "a", newline = "") as f:
+        if needs_newline:
+            f.write("\n")
+        pd.DataFrame([[new_dataset_name, file_path, new_dataset_description, datetime.now()]]).to_csv(f, header = False, index = False)
+
+def dataset_entry(master_file_list_path: str, dataset_name: str) -> pd.Series:
+    # The newest row of the master file list for a dataset. Rows appended by
+    # add_file_to_master carry their full upload time and are newer than 
+    # the rows written before, which were kept newest first and whose 
+    # upload_time is not a full timestamp.
+    file_list = dsf.read_csv(master_file_list_path)
+    entries = file_list[file_list["file_folder"] == dataset_name]
+    uploaded = pd.to_datetime(entries["upload_time"].astype(str), format = "ISO8601", errors = "coerce")
+    if uploaded.notna().any():
+        return entries.loc[uploaded.idxmax()]
+    return entries.iloc[0]
+
+def clean_column_names(columns: list):
+    # Readable names for the raw dataset columns ("Weight.94" -> "Weight",
+    # "Weight.94.unit" -> "Weight_unit"), and the [raw, cleaned] pairs of the
+    # attribute columns that need a definition (ids and unit columns do not).
     columns_cleaned = []
     columns_to_query = []
     for c in columns:
@@ -48,68 +66,186 @@ def create_column_summary(in_path: str, file_type: str, out_dir: str, dataset_na
                 columns_to_query.append([c, c_cleaned])
         else:
             columns_cleaned.append(c)
-
-    columns_df = pd.DataFrame(columns_to_query, columns = ["", "column_cleaned"]).set_index("")
-
-    data_dictionary_df = pd.DataFrame([dataset_name] * len(columns), columns = ["Product Category"])
-    data_dictionary_df.insert(1, "Column Name Raw", columns)
-    data_dictionary_df.insert(2, "Column Name", columns_cleaned)
-    data_dictionary_df.insert(3, "Column Top Values", [""]*len(columns))
-    data_dictionary_df.insert(4, "Column Unit", [""]*len(columns))
-    data_dictionary_df.insert(5, "Column Min", [""]*len(columns))
-    data_dictionary_df.insert(6, "Column Max", [""]*len(columns))
-    data_dictionary_df.insert(7, "Column Definition", [""]*len(columns))
-    data_dictionary_df.insert(8, "Approved", [False]*len(columns))
-
-    data_dictionary_df["Column Definition"][data_dictionary_df["Column Name"].str.contains("unit")] = "The unit of measure for the " + data_dictionary_df["Column Name"][data_dictionary_df["Column Name"].str.contains("unit")].str.replace("_unit", "") + " column."
-    data_dictionary_df["Approved"][data_dictionary_df["Column Name"].str.contains("unit")] = True
-
-    col_units = []
-    col_values = []
-    col_mins = []
-    col_maxs = []
-    for c in columns_df.index.values:
-        try:
-            col_unit = data[c + ".unit"].value_counts().nlargest(1).index[0]
-        except:
-            col_unit = "N/A"
-
-        col_vals = str([str(val) for val in data[c].value_counts().nlargest(5).index.values]).replace("]", "").replace("[", "")
-
-        if data[c].dtype == float or data[c].dtype == int:
-            col_min = str(pd.DataFrame.min(data[c]))
-            col_max = str(pd.DataFrame.max(data[c]))
-        else:
-            col_min = "N/A"
-            col_max = "N/A"
-
-        col_units.append(col_unit)
-        col_values.append(col_vals)
-        col_mins.append(col_min)
-        col_maxs.append(col_max)
-
-        data_dictionary_df["Column Unit"][data_dictionary_df["Column Name Raw"] == c] = col_unit
-        data_dictionary_df["Column Top Values"][data_dictionary_df["Column Name Raw"] == c] = col_vals
-        data_dictionary_df["Column Min"][data_dictionary_df["Column Name Raw"] == c] = col_min
-        data_dictionary_df["Column Max"][data_dictionary_df["Column Name Raw"] == c] = col_max
-
-
-    columns_df.insert(1, "column_values", col_values, True)
-    columns_df.insert(2, "column_unit", col_units, True)
-    columns_df.insert(3, "column_min", col_mins, True)
-    columns_df.insert(4, "column_max", col_maxs, True)
+    return columns_cleaned, columns_to_query
+
+def column_value_counts(data: pd.DataFrame, columns: list) -> pd.Series:
+    # Non-null value counts of many columns in one groupby, indexed by 
+    # (column, value as text) and sorted by count within each column. Ties 
+    # keep the order of first appearance, as value_counts does. Values are
+    # compared as text because grouping mixed objects would merge e.g. 0.0 
+    # and False from different columns.
+    values = data[columns].to_numpy(dtype = object).ravel(order = "F")
+    codes = np.repeat(np.arange(len(columns)), data.shape[0])
+    present = ~pd.isna(values)
+    long = pd.DataFrame({"column": codes[present], "value": values[present].astype(str)})
+
+    counts = long.groupby(["column", "value"], sort = False).size().sort_values(ascending = False, kind = "stable")
+    counts.index = pd.MultiIndex.from_arrays([np.asarray(columns, dtype = object)[counts.index.get_level_values(0)], 
+                                              counts.index.get_level_values(1)])
+    return counts
+
+def format_top_values(counts: pd.Series, top_k: int) -> pd.Series:
+    # "'8.0', '6.0', '12.0'" style string of the top_k values of each column
+    top = counts.groupby(level = 0, sort = False).head(top_k)
+    values = pd.Series(top.index.get_level_values(1), index = top.index.get_level_values(0))
+    return values.groupby(level = 0, sort = False).agg(lambda vals: str(list(vals)).replace("]", "").replace("[", ""))
+
+def merge_top_counts(summary: pd.Series, counts: pd.Series, capacity: int) -> pd.Series:
+    # Mergeable top-k summary: add the new (column, value) counts to the 
+    # running ones and keep only the capacity heaviest values per column.
+    # Counts of values that were dropped at some point are lower bounds.
+    if summary is not None:
+        counts = pd.concat([summary, counts]).groupby(level = [0, 1], sort = False).sum()
+    counts = counts.sort_values(ascending = False, kind = "stable")
+    return counts.groupby(level = 0, sort = False).head(capacity)
+
+def new_profile_stats() -> dict:
+    return {"rows": 0, "nulls": pd.Series(dtype = float), "min": pd.Series(dtype = float), "max": pd.Series(dtype = float),
+            "values": None, "units": None}
+
+def update_profile_stats(stats: dict, data: pd.DataFrame, columns: list, capacity: int):
+    # Fold one chunk of rows into the running column statistics.
+    stats["rows"] += data.shape[0]
+    stats["nulls"] = stats["nulls"].add(data[columns].isna().sum(), fill_value = 0)
+
+    numeric = data[columns].select_dtypes(include = "number")
+    stats["min"] = pd.concat([stats["min"], numeric.min()], axis = 1).min(axis = 1)
+    stats["max"] = pd.concat([stats["max"], numeric.max()], axis = 1).max(axis = 1)
+
+    unit_columns = [c + ".unit" for c in columns if c + ".unit" in data.columns]
+    stats["values"] = merge_top_counts(stats["values"], column_value_counts(data, columns), capacity)
+    stats["units"] = merge_top_counts(stats["units"], column_value_counts(data, unit_columns), capacity)
+
+def finish_profile(stats: dict, columns: list, top_k: int) -> pd.DataFrame:
+    profile = pd.DataFrame(index = pd.Index(columns))
+
+    profile["column_values"] = format_top_values(stats["values"], top_k).reindex(columns).fillna("")
+
+    units = stats["units"].groupby(level = 0, sort = False).head(1)
+    units = pd.Series(units.index.get_level_values(1), index = [c[:-len(".unit")] for c in units.index.get_level_values(0)])
+    profile["column_unit"] = units.reindex(columns).fillna("N/A")
+
+    profile["column_min"] = stats["min"].astype(str).reindex(columns).fillna("N/A")
+    profile["column_max"] = stats["max"].astype(str).reindex(columns).fillna("N/A")
+
+    profile["column_null_rate"] = (stats["nulls"] / max(stats["rows"], 1)).reindex(columns)
+    return profile
+
+def _profile_chunk(data: pd.DataFrame, columns: list, top_k: int) -> pd.DataFrame:
+    # A single chunk of rows has exact counts, so top_k candidates suffice
+    stats = new_profile_stats()
+    update_profile_stats(stats, data, columns, top_k)
+    return finish_profile(stats, columns, top_k)
+
+def profile_columns(data: pd.DataFrame, columns: list, top_k: int = 5, n_jobs: int = 1, chunk_columns: int = 250) -> pd.DataFrame:
+    # Top values, dominant unit (from the .unit twin), min/max of numeric 
+    # columns and null rate for every column in columns, indexed by column.
+    # Columns are profiled in vectorized chunks of chunk_columns, optionally
+    # spread over n_jobs processes.
+    columns = list(columns)
+    chunks = [columns[i:i + chunk_columns] for i in range(0, len(columns), chunk_columns)]
+    chunk_frames = [data[chunk + [c + ".unit" for c in chunk if c + ".unit" in data.columns]] for chunk in chunks]
+
+    if n_jobs > 1 and len(chunks) > 1:
+        with ProcessPoolExecutor(max_workers = n_jobs) as executor:
+            profiles = list(executor.map(_profile_chunk, chunk_frames, chunks, [top_k] * len(chunks)))
+    else:
+        profiles = [_profile_chunk(chunk_frame, chunk, top_k) for chunk_frame, chunk in zip(chunk_frames, chunks)]
+
+    if not profiles:
+        return pd.DataFrame(columns = ["column_values", "column_unit", "column_min", "column_max", "column_null_rate"])
+    return pd.concat(profiles)
+
+def write_column_summary(columns: list, profile: pd.DataFrame, out_dir: str, dataset_name: str):
+    # Build columns_summary.csv and the data dictionary from a column profile
+    # in bulk and write them to out_dir/dataset_name.
+    columns_cleaned, columns_to_query = clean_column_names(columns)
+
+    columns_df = pd.DataFrame([cleaned for _, cleaned in columns_to_query], index = [c for c, _ in columns_to_query], columns = ["column_cleaned"])
+    columns_df = columns_df.join(profile[["column_values", "column_unit", "column_min", "column_max", "column_null_rate"]])
+
+    data_dictionary_df = pd.DataFrame({"Product Category": [dataset_name] * len(columns), 
+                                       "Column Name Raw": columns, 
+                                       "Column Name": columns_cleaned})
+    raw_names = data_dictionary_df["Column Name Raw"]
+    data_dictionary_df["Column Top Values"] = raw_names.map(profile["column_values"]).fillna("")
+    data_dictionary_df["Column Unit"] = raw_names.map(profile["column_unit"]).fillna("")
+    data_dictionary_df["Column Min"] = raw_names.map(profile["column_min"]).fillna("")
+    data_dictionary_df["Column Max"] = raw_names.map(profile["column_max"]).fillna("")
+    data_dictionary_df["Column Definition"] = ""
+    data_dictionary_df["Approved"] = False
+
+    unit_rows = data_dictionary_df["Column Name"].str.contains("unit")
+    data_dictionary_df.loc[unit_rows, "Column Definition"] = "The unit of measure for the " + data_dictionary_df.loc[unit_rows, "Column Name"].str.replace("_unit", "") + " column."
+    data_dictionary_df.loc[unit_rows, "Approved"] = True
 
     if not os.path.exists(out_dir + "/" + dataset_name):
         os.makedirs(out_dir + "/" + dataset_name)
         columns_df.to_csv(out_dir + "/" + dataset_name + "/columns_summary.csv", index = False)
-        data_dictionary_df.to_csv(out_dir + "/" + dataset_name + "/" + dataset_name + "_Data_Dictionary.csv", index = False)
+        data_dictionary_df.to_csv(data_dictionary_path(out_dir, dataset_name), index = False)
     else:
         columns_df.to_csv(out_dir + "/" + dataset_name + "/columns_summary.csv", index = False)
-        data_dictionary_df.to_csv(out_dir + "/" + dataset_name + "/" + dataset_name + "_Data_Dictionary.csv", index = False)
+        data_dictionary_df.to_csv(data_dictionary_path(out_dir, dataset_name), index = False)
 
+def create_column_summary(in_path: str, file_type: str, out_dir: str, dataset_name: str, n_jobs: int = 1):
+    if file_type == ".csv":
+        data = pd.read_csv(in_path)
+    elif file_type == ".feather":
+        data = pd.read_feather(in_path)
 
-@st.cache_data  
-def query_LLM(column_summary: pd.DataFrame, column_name: str, dataset_description: str, LLM: str, LLM_token: str):
+    _, columns_to_query = clean_column_names(data.columns)
+    profile = profile_columns(data, [c for c, _ in columns_to_query], n_jobs = n_jobs)
+    write_column_summary(list(data.columns), profile, out_dir, dataset_name)
+
+
+def ingest_dataset(uploaded_file, file_type: str, file_path: str, chunk_size: int = 10000, top_k: int = 5, 
+                   sketch_size: int = 64, progress_callback = None):
+    # Stream an uploaded csv/feather file into the columnar dataset at 
+    # file_path chunk by chunk, profiling the columns on the way, so peak 
+    # memory depends on chunk_size, not file size. The file is read twice:
+    # first to find each column's type over all chunks (a column mixing 
+    # numbers and text is stored as text), then to convert it, so no value
+    # is lost. Top values and units are tracked with a top-k summary of 
+    # sketch_size candidates per column. progress_callback(fraction, text)
+    # is called after every chunk. Returns the dataset columns, their 
+    # profile, ready for write_column_summary, and warnings to show the user.
+    size = uploaded_file.seek(0, os.SEEK_END)
+
+    def progress(start, text):
+        if progress_callback is not None:
+            progress_callback(start + min(uploaded_file.tell() / max(size, 1), 1.0) / 2, text)
+
+    uploaded_file.seek(0)
+    kinds = {}
+    mixed = set()
+    for chunk in dsf.iter_upload_chunks(uploaded_file, file_type, chunk_size, dsf.PRODUCT_BASE_COLUMNS):
+        chunk_kinds = dsf.chunk_column_kinds(chunk)
+        mixed.update(c for c, kind in chunk_kinds.items() if kinds.get(c) not in [None, kind] and kind is not None and c not in dsf.PRODUCT_BASE_COLUMNS)
+        kinds = dsf.merge_column_kinds(kinds, chunk_kinds)
+        progress(0.0, "Checking column types...")
+    if not kinds:
+        raise ValueError("The uploaded file contains no rows.")
+
+    warnings = ["Column {!r} mixes numbers and text, so it was stored as text.".format(c) for c in kinds if c in mixed]
+    schema = dsf.column_kinds_schema(kinds)
+    columns = list(kinds)
+    _, columns_to_query = clean_column_names(columns)
+    profiled = [c for c, _ in columns_to_query]
+    stats = new_profile_stats()
+
+    def profiled_chunks():
+        uploaded_file.seek(0)
+        text_columns = [field.name for field in schema if field.type == pa.string()]
+        for chunk in dsf.iter_upload_chunks(uploaded_file, file_type, chunk_size, text_columns):
+            chunk = dsf.conform_chunk(chunk, schema)
+            update_profile_stats(stats, chunk, profiled, sketch_size)
+            progress(0.5, "{:,} rows processed...".format(stats["rows"]))
+            yield chunk
+
+    dsf.write_columnar_chunks(profiled_chunks(), schema, file_path)
+    return columns, finish_profile(stats, profiled, top_k), warnings
+
+def query_LLM(column_summary: pd.DataFrame, column_name: str, dataset_description: str, LLM: str, LLM_token: str, use_cache: bool = True):
 
     if column_name not in column_summary["column_cleaned"].to_numpy():
         return -1
@@ -156,36 +292,162 @@ def query_LLM(column_summary: pd.DataFrame, column_name: str, dataset_descriptio
             - `<object name='baz'><string name="foo" format="capitalize two-words" /><integer name="index" format="1-indexed" /></object>` => `{{{{'baz': {{{{'foo': 'Some String', 'index': 1}}}}}}}}`
             """
 
-    if LLM == "Cohere":
-        model = cohere.Client(api_key = LLM_token)
-        try:
-            output = model.generate(prompt = PROMPT.format(prompt_params), 
-                                    model = 'command', 
-                                    max_tokens = 1024, 
-                                    temperature = 0.0)
-            
-            output = output.generations[0].text
-            
-            if "," in output[-3:]:
-                output = output[:output.rfind(",")] + output[-1:]
-
-            return output
-        except Exception as e:
-            return "Error in Cohere definition: {}".format(e)
-    elif LLM == "LLaMA2":
-        os.environ['REPLICATE_API_TOKEN'] = LLM_token
-
-        query = replicate.run("meta/llama-2-70b-chat:02e509c789964a7ea8736978a43525956ef40397be9033abf9fd2badfe68c9e3",
-                                input={"prompt": PROMPT.format(prompt_params)})
-        
-        output = ""
-        for item in query:
-            output = output + item
-
-        try:
-            return output
-        except:
-            return "Error"
+    try:
+        return llm.generate(LLM, PROMPT.format(prompt_params), LLM_token, use_cache = use_cache)
+    except Exception as e:
+        return "Error in {} definition: {}".format(LLM, e)
+
+def column_context(summary_row: pd.Series) -> str:
+    # Example values, unit and range of one column as used in the prompts
+    if pd.isna(summary_row["column_unit"]):
+        unit = ""
+    else:
+        unit = summary_row["column_unit"]
+
+    context = "EXAMPLE VALUES: {} {}".format(summary_row["column_values"], unit)
+    if not pd.isna(summary_row["column_min"]):
+        context += "; MIN VALUE: {} {}; MAX VALUE: {} {}".format(summary_row["column_min"], unit, summary_row["column_max"], unit)
+    return context
+
+BATCH_DEFINITION_PROMPT = """Given the following dataset file description and a list of columns with their example values, please generate a definition for every column which is at least three sentences long and 100 characters in length.
+
+DATASET FILE DESCRIPTION: {dataset_description}
+
+COLUMNS:
+{columns}
+
+ONLY return a valid JSON array (no other text is necessary) with one object per column, in the same order as the list above. Each object has the keys "column_name" (the name of the column exactly as given) and "definition" (the definition for the column). Be correct and concise.
+"""
+
+def batch_definition_prompt(column_summary: pd.DataFrame, columns: list, dataset_description: str) -> str:
+    rows = column_summary.drop_duplicates("column_cleaned").set_index("column_cleaned").loc[columns]
+    blocks = ["{}. COLUMN NAME: {}; {}".format(i + 1, column, column_context(row)) for i, (column, row) in enumerate(rows.iterrows())]
+    return BATCH_DEFINITION_PROMPT.format(dataset_description = dataset_description, columns = "\n".join(blocks))
+
+def pack_definition_batches(column_summary: pd.DataFrame, columns: list, dataset_description: str, 
+                            token_budget: int = DEFINITION_BATCH_TOKENS, max_columns: int = DEFINITION_BATCH_MAX_COLUMNS) -> list:
+    # Greedily group columns so that each batch prompt, plus 
+    # DEFINITION_TOKENS_PER_COLUMN of answer per column, fits token_budget.
+    # A column that does not fit on its own still gets a batch of one.
+    rows = column_summary.drop_duplicates("column_cleaned").set_index("column_cleaned")
+    base_tokens = num_tokens_from_string(BATCH_DEFINITION_PROMPT.format(dataset_description = dataset_description, columns = ""), "cl100k_base")
+
+    batches = []
+    batch = []
+    batch_tokens = base_tokens
+    for column in columns:
+        block = "{}. COLUMN NAME: {}; {}\n".format(len(batch) + 1, column, column_context(rows.loc[column]))
+        column_tokens = num_tokens_from_string(block, "cl100k_base") + DEFINITION_TOKENS_PER_COLUMN
+        if batch and (batch_tokens + column_tokens > token_budget or len(batch) >= max_columns):
+            batches.append(batch)
+            batch = []
+            batch_tokens = base_tokens
+        batch.append(column)
+        batch_tokens += column_tokens
+    if batch:
+        batches.append(batch)
+    return batches
+
+def parse_batch_definitions(response: str, columns: list) -> dict:
+    # {column: definition} from a JSON array reply. Objects are matched on
+    # column_name, falling back to their position when the model renamed 
+    # the columns but answered all of them. Unparsable replies give {}.
+    start, end = response.find("["), response.rfind("]")
+    if start == -1 or end <= start:
+        return {}
+    try:
+        items = json.loads(response[start:end + 1])
+    except ValueError:
+        return {}
+
+    items = [item for item in items if isinstance(item, dict) and isinstance(item.get("definition"), str)]
+    definitions = {item.get("column_name"): item["definition"] for item in items if item.get("column_name") in columns}
+    if len(definitions) < len(columns) and len(items) == len(columns):
+        definitions = {column: item["definition"] for column, item in zip(columns, items)}
+    return definitions
+
+def data_dictionary_path(out_dir: str, dataset_name: str) -> str:
+    return out_dir + "/" + dataset_name + "/" + dataset_name + "_Data_Dictionary.csv"
+
+def approve_definition(data_dictionary: pd.DataFrame, column: str, definition: str) -> pd.DataFrame:
+    # A copy of data_dictionary with column's definition set and approved,
+    # leaving the (possibly shared, see dsf.read_csv) original as it is
+    approved = data_dictionary.copy()
+    mask = approved["Column Name"] == column
+    approved.loc[mask, "Column Definition"] = definition
+    approved.loc[mask, "Approved"] = True
+    return approved
+
+def definition_drafts_path(out_dir: str, dataset_name: str) -> str:
+    return out_dir + "/" + dataset_name + "/" + dataset_name + "_Definition_Drafts.csv"
+
+def _read_definition_drafts(path: str) -> dict:
+    drafts = pd.read_csv(path).drop_duplicates(["Column Name", "Model"], keep = "last")
+    return dict(zip(zip(drafts["Column Name"], drafts["Model"]), drafts["Definition"]))
+
+def load_definition_drafts(out_dir: str, dataset_name: str) -> dict:
+    # {(column, model): definition}; the latest draft of a column wins.
+    # Shared until drafts are added.
+    path = definition_drafts_path(out_dir, dataset_name)
+    if not os.path.exists(path):
+        return {}
+    return dsf.cached_load(path, _read_definition_drafts)
+
+_drafts_lock = threading.Lock()
+
+def save_definition_drafts(out_dir: str, dataset_name: str, model: str, definitions: dict):
+    # Drafts are appended as each batch finishes, so an interrupted run 
+    # keeps what it has already generated.
+    path = definition_drafts_path(out_dir, dataset_name)
+    drafts = pd.DataFrame({"Column Name": list(definitions.keys()), "Model": model, 
+                           "Definition": list(definitions.values()), "Created": datetime.now()})
+    with _drafts_lock:
+        drafts.to_csv(path, mode = "a", header = not os.path.exists(path), index = False)
+
+def generate_definitions(column_summary: pd.DataFrame, columns: list, dataset_description: str, api_keys: dict, 
+                         models: list, out_dir: str, dataset_name: str, token_budget: int = DEFINITION_BATCH_TOKENS, 
+                         status: dict = None, progress_callback = None):
+    # Draft definitions for columns with every model in models. Batches run 
+    # concurrently, DEFINITION_CONCURRENCY at a time per model, and are saved
+    # to the drafts file as they complete. Columns that already have a draft
+    # for a model are skipped. status, if given, is updated in place with 
+    # done/total batch counts and the errors encountered; 
+    # progress_callback(status) is called after each batch.
+    status = status if status is not None else {}
+    drafts = load_definition_drafts(out_dir, dataset_name)
+    columns = [c for c in dict.fromkeys(columns) if c in column_summary["column_cleaned"].to_numpy()]
+
+    work = []
+    for model in models:
+        pending = [c for c in columns if (c, model) not in drafts]
+        work += [(model, batch) for batch in pack_definition_batches(column_summary, pending, dataset_description, token_budget)]
+    status.update({"done": 0, "total": len(work), "drafted": 0, "errors": []})
+
+    def run_batch(model, batch):
+        prompt = batch_definition_prompt(column_summary, batch, dataset_description)
+        response = llm.generate(model, prompt, api_keys[model], max_tokens = DEFINITION_TOKENS_PER_COLUMN * len(batch))
+        return parse_batch_definitions(response, batch)
+
+    executors = {model: ThreadPoolExecutor(max_workers = DEFINITION_CONCURRENCY.get(model, 1)) for model in models}
+    try:
+        futures = {executors[model].submit(run_batch, model, batch): (model, batch) for model, batch in work}
+        for future in as_completed(futures):
+            model, batch = futures[future]
+            try:
+                definitions = future.result()
+            except Exception as e:
+                definitions = {}
+                status["errors"].append("Error in {} definitions: {}".format(model, e))
+            if definitions:
+                save_definition_drafts(out_dir, dataset_name, model, definitions)
+            status["drafted"] += len(definitions)
+            status["done"] += 1
+            if progress_callback is not None:
+                progress_callback(status)
+    finally:
+        for executor in executors.values():
+            executor.shutdown(wait = False, cancel_futures = True)
+    return status
 
 @st.cache_data  
 def query_LLM_TESTER(column_summary, column, dataset_description, LLM, LLM_key):
@@ -0,0 +1,396 @@
+import pandas as pd
+import numpy as np
+import os
+import re
+import sys
+import threading
+import collections
+import contextlib
+import tempfile
+
+import pyarrow as pa
+import pyarrow.feather as feather
+
+# Product columns every evaluation needs, whatever the mandate.
+PRODUCT_BASE_COLUMNS = ["id", "name", "category_id", "category_label", "Sustainability certificates.42513"]
+
+# Columns kept in memory for finding products.
+PRODUCT_INDEX_COLUMNS = ["id", "name", "category_label"]
+
+# Product search: a match must share at least SEARCH_MIN_MATCH of the 
+# query's trigrams with the product's name, id and category label.
+SEARCH_MIN_MATCH = 0.5
+SEARCH_PAGE_SIZE = 20
+
+# Search text is reduced to lowercase letters, digits and spaces; each 
+# character's code is its position in SEARCH_ALPHABET, and other bytes map
+# to the space.
+SEARCH_ALPHABET = " abcdefghijklmnopqrstuvwxyz0123456789"
+SEARCH_TRIGRAMS = len(SEARCH_ALPHABET) ** 3
+SEARCH_SEPARATORS = r"[^0-9a-z]+"
+_SEARCH_CODES = np.zeros(256, dtype = np.int64)
+_SEARCH_CODES[[ord(c) for c in SEARCH_ALPHABET]] = np.arange(len(SEARCH_ALPHABET))
+
+# Files the app reads on every rerun (product and search indexes, mandates,
+# relevance, rules, models...) are loaded once per process and shared, read
+# only, by every session and worker thread. Entries are keyed on the loader,
+# the file and the loader's arguments, loaded again when the file's 
+# modification time changes, and the least recently used are dropped once 
+# the estimated size of all entries exceeds REGISTRY_MAX_BYTES.
+REGISTRY_MAX_BYTES = 1024 * 1024 * 1024
+
+def estimated_size(value, depth: int = 0) -> int:
+    # Approximate memory held by a loaded value, in bytes. Containers and 
+    # objects (e.g. fitted models, which keep arrays as attributes) are 
+    # measured through their contents, down to a few levels.
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        size = value.memory_usage(deep = True, index = True)
+        return int(size.sum() if isinstance(size, pd.Series) else size)
+    if isinstance(value, np.ndarray):
+        return int(value.nbytes)
+    if isinstance(value, pa.Table):
+        return int(value.nbytes)
+    if hasattr(value, "data") and hasattr(value, "indices") and hasattr(value, "indptr"):
+        # scipy sparse matrix
+        return int(value.data.nbytes + value.indices.nbytes + value.indptr.nbytes)
+    if depth >= 4:
+        return sys.getsizeof(value)
+    if isinstance(value, dict):
+        return sum(estimated_size(v, depth + 1) for v in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(estimated_size(v, depth + 1) for v in value)
+    if hasattr(value, "__dict__"):
+        return sys.getsizeof(value) + sum(estimated_size(v, depth + 1) for v in vars(value).values())
+    return sys.getsizeof(value)
+
+class FileRegistry:
+    def __init__(self, max_bytes: int = REGISTRY_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()    # key: (modified, value, size), least recently used first
+        self.loading = {}                           # key: lock held while the entry is loaded
+        self.counts = {"hits": 0, "misses": 0, "reloads": 0, "evicted": 0}
+        self.lock = threading.Lock()
+
+    def _lookup(self, key: tuple, modified: float):
+        entry = self.entries.get(key)
+        if entry is None or entry[0] != modified:
+            return None
+        self.entries.move_to_end(key)
+        self.counts["hits"] += 1
+        return entry
+
+    def get(self, file_path: str, load, *args):
+        # load(file_path, *args), or the value it returned when the file was
+        # last loaded with the same arguments and has not changed since. 
+        # Concurrent requests for one entry wait for a single load.
+        key = (load.__module__, load.__qualname__, file_path) + args
+        modified = os.path.getmtime(file_path)
+        with self.lock:
+            entry = self._lookup(key, modified)
+            if entry is not None:
+                return entry[1]
+            key_lock = self.loading.setdefault(key, threading.Lock())
+
+        with key_lock:
+            with self.lock:
+                entry = self._lookup(key, modified)
+                if entry is not None:
+                    return entry[1]
+            value = load(file_path, *args)
+            size = estimated_size(value)
+            with self.lock:
+                self.counts["reloads" if key in self.entries else "misses"] += 1
+                self.entries[key] = (modified, value, size)
+                self.entries.move_to_end(key)
+                self._evict(key)
+        return value
+
+    def _evict(self, keep: tuple):
+        # Drop the least recently used entries until the rest fit; the entry
+        # just loaded stays even if it alone is over the budget.
+        total = sum(size for _, _, size in self.entries.values())
+        for key in list(self.entries):
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            total -= self.entries.pop(key)[2]
+            self.loading.pop(key, None)
+            self.counts["evicted"] += 1
+
+    def stats(self) -> dict:
+        with self.lock:
+            return dict(self.counts, entries = len(self.entries), bytes = sum(size for _, _, size in self.entries.values()), 
+                        max_bytes = self.max_bytes)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.loading.clear()
+
+registry = FileRegistry()
+
+def cached_load(file_path: str, load, *args):
+    # load(file_path, *args) through the process-wide registry. Callers 
+    # share the value and must not modify it.
+    return registry.get(file_path, load, *args)
+
+def read_csv(file_path: str) -> pd.DataFrame:
+    return cached_load(file_path, pd.read_csv)
+
+def registry_stats() -> dict:
+    """Returns hit/miss/eviction counters and the memory held by the shared file registry."""
+    return registry.stats()
+
+def columnar_path(file_path: str) -> str:
+    return os.path.splitext(file_path)[0] + ".feather"
+
+@contextlib.contextmanager
+def replacing(file_path: str, suffix: str = ".tmp"):
+    # Yields a path to write file_path's new contents to, unique to this 
+    # writer and in the same folder, which replaces file_path once the 
+    # block completes; concurrent writers never share a temporary file.
+    fd, temp_path = tempfile.mkstemp(dir = os.path.dirname(file_path) or ".", suffix = suffix)
+    os.close(fd)
+    try:
+        yield temp_path
+        os.replace(temp_path, file_path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+def write_columnar(data: pd.DataFrame, file_path: str):
+    # Datasets are stored as uncompressed Feather (Arrow IPC) so they can be
+    # memory-mapped and read column by column without a copy.
+    data = data.reset_index(drop = True)
+    try:
+        table = pa.Table.from_pandas(data, preserve_index = False)
+    except (pa.ArrowTypeError, pa.ArrowInvalid):
+        # Arrow needs one type per column; store mixed object columns as text
+        for c in data.columns[data.dtypes == object]:
+            data[c] = data[c].where(data[c].isna(), data[c].astype(str))
+        table = pa.Table.from_pandas(data, preserve_index = False)
+
+    with replacing(file_path) as temp_path:
+        feather.write_feather(table, temp_path, compression = "uncompressed")
+
+def ensure_columnar(file_path: str) -> str:
+    # Path of the columnar copy of a dataset, converting it from CSV if the
+    # copy is missing or older than the CSV.
+    if file_path.endswith(".feather"):
+        return file_path
+
+    out_path = columnar_path(file_path)
+    if not os.path.exists(out_path) or os.path.getmtime(out_path) < os.path.getmtime(file_path) or not _text_identifiers(out_path):
+        write_columnar(pd.read_csv(file_path, dtype = {c: str for c in PRODUCT_BASE_COLUMNS}), out_path)
+    return out_path
+
+def _text_identifiers(file_path: str) -> bool:
+    # Whether the product base columns of a columnar copy are stored as 
+    # text; copies made before they were are converted again
+    schema = pa.ipc.open_file(pa.memory_map(file_path)).schema
+    return all(schema.field(c).type in [pa.string(), pa.large_string(), pa.null()] for c in PRODUCT_BASE_COLUMNS if c in schema.names)
+
+def open_dataset(file_path: str, columns: list = None) -> pa.Table:
+    # Memory-mapped read; only the projected columns are touched.
+    return feather.read_table(file_path, columns = columns, memory_map = True)
+
+def dataset_columns(file_path: str) -> list:
+    return open_dataset(file_path).schema.names
+
+def load_product_index(file_path: str) -> pd.DataFrame:
+    # id, name and category of every product; the row label is the product's
+    # row number in the dataset, as used by load_products.
+    return open_dataset(file_path, PRODUCT_INDEX_COLUMNS).to_pandas()
+
+def load_products(file_path: str, rows: list, columns: list = None) -> pd.DataFrame:
+    # Materialize only the requested rows and columns.
+    return open_dataset(file_path, columns).take(pa.array(rows, type = pa.int64())).to_pandas()
+
+def iter_product_chunks(file_path: str, chunk_size: int, columns: list = None):
+    table = open_dataset(file_path, columns)
+    for offset in range(0, table.num_rows, chunk_size):
+        yield table.slice(offset, chunk_size).to_pandas()
+
+def mandate_columns(mandate_column_full_df: pd.DataFrame, available_columns: list, extra_columns: list = None) -> list:
+    # Product columns needed to evaluate the mandates in mandate_column_full_df:
+    # the base columns plus every relevant column (and extra_columns) with 
+    # its unit twin.
+    columns = list(PRODUCT_BASE_COLUMNS)
+    for col in list(pd.unique(mandate_column_full_df["Column Name Raw"].dropna())) + list(extra_columns or []):
+        columns += [col, col + ".unit"]
+
+    available_columns = set(available_columns)
+    return [col for col in dict.fromkeys(columns) if col in available_columns]
+
+def iter_upload_chunks(uploaded_file, file_type: str, chunk_size: int, text_columns: list = ()):
+    # DataFrames of at most chunk_size rows read from an uploaded csv or 
+    # feather (Arrow IPC) file. CSV columns in text_columns are read as 
+    # they are written, without parsing numbers.
+    if file_type == ".csv":
+        for chunk in pd.read_csv(uploaded_file, chunksize = chunk_size, dtype = {c: str for c in text_columns}):
+            yield chunk
+    elif file_type == ".feather":
+        reader = pa.ipc.open_file(uploaded_file)
+        for i in range(reader.num_record_batches):
+            batch = reader.get_batch(i)
+            for offset in range(0, batch.num_rows, chunk_size):
+                yield batch.slice(offset, chunk_size).to_pandas()
+
+def chunk_column_kinds(chunk: pd.DataFrame) -> dict:
+    # {column: "number", "boolean", "text" or None (no values)} for one chunk
+    kinds = {}
+    for c in chunk.columns:
+        # A column with no values in the chunk is read as float64 whatever
+        # its other chunks hold
+        kind = "empty" if chunk[c].isna().all() else pd.api.types.infer_dtype(chunk[c], skipna = True)
+        if kind == "empty":
+            kinds[c] = None
+        elif kind == "boolean":
+            kinds[c] = "boolean"
+        elif kind in ["integer", "floating", "mixed-integer-float", "decimal"]:
+            kinds[c] = "number"
+        else:
+            kinds[c] = "text"
+    return kinds
+
+def merge_column_kinds(kinds: dict, chunk_kinds: dict) -> dict:
+    # Column kinds over several chunks: a column whose chunks disagree is
+    # widened to text, which holds any value
+    merged = dict(kinds)
+    for c, kind in chunk_kinds.items():
+        if merged.get(c) is None:
+            merged[c] = kind
+        elif kind is not None and kind != merged[c]:
+            merged[c] = "text"
+    return merged
+
+def column_kinds_schema(kinds: dict) -> pa.Schema:
+    # Column types of a dataset written in chunks, from the kinds of all its
+    # chunks (see merge_column_kinds). Numbers are stored as float64, which
+    # holds missing values; the product base columns and columns with no 
+    # values are stored as text.
+    types = {"number": pa.float64(), "boolean": pa.bool_()}
+    return pa.schema([pa.field(c, pa.string() if c in PRODUCT_BASE_COLUMNS else types.get(kind, pa.string())) for c, kind in kinds.items()])
+
+def conform_chunk(chunk: pd.DataFrame, schema: pa.Schema) -> pd.DataFrame:
+    # Cast a chunk to the dataset schema. The schema must come from every 
+    # chunk (see column_kinds_schema): a value its column cannot represent 
+    # raises ValueError rather than being dropped.
+    columns = {}
+    for field in schema:
+        col = chunk[field.name] if field.name in chunk.columns else pd.Series([None] * chunk.shape[0], index = chunk.index, dtype = object)
+        if field.type == pa.float64():
+            values = pd.to_numeric(col, errors = "coerce")
+        elif field.type == pa.bool_():
+            values = col.map({True: True, False: False, "True": True, "False": False, "true": True, "false": False}).astype(object)
+        else:
+            values = col.astype(object).where(col.isna(), col.astype(str))
+        lost = values.isna() & col.notna()
+        if lost.any():
+            raise ValueError("Column {!r} cannot store the value {!r} as {}".format(field.name, col[lost].iloc[0], field.type))
+        columns[field.name] = values
+    return pd.DataFrame(columns, index = chunk.index)
+
+def write_columnar_chunks(chunks, schema: pa.Schema, file_path: str):
+    # Write an iterable of conformed chunks as one uncompressed Arrow IPC 
+    # (Feather) file without holding more than one chunk in memory.
+    with replacing(file_path) as temp_path:
+        with pa.OSFile(temp_path, "wb") as sink:
+            with pa.ipc.new_file(sink, schema) as writer:
+                for chunk in chunks:
+                    writer.write_table(pa.Table.from_pandas(chunk, schema = schema, preserve_index = False))
+
+def search_index_path(file_path: str) -> str:
+    return os.path.splitext(file_path)[0] + "_search.npz"
+
+def normalize_search_text(text: str) -> str:
+    return " ".join(re.sub(SEARCH_SEPARATORS, " ", str(text).lower()).split())
+
+def search_trigrams(texts: list):
+    # (row, trigram) pairs of normalized texts, each trigram once per row, 
+    # sorted by row. Words are padded as in pg_trgm so word starts and ends
+    # count ("x1" -> "  x", " x1", "x1 "); a trigram is the base-37 code of
+    # its three characters. Words are joined with three spaces and texts
+    # concatenated, so the windows spanning two words or texts are exactly
+    # those with a character followed by a space, or three spaces.
+    padded = ["  " + text.replace(" ", "   ") + " " for text in texts]
+    chars = _SEARCH_CODES[np.frombuffer("".join(padded).encode("ascii"), dtype = np.uint8)]
+    lengths = np.fromiter(map(len, padded), dtype = np.int64, count = len(padded))
+    window_rows = np.repeat(np.arange(len(texts), dtype = np.int64), lengths)[:-2]
+    c0, c1, c2 = chars[:-2], chars[1:-1], chars[2:]
+    valid = ~((c0 != 0) & (c1 == 0)) & ~((c0 == 0) & (c1 == 0) & (c2 == 0))
+    keys = np.sort(window_rows[valid] * SEARCH_TRIGRAMS + (c0 * 37 * 37 + c1 * 37 + c2)[valid])
+    first = np.ones(len(keys), dtype = bool)
+    first[1:] = keys[1:] != keys[:-1]
+    keys = keys[first]
+    return keys // SEARCH_TRIGRAMS, keys % SEARCH_TRIGRAMS
+
+def build_search_index(file_path: str, out_path: str):
+    # Inverted trigram index over the products' name, id and category label:
+    # the row numbers of every trigram's products, stored contiguously by 
+    # trigram with the offset of each trigram's list, and each product's 
+    # trigram count.
+    products = load_product_index(file_path)
+    texts = (products["name"].astype(str) + " " + products["id"].astype(str) + " " + products["category_label"].astype(str)).str.lower()
+    rows, grams = search_trigrams([" ".join(text.split()) for text in texts.str.replace(SEARCH_SEPARATORS, " ", regex = True)])
+
+    # A stable sort keeps each list's rows in ascending order
+    order = np.argsort(grams, kind = "stable")
+    starts = np.concatenate([[0], np.cumsum(np.bincount(grams, minlength = SEARCH_TRIGRAMS))])
+    with replacing(out_path, ".npz") as temp_path:
+        np.savez(temp_path, starts = starts.astype(np.int64), rows = rows[order].astype(np.int32), 
+                 gram_counts = np.bincount(rows, minlength = len(texts)).astype(np.int32))
+
+def ensure_search_index(file_path: str) -> str:
+    # Path of the dataset's search index, (re)built if it is missing or 
+    # older than the dataset.
+    out_path = search_index_path(file_path)
+    if not os.path.exists(out_path) or os.path.getmtime(out_path) < os.path.getmtime(file_path):
+        build_search_index(file_path, out_path)
+    return out_path
+
+def _read_search_index(index_path: str) -> dict:
+    with np.load(index_path) as index:
+        return {key: index[key] for key in index.files}
+
+def _read_product_index(file_path: str) -> pd.DataFrame:
+    # Object columns: taking a page of rows from Arrow-backed strings costs
+    # more than the search itself
+    return load_product_index(file_path).astype(object)
+
+def load_search_index(file_path: str):
+    # The search index and the product index it points into, read once and
+    # shared until they change.
+    return cached_load(ensure_search_index(file_path), _read_search_index), cached_load(file_path, _read_product_index)
+
+def search_products(file_path: str, query: str, limit: int = SEARCH_PAGE_SIZE, offset: int = 0):
+    # Products whose name, id or category label fuzzily match query, best 
+    # first: ranked by the share of the query's trigrams they contain, then
+    # by overall similarity (so shorter, closer names come first). Returns 
+    # (page, total): page holds id, name and category_label of results 
+    # offset to offset + limit, labelled with their row numbers and with 
+    # their score; total is the number of matches.
+    index, products = load_search_index(file_path)
+    _, grams = search_trigrams([normalize_search_text(query)])
+    if len(grams) == 0:
+        return pd.DataFrame([], columns = PRODUCT_INDEX_COLUMNS + ["score"]), 0
+
+    # Trigrams shared with the query, counted per product
+    starts = index["starts"]
+    shared = np.bincount(np.concatenate([index["rows"][starts[g]:starts[g + 1]] for g in grams]), minlength = len(index["gram_counts"]))
+    rows = np.flatnonzero(shared >= SEARCH_MIN_MATCH * len(grams))
+    shared = shared[rows]
+
+    score = shared / len(grams)
+    similarity = shared / (len(grams) + index["gram_counts"][rows] - shared)
+
+    # Only the products up to the requested page are sorted
+    candidates = np.arange(len(rows))
+    if offset + limit < len(rows):
+        candidates = np.argpartition(-(score + similarity * 1e-3), offset + limit - 1)[:offset + limit]
+    order = candidates[np.lexsort((rows[candidates], -similarity[candidates], -score[candidates]))][offset:offset + limit]
+
+    page = products.iloc[rows[order]].copy()
+    page["score"] = score[order]
+    return page, len(rows)
@@ -0,0 +1,142 @@
+import json
+import os
+import sqlite3
+import subprocess
+import sys
+import time
+
+from contextlib import closing
+
+# Long evaluations run as jobs in worker processes (see job_worker.py) instead
+# of inside the Streamlit script, so reruns and reloads do not interrupt them.
+# Jobs are queued in a SQLite file shared by every session and worker:
+#     queued -> running -> done | failed | cancelled
+# API keys are kept apart from the job parameters, only until a worker takes
+# the job: they are erased when it is claimed or cancelled.
+JOBS_PATH = "./jobs.sqlite"
+
+# Seconds between checks of the queue by an idle worker, and between page
+# refreshes while a job is shown.
+JOB_POLL_SECONDS = 1.0
+
+# A worker that has not reported for STALE_SECONDS is presumed dead; its
+# running job fails, since its API keys went with the worker.
+HEARTBEAT_SECONDS = 5.0
+STALE_SECONDS = 60.0
+
+# Worker processes started by the app when none are running; they exit
+# after IDLE_EXIT_SECONDS without jobs.
+DEFAULT_WORKERS = 2
+IDLE_EXIT_SECONDS = 600
+
+WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "job_worker.py")
+
+JOB_COLUMNS = ["id", "kind", "params", "status", "done", "total", "message", "result", "error",
+               "submitted", "started", "finished", "worker", "cancel"]
+
+class JobCancelled(Exception):
+    pass
+
+def _connect(path: str = JOBS_PATH) -> sqlite3.Connection:
+    con = sqlite3.connect(path, timeout = 30, isolation_level = None)
+    con.execute("PRAGMA journal_mode=WAL")
+    con.execute("""CREATE TABLE IF NOT EXISTS jobs (id INTEGER PRIMARY KEY AUTOINCREMENT, kind TEXT, params TEXT, secrets TEXT,
+                   status TEXT, done REAL, total REAL, message TEXT, result TEXT, error TEXT,
+                   submitted REAL, started REAL, finished REAL, worker INTEGER, heartbeat REAL, cancel INTEGER DEFAULT 0)""")
+    con.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, id)")
+    con.execute("CREATE TABLE IF NOT EXISTS workers (pid INTEGER PRIMARY KEY, heartbeat REAL)")
+    return con
+
+def _job_dict(row) -> dict:
+    job = dict(zip(JOB_COLUMNS, row))
+    job["params"] = json.loads(job["params"])
+    job["result"] = None if job["result"] is None else json.loads(job["result"])
+    return job
+
+def submit_job(kind: str, params: dict, secrets: dict = None, path: str = JOBS_PATH) -> int:
+    # Queue a job and return its id. params must be JSON serializable.
+    with closing(_connect(path)) as con:
+        cursor = con.execute("INSERT INTO jobs (kind, params, secrets, status, done, total, submitted) VALUES (?, ?, ?, 'queued', 0, 0, ?)",
+                             (kind, json.dumps(params), json.dumps(secrets or {}), time.time()))
+        return cursor.lastrowid
+
+def get_job(job_id: int, path: str = JOBS_PATH) -> dict:
+    # The job's state, without its secrets; None if there is no such job.
+    with closing(_connect(path)) as con:
+        row = con.execute("SELECT {} FROM jobs WHERE id = ?".format(", ".join(JOB_COLUMNS)), (job_id,)).fetchone()
+    return None if row is None else _job_dict(row)
+
+def list_jobs(kind: str = None, limit: int = 20, path: str = JOBS_PATH) -> list:
+    # Newest jobs first, optionally of one kind.
+    with closing(_connect(path)) as con:
+        where = "" if kind is None else " WHERE kind = ?"
+        rows = con.execute("SELECT {} FROM jobs{} ORDER BY id DESC LIMIT ?".format(", ".join(JOB_COLUMNS), where),
+                           ([] if kind is None else [kind]) + [limit]).fetchall()
+    return [_job_dict(row) for row in rows]
+
+def cancel_job(job_id: int, path: str = JOBS_PATH):
+    # A queued job is cancelled at once; a running job stops at its next
+    # progress report.
+    with closing(_connect(path)) as con:
+        con.execute("UPDATE jobs SET status = 'cancelled', secrets = NULL, finished = ? WHERE id = ? AND status = 'queued'", (time.time(), job_id))
+        con.execute("UPDATE jobs SET cancel = 1, secrets = NULL WHERE id = ? AND status = 'running'", (job_id,))
+
+def claim_job(worker: int, path: str = JOBS_PATH):
+    # Take the oldest queued job for worker: (job, secrets), or None if the
+    # queue is empty. The secrets are handed over in memory and erased from
+    # the queue. Jobs of dead workers are failed first.
+    with closing(_connect(path)) as con:
+        con.execute("BEGIN IMMEDIATE")
+        con.execute("UPDATE jobs SET status = 'failed', error = ?, secrets = NULL, finished = ? WHERE status = 'running' AND heartbeat < ?", 
+                    ("The worker running this job stopped; please submit it again.", time.time(), time.time() - STALE_SECONDS))
+        con.execute("UPDATE jobs SET secrets = NULL WHERE status != 'queued' AND secrets IS NOT NULL")
+        row = con.execute("SELECT {}, secrets FROM jobs WHERE status = 'queued' ORDER BY id LIMIT 1".format(", ".join(JOB_COLUMNS))).fetchone()
+        if row is None:
+            con.execute("COMMIT")
+            return None
+        now = time.time()
+        con.execute("UPDATE jobs SET status = 'running', secrets = NULL, worker = ?, started = ?, heartbeat = ? WHERE id = ?", (worker, now, now, row[0]))
+        con.execute("COMMIT")
+    job = _job_dict(row[:-1])
+    job["status"] = "running"
+    return job, json.loads(row[-1] or "{}")
+
+def report_progress(job_id: int, done: float, total: float, message: str = None, path: str = JOBS_PATH):
+    # Record a running job's progress. Raises JobCancelled if the job was
+    # cancelled, so the job stops where it reports.
+    with closing(_connect(path)) as con:
+        con.execute("UPDATE jobs SET done = ?, total = ?, message = COALESCE(?, message), heartbeat = ? WHERE id = ?",
+                    (done, total, message, time.time(), job_id))
+        cancel = con.execute("SELECT cancel FROM jobs WHERE id = ?", (job_id,)).fetchone()
+    if cancel is not None and cancel[0]:
+        raise JobCancelled("Job {} was cancelled.".format(job_id))
+
+def finish_job(job_id: int, status: str, result = None, error: str = None, path: str = JOBS_PATH):
+    # status is "done", "failed" or "cancelled"
+    with closing(_connect(path)) as con:
+        con.execute("UPDATE jobs SET status = ?, result = ?, error = ?, secrets = NULL, finished = ? WHERE id = ?",
+                    (status, json.dumps(result), error, time.time(), job_id))
+
+def worker_heartbeat(worker: int, path: str = JOBS_PATH):
+    with closing(_connect(path)) as con:
+        con.execute("INSERT OR REPLACE INTO workers (pid, heartbeat) VALUES (?, ?)", (worker, time.time()))
+        con.execute("UPDATE jobs SET heartbeat = ? WHERE worker = ? AND status = 'running'", (time.time(), worker))
+
+def remove_worker(worker: int, path: str = JOBS_PATH):
+    with closing(_connect(path)) as con:
+        con.execute("DELETE FROM workers WHERE pid = ?", (worker,))
+
+def live_workers(path: str = JOBS_PATH) -> int:
+    with closing(_connect(path)) as con:
+        return con.execute("SELECT COUNT(*) FROM workers WHERE heartbeat >= ?", (time.time() - STALE_SECONDS,)).fetchone()[0]
+
+def ensure_workers(workers: int = DEFAULT_WORKERS, path: str = JOBS_PATH):
+    # Start worker processes, detached from the app, until workers are
+    # alive. A started worker is registered right away so concurrent reruns
+    # do not start more.
+    missing = workers - live_workers(path)
+    for _ in range(max(missing, 0)):
+        process = subprocess.Popen([sys.executable, WORKER_SCRIPT, "--jobs", os.path.abspath(path), "--idle-exit", str(IDLE_EXIT_SECONDS)],
+                                   cwd = os.getcwd(), stdin = subprocess.DEVNULL, stdout = subprocess.DEVNULL,
+                                   stderr = subprocess.DEVNULL, start_new_session = True)
+        worker_heartbeat(process.pid, path)
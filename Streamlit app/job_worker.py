@@ -0,0 +1,137 @@
+# Worker processes for the job queue in job_functions. The app starts them
+# when needed; they can also be run by hand from the "Streamlit app" folder:
+#
+#     python job_worker.py --workers 4
+#
+# Each worker takes the oldest queued job, runs it and records its progress
+# and result, then takes the next one.
+import argparse
+import json
+import multiprocessing
+import os
+import threading
+import time
+import traceback
+
+import pandas as pd
+
+import job_functions as jf
+
+def run_recommend_product(job: dict, api_keys: dict, report) -> dict:
+    import cert_eval_functions as cef
+    import llm_functions as llm
+    import trace_functions as trf
+
+    def progress(done, total, streams):
+        report(done, total, "\n\n".join(" ".join(text.split())[-200:] for _, text in sorted(streams.items())[:3]) or None)
+
+    # The run is traced, and the trace saved even if it fails
+    trace_path = trf.trace_path("recommend_product_{}".format(job["id"]))
+    trace = None
+    try:
+        with trf.start_trace("recommend_product", job = job["id"], dataset = job["params"].get("dataset_name"), 
+                             product_row = job["params"].get("product_row")) as trace:
+            # Classifiers are scored by the page when it shows the results
+            params = dict(job["params"])
+            params.pop("classifiers", None)
+            rec, summary = cef.recommend_product(api_keys = api_keys, progress_callback = progress, **params)
+    finally:
+        if trace is not None:
+            trf.write_trace(trace, trace_path)
+    return {"rec": json.loads(rec.to_json(orient = "split", date_format = "iso", index = False)),
+            "summary": json.loads(summary.to_json(orient = "split", index = False)), 
+            "rate_limits": llm.rate_limit_stats(), 
+            "cache": llm.cache_stats(),
+            "usage": llm.usage_stats(),
+            "trace": trace_path}
+
+def run_certify_catalog(job: dict, api_keys: dict, report) -> dict:
+    import cert_eval_functions as cef
+    import dataset_functions as dsf
+    import model_functions as mf
+
+    params = dict(job["params"])
+    classifiers = params.pop("classifiers", [])
+    products_done, products_total = cef.certify_catalog(api_keys = api_keys, progress_callback = lambda done, total: report(done, total),
+                                                        **params)
+
+    # Classifiers trained in Models.ipynb score the whole catalog locally
+    products_path = dsf.ensure_columnar(cef.get_dataset_file(params.get("master_file_list_path", "./file_list.csv"), params["dataset_name"]))
+    classifier_scores_path = "./Product Certification/" + params["dataset_name"] + "/product_classifier_scores.csv"
+    for cert in params["certs"]:
+        for kind in classifiers:
+            if kind in mf.available_classifiers(cert):
+                for scores in mf.score_dataset(products_path, cert, kind):
+                    cef.save_recommendation(classifier_scores_path, scores)
+    return {"products_done": products_done, "products_total": products_total}
+
+def run_draft_definitions(job: dict, api_keys: dict, report) -> dict:
+    import data_dictionary_functions as ddf
+
+    params = dict(job["params"])
+    column_summary = pd.read_csv(params.pop("column_summary_path"))
+    status = ddf.generate_definitions(column_summary, api_keys = api_keys,
+                                      progress_callback = lambda status: report(status["done"], status["total"],
+                                                                                "{} definitions drafted".format(status["drafted"])),
+                                      **params)
+    return {"drafted": status["drafted"], "errors": status["errors"]}
+
+# kind: function(job, api keys, report(done, total, message)) -> JSON serializable result
+JOB_RUNNERS = {"recommend_product": run_recommend_product,
+               "certify_catalog": run_certify_catalog,
+               "draft_definitions": run_draft_definitions}
+
+def run_job(job: dict, api_keys: dict, path: str = jf.JOBS_PATH):
+    def report(done, total, message = None):
+        jf.report_progress(job["id"], done, total, message, path)
+
+    try:
+        result = JOB_RUNNERS[job["kind"]](job, api_keys, report)
+    except jf.JobCancelled:
+        jf.finish_job(job["id"], "cancelled", path = path)
+    except Exception:
+        jf.finish_job(job["id"], "failed", error = traceback.format_exc(), path = path)
+    else:
+        jf.finish_job(job["id"], "done", result, path = path)
+
+def work(path: str = jf.JOBS_PATH, idle_exit: float = None):
+    # Run queued jobs until stopped, or until the queue has been empty for
+    # idle_exit seconds. A background thread reports the worker alive,
+    # including while a job runs without reporting progress.
+    worker = os.getpid()
+    stopped = threading.Event()
+
+    def heartbeat():
+        while not stopped.wait(jf.HEARTBEAT_SECONDS):
+            jf.worker_heartbeat(worker, path)
+
+    jf.worker_heartbeat(worker, path)
+    threading.Thread(target = heartbeat, daemon = True).start()
+    idle_since = time.time()
+    try:
+        while idle_exit is None or time.time() - idle_since < idle_exit:
+            claimed = jf.claim_job(worker, path)
+            if claimed is None:
+                time.sleep(jf.JOB_POLL_SECONDS)
+                continue
+            run_job(*claimed, path = path)
+            idle_since = time.time()
+    finally:
+        stopped.set()
+        jf.remove_worker(worker, path)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Run queued recommendation and data dictionary jobs.")
+    parser.add_argument("--workers", type = int, default = 1, help = "number of worker processes")
+    parser.add_argument("--jobs", default = jf.JOBS_PATH, help = "job queue database")
+    parser.add_argument("--idle-exit", type = float, default = None, help = "stop after this many seconds without jobs")
+    args = parser.parse_args()
+
+    if args.workers == 1:
+        work(args.jobs, args.idle_exit)
+    else:
+        processes = [multiprocessing.Process(target = work, args = (args.jobs, args.idle_exit)) for _ in range(args.workers)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
@@ -0,0 +1,586 @@
+import os
+import time
+import random
+import threading
+import sqlite3
+import hashlib
+import json
+import functools
+import contextlib
+import contextvars
+from contextlib import closing
+
+import cohere
+import replicate
+import openai
+import tiktoken
+
+import trace_functions as trf
+
+PROVIDER_MODELS = {"Cohere": "command",
+                   "LLaMA2": "meta/llama-2-70b-chat:02e509c789964a7ea8736978a43525956ef40397be9033abf9fd2badfe68c9e3",
+                   "GPT-3.5": "gpt-3.5-turbo"}
+
+# Quotas used to pace requests to each provider. The Cohere numbers match a
+# trial key; raise them for production keys.
+PROVIDER_RATE_LIMITS = {"Cohere": {"requests_per_minute": 5, "tokens_per_minute": 40000},
+                        "LLaMA2": {"requests_per_minute": 600, "tokens_per_minute": 400000},
+                        "GPT-3.5": {"requests_per_minute": 3500, "tokens_per_minute": 90000}}
+
+# Provider API endpoints, e.g. a proxy or the mock server in 
+# benchmarks/mock_llm_server.py; None uses the provider's own endpoint.
+PROVIDER_BASE_URLS = {"Cohere": os.environ.get("COHERE_BASE_URL"),
+                      "LLaMA2": os.environ.get("REPLICATE_BASE_URL"),
+                      "GPT-3.5": os.environ.get("OPENAI_BASE_URL")}
+
+# List prices in USD per 1,000 input and output tokens.
+PROVIDER_PRICES = {"Cohere": {"input": 0.001, "output": 0.002},
+                   "LLaMA2": {"input": 0.00065, "output": 0.00275},
+                   "GPT-3.5": {"input": 0.0005, "output": 0.0015}}
+
+# Persistent response cache shared by every session and app restart.
+LLM_CACHE_PATH = "./LLM Cache/llm_cache.sqlite"
+LLM_CACHE_TTL = 30 * 24 * 60 * 60
+LLM_CACHE_MAX_BYTES = 200 * 1024 * 1024
+# Writes between checks of the cache size, which sums every entry; the 
+# cache may go over its budget by as many responses in between.
+LLM_CACHE_EVICT_EVERY = 100
+
+MAX_RETRIES = 5
+BACKOFF_BASE = 2
+BACKOFF_MAX = 60
+
+class ProviderError(Exception):
+    pass
+
+class RateLimitError(ProviderError):
+    pass
+
+class ServiceUnavailableError(ProviderError):
+    pass
+
+class TokenBucket:
+    # Bucket refilled continuously at per_minute / 60 units per second.
+    # Reservations are taken immediately and may drive the level negative;
+    # the caller then waits until the debt has been refilled, so waiting
+    # callers are served in the order they reserved.
+    def __init__(self, per_minute: float):
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.level = per_minute
+        self.updated = time.monotonic()
+
+    def reserve(self, amount: float, now: float) -> float:
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+        self.level -= min(amount, self.capacity)
+        return max(0.0, -self.level / self.rate)
+
+    def drain(self):
+        self.level = min(self.level, 0.0)
+
+class RateLimiter:
+    # Paces one provider on both requests/min and tokens/min.
+    def __init__(self, requests_per_minute: float, tokens_per_minute: float):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.lock = threading.Lock()
+
+    def acquire(self, tokens: int) -> float:
+        with self.lock:
+            now = time.monotonic()
+            wait = max(self.requests.reserve(1, now), self.tokens.reserve(tokens, now))
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def penalize(self):
+        # The provider rejected a request, so our view of the quota is too
+        # optimistic: stop handing out requests until the bucket refills.
+        with self.lock:
+            self.requests.drain()
+
+_rate_limiters = {}
+_clients = {}
+_rate_limit_stats = {}
+_cache_stats = {"hits": 0, "misses": 0, "expired": 0, "writes": 0, "evicted": 0}
+_cache_writes = 0
+_usage_stats = {}
+_meters = contextvars.ContextVar("meters", default = ())
+_lock = threading.Lock()
+
+def get_rate_limiter(provider: str) -> RateLimiter:
+    with _lock:
+        if provider not in _rate_limiters:
+            limits = PROVIDER_RATE_LIMITS[provider]
+            _rate_limiters[provider] = RateLimiter(limits["requests_per_minute"], limits["tokens_per_minute"])
+        return _rate_limiters[provider]
+
+def get_client(provider: str, api_key: str):
+    # One client per (provider, key), built on first use and shared by every
+    # thread. The Cohere and Replicate clients keep their HTTP connections 
+    # alive between requests; the key travels with the client instead of 
+    # through process-wide state. openai keeps a pooled session per thread 
+    # itself, so GPT-3.5 only needs the key passed on each request.
+    base_url = PROVIDER_BASE_URLS.get(provider)
+    endpoint = {} if base_url is None else {"base_url": base_url}
+    with _lock:
+        if (provider, api_key, base_url) not in _clients:
+            if provider == "Cohere":
+                _clients[(provider, api_key, base_url)] = cohere.Client(api_key = api_key, **endpoint)
+            elif provider == "LLaMA2":
+                _clients[(provider, api_key, base_url)] = replicate.Client(api_token = api_key, **endpoint)
+            else:
+                _clients[(provider, api_key, base_url)] = None
+        return _clients[(provider, api_key, base_url)]
+
+def openai_endpoint() -> dict:
+    # Extra request arguments that send GPT-3.5 requests to PROVIDER_BASE_URLS
+    base_url = PROVIDER_BASE_URLS.get("GPT-3.5")
+    return {} if base_url is None else {"api_base": base_url}
+
+def request_cost(provider: str, input_tokens: int, output_tokens: int) -> float:
+    # USD cost of a request at the provider's list prices
+    prices = PROVIDER_PRICES[provider]
+    return (input_tokens * prices["input"] + output_tokens * prices["output"]) / 1000
+
+def _usage(requests: int = 0, cached: int = 0, input_tokens: int = 0, output_tokens: int = 0, cost: float = 0.0) -> dict:
+    return {"requests": requests, "cached": cached, "input_tokens": input_tokens, "output_tokens": output_tokens, "cost": cost}
+
+def _account(provider: str, input_tokens: int, output_tokens: int, cached: bool = False) -> float:
+    # Charge a response to the provider's usage and to every meter open in
+    # the calling context (see metered). Cached responses are free.
+    cost = 0.0 if cached else request_cost(provider, input_tokens, output_tokens)
+    usage = _usage(1, int(cached), 0 if cached else input_tokens, 0 if cached else output_tokens, cost)
+    with _lock:
+        for totals in (_usage_stats.setdefault(provider, _usage()),) + _meters.get():
+            for stat, value in usage.items():
+                totals[stat] += value
+    return cost
+
+@contextlib.contextmanager
+def metered():
+    # Yields a dict totalling the requests, cached responses, billed tokens 
+    # and USD cost of the responses generated inside the block, including
+    # on threads started through trace_functions.in_context. Meters nest.
+    usage = _usage()
+    token = _meters.set(_meters.get() + (usage,))
+    try:
+        yield usage
+    finally:
+        _meters.reset(token)
+
+def usage_stats() -> dict:
+    """Returns per-provider counters for responses, cached responses, billed tokens and cost in USD."""
+    with _lock:
+        return {provider: dict(usage) for provider, usage in _usage_stats.items()}
+
+def reset_usage_stats():
+    with _lock:
+        _usage_stats.clear()
+
+def _record(provider: str, stat: str, value: float = 1):
+    with _lock:
+        stats = _rate_limit_stats.setdefault(provider, {"calls": 0, "throttled": 0, "retried": 0, "failed": 0, "stopped_early": 0, "wait_seconds": 0.0})
+        stats[stat] += value
+
+def _record_cache(stat: str, value: int = 1):
+    with _lock:
+        _cache_stats[stat] += value
+
+def rate_limit_stats() -> dict:
+    """Returns per-provider counters for calls, throttled calls, retries, failures, streams stopped early and time spent waiting."""
+    with _lock:
+        return {provider: dict(stats) for provider, stats in _rate_limit_stats.items()}
+
+def reset_rate_limit_stats():
+    with _lock:
+        _rate_limit_stats.clear()
+
+def _cache_connection() -> sqlite3.Connection:
+    # A short-lived connection per operation keeps the cache safe to use from
+    # worker threads; WAL lets readers proceed while another session writes.
+    if not os.path.exists(os.path.dirname(LLM_CACHE_PATH)):
+        os.makedirs(os.path.dirname(LLM_CACHE_PATH), exist_ok = True)
+    con = sqlite3.connect(LLM_CACHE_PATH, timeout = 30)
+    con.execute("PRAGMA journal_mode=WAL")
+    con.execute("""CREATE TABLE IF NOT EXISTS responses (
+                       key TEXT PRIMARY KEY, provider TEXT, model TEXT, temperature REAL,
+                       response TEXT, size INTEGER, created REAL, accessed REAL)""")
+    con.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+    return con
+
+def cache_key(provider: str, model: str, prompt: str, temperature: float, max_tokens: int) -> str:
+    # Whitespace differences (e.g. template indentation) do not change the key.
+    # max_tokens does: a reply cut short by it must not answer a longer request.
+    normalized_prompt = " ".join(prompt.split())
+    return hashlib.sha256(json.dumps([provider, model, normalized_prompt, temperature, max_tokens]).encode("utf-8")).hexdigest()
+
+def cache_get(key: str):
+    # Returns the cached response, or None on a miss or an expired entry.
+    now = time.time()
+    with closing(_cache_connection()) as con, con:
+        row = con.execute("SELECT response, created FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            _record_cache("misses")
+            return None
+        if now - row[1] > LLM_CACHE_TTL:
+            con.execute("DELETE FROM responses WHERE key = ?", (key,))
+            _record_cache("misses")
+            _record_cache("expired")
+            return None
+        con.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+    _record_cache("hits")
+    return row[0]
+
+def is_cached(provider: str, prompt: str, system: str = None, temperature: float = 0.0, json_mode: bool = False, 
+              stopped: bool = False, max_tokens: int = 1024) -> bool:
+    # Whether generate (or generate_stream, with stopped if it is given a 
+    # stop condition) would answer from the cache. Does not count as a 
+    # lookup in cache_stats.
+    model = PROVIDER_MODELS[provider] + (":json" if json_mode else "")
+    keys = [cache_key(provider, model, _cache_prompt(prompt, system), temperature, max_tokens)]
+    if stopped:
+        keys.append(cache_key(provider, model + ":stopped", _cache_prompt(prompt, system), temperature, max_tokens))
+    with closing(_cache_connection()) as con:
+        return con.execute("SELECT COUNT(*) FROM responses WHERE key IN ({}) AND created >= ?".format(", ".join("?" * len(keys))), 
+                           keys + [time.time() - LLM_CACHE_TTL]).fetchone()[0] > 0
+
+def _traced_cache_get(key: str):
+    with trf.span("cache_lookup") as attributes:
+        output = cache_get(key)
+        attributes["hit"] = output is not None
+        return output
+
+def cache_put(key: str, provider: str, model: str, temperature: float, response: str):
+    global _cache_writes
+    now = time.time()
+    size = len(response.encode("utf-8"))
+    with _lock:
+        _cache_writes += 1
+        check_size = _cache_writes % LLM_CACHE_EVICT_EVERY == 1
+    with closing(_cache_connection()) as con, con:
+        con.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (key, provider, model, temperature, response, size, now, now))
+
+        # Least recently used entries go first once the cache is over its size
+        # budget; the size is checked on the first write of every 
+        # LLM_CACHE_EVICT_EVERY.
+        total = con.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0] if check_size else 0
+        if total > LLM_CACHE_MAX_BYTES:
+            evicted = 0
+            for old_key, old_size in con.execute("SELECT key, size FROM responses ORDER BY accessed").fetchall():
+                if total <= LLM_CACHE_MAX_BYTES * 0.9:
+                    break
+                con.execute("DELETE FROM responses WHERE key = ?", (old_key,))
+                total -= old_size
+                evicted += 1
+            _record_cache("evicted", evicted)
+    _record_cache("writes")
+
+def cache_stats() -> dict:
+    """Returns hit/miss counters for the persistent LLM response cache."""
+    with _lock:
+        stats = dict(_cache_stats)
+    lookups = stats["hits"] + stats["misses"]
+    stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+    return stats
+
+def clear_cache():
+    with closing(_cache_connection()) as con, con:
+        con.execute("DELETE FROM responses")
+
+def backoff_delay(attempt: int) -> float:
+    # Exponential backoff with jitter: half the delay is fixed, half random.
+    delay = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+@functools.lru_cache(maxsize = None)
+def get_encoding(encoding_name: str):
+    # Loading an encoding parses its BPE ranks; do it once per process. 
+    # tiktoken downloads them on first use; a failed load raises and is 
+    # not cached, so the next call tries again.
+    return tiktoken.get_encoding(encoding_name)
+
+def truncate_to_tokens(string: str, max_tokens: int, encoding_name: str = "cl100k_base") -> str:
+    # string cut to at most max_tokens tokens, marked with "..." when cut
+    encoding = get_encoding(encoding_name)
+    tokens = encoding.encode(string)
+    if len(tokens) <= max_tokens:
+        return string
+    return encoding.decode(tokens[:max(max_tokens - 1, 0)]).rstrip() + "..."
+
+def num_tokens_from_string(string: str, encoding_name: str) -> int:
+    """Returns the number of tokens in a text string."""
+    encoding = get_encoding(encoding_name)
+    num_tokens = len(encoding.encode(string))
+    return num_tokens
+
+def response_format(provider: str, json_mode: bool) -> dict:
+    # Extra request arguments that enable JSON mode
+    if json_mode and provider == "GPT-3.5":
+        return {"response_format": {"type": "json_object"}}
+    return {}
+
+def _provider_error(provider: str, e: Exception):
+    # RateLimitError / ServiceUnavailableError for a provider exception that
+    # signals throttling or a transient outage, None for anything else.
+    if provider == "GPT-3.5":
+        if isinstance(e, openai.error.RateLimitError):
+            return RateLimitError(str(e))
+        if isinstance(e, (openai.error.ServiceUnavailableError, openai.error.APIError, openai.error.Timeout)):
+            return ServiceUnavailableError(str(e))
+        return None
+
+    if provider == "Cohere":
+        # cohere 5+ errors carry status_code, older ones http_status
+        status = getattr(e, "status_code", None) or getattr(e, "http_status", None)
+    else:
+        status = getattr(e, "status", None)
+    if status == 429 or (provider == "Cohere" and "You are using a Trial key" in str(e)):
+        return RateLimitError(str(e))
+    if (status or 0) >= 500:
+        return ServiceUnavailableError(str(e))
+    return None
+
+def provider_messages(provider: str, prompt: str, system: str = None):
+    # The request payload for a prompt with an optional system message: chat
+    # messages for GPT-3.5, the model input for LLaMA2, and for Cohere, whose
+    # generate endpoint has no system role, the prompt text.
+    if provider == "GPT-3.5":
+        return ([{"role": "system", "content": system}] if system else []) + [{"role": "user", "content": prompt}]
+    if provider == "LLaMA2":
+        return dict({"prompt": prompt}, **({"system_prompt": system} if system else {}))
+    return system + "\n\n" + prompt if system else prompt
+
+def _billed_tokens(usage: dict, input_tokens, output_tokens):
+    # Store the token counts a provider reported in usage, if both are known
+    if usage is not None and input_tokens is not None and output_tokens is not None:
+        usage.update(input_tokens = int(input_tokens), output_tokens = int(output_tokens))
+
+def call_provider(provider: str, prompt: str, api_key: str, max_tokens: int, temperature: float, json_mode: bool = False, 
+                  system: str = None, usage: dict = None) -> str:
+    # Single request to the provider. Throttling and transient outages are
+    # raised as RateLimitError / ServiceUnavailableError so they can be retried.
+    # json_mode constrains the reply to a JSON object where the provider 
+    # supports it (GPT-3.5); elsewhere the prompt has to ask for JSON. 
+    # system is sent as the system message where the provider has one.
+    # The billed input and output tokens are stored in usage where the
+    # provider reports them (Cohere, GPT-3.5).
+    try:
+        if provider == "Cohere":
+            model = get_client(provider, api_key)
+            output = model.generate(prompt = provider_messages(provider, prompt, system),
+                                    model = PROVIDER_MODELS[provider],
+                                    max_tokens = max_tokens,
+                                    temperature = temperature)
+
+            billed = getattr(getattr(output, "meta", None), "billed_units", None)
+            _billed_tokens(usage, getattr(billed, "input_tokens", None), getattr(billed, "output_tokens", None))
+            output = output.generations[0].text
+
+            if "," in output[-3:]:
+                output = output[:output.rfind(",")] + output[-1:]
+
+            return output
+        elif provider == "LLaMA2":
+            client = get_client(provider, api_key)
+            query = client.run(PROVIDER_MODELS[provider], input=dict(provider_messages(provider, prompt, system), max_new_tokens=max_tokens))
+
+            output = ""
+            for item in query:
+                output = output + item
+
+            return output
+        elif provider == "GPT-3.5":
+            output = openai.ChatCompletion.create(
+                api_key=api_key,
+                model=PROVIDER_MODELS[provider],
+                messages=provider_messages(provider, prompt, system),
+                max_tokens=max_tokens,
+                temperature=temperature,
+                **response_format(provider, json_mode),
+                **openai_endpoint()
+            )
+
+            billed = output.get('usage') or {}
+            _billed_tokens(usage, billed.get('prompt_tokens'), billed.get('completion_tokens'))
+            return output['choices'][0]['message']['content']
+    except Exception as e:
+        error = _provider_error(provider, e)
+        if error is not None:
+            raise error from e
+        raise
+    raise ValueError("Unknown LLM provider: {}".format(provider))
+
+def _field(item, name: str):
+    # Attribute of an SDK object, or key of a plain dict
+    if isinstance(item, dict):
+        return item.get(name)
+    return getattr(item, name, None)
+
+def stream_provider(provider: str, prompt: str, api_key: str, max_tokens: int, temperature: float, json_mode: bool = False, 
+                    system: str = None, usage: dict = None):
+    # Single streaming request: yields the response text piece by piece as
+    # the provider produces it. Closing the generator abandons the request,
+    # which stops generation on the provider's side. The billed input and
+    # output tokens are stored in usage from the final event of a complete
+    # stream, where the provider reports them (Cohere, GPT-3.5).
+    try:
+        if provider == "Cohere":
+            client = get_client(provider, api_key)
+            if hasattr(client, "generate_stream"):
+                events = client.generate_stream(prompt = provider_messages(provider, prompt, system), model = PROVIDER_MODELS[provider], 
+                                                max_tokens = max_tokens, temperature = temperature)
+            else:
+                events = client.generate(prompt = provider_messages(provider, prompt, system), model = PROVIDER_MODELS[provider], 
+                                         max_tokens = max_tokens, temperature = temperature, stream = True)
+            for event in events:
+                if getattr(event, "text", None):
+                    yield event.text
+                billed = _field(_field(_field(event, "response"), "meta"), "billed_units")
+                if billed is not None:
+                    _billed_tokens(usage, _field(billed, "input_tokens"), _field(billed, "output_tokens"))
+        elif provider == "LLaMA2":
+            client = get_client(provider, api_key)
+            for item in client.run(PROVIDER_MODELS[provider], input=dict(provider_messages(provider, prompt, system), max_new_tokens=max_tokens)):
+                yield item
+        elif provider == "GPT-3.5":
+            for chunk in openai.ChatCompletion.create(api_key=api_key, 
+                                                      model=PROVIDER_MODELS[provider], 
+                                                      messages=provider_messages(provider, prompt, system), 
+                                                      max_tokens=max_tokens, 
+                                                      temperature=temperature, 
+                                                      stream=True, 
+                                                      stream_options={"include_usage": True}, 
+                                                      **response_format(provider, json_mode), 
+                                                      **openai_endpoint()):
+                # The usage comes last, in a chunk without choices
+                billed = chunk.get('usage') or {}
+                _billed_tokens(usage, billed.get('prompt_tokens'), billed.get('completion_tokens'))
+                if not chunk['choices']:
+                    continue
+                text = chunk['choices'][0]['delta'].get('content')
+                if text:
+                    yield text
+        else:
+            raise ValueError("Unknown LLM provider: {}".format(provider))
+    except Exception as e:
+        error = _provider_error(provider, e)
+        if error is not None:
+            raise error from e
+        raise
+
+def _cache_prompt(prompt: str, system: str = None) -> str:
+    # Everything sent to the model, for cache keys and token estimates
+    return system + "\n\n" + prompt if system else prompt
+
+def _paced_request(provider: str, tokens: int, request):
+    # Run request() paced by the provider's rate limiter. Throttled or
+    # unavailable responses are retried with exponential backoff; the last
+    # error is raised once MAX_RETRIES is exhausted.
+    limiter = get_rate_limiter(provider)
+
+    for attempt in range(MAX_RETRIES + 1):
+        wait = limiter.acquire(tokens)
+        _record(provider, "calls")
+        if wait > 0:
+            _record(provider, "throttled")
+            _record(provider, "wait_seconds", wait)
+            trf.record_span("rate_limit_wait", wait, provider = provider)
+
+        try:
+            with trf.span("provider_call", provider = provider, attempt = attempt):
+                return request()
+        except (RateLimitError, ServiceUnavailableError) as e:
+            if isinstance(e, RateLimitError):
+                limiter.penalize()
+            if attempt == MAX_RETRIES:
+                _record(provider, "failed")
+                raise
+            _record(provider, "retried")
+            delay = backoff_delay(attempt)
+            _record(provider, "wait_seconds", delay)
+            with trf.span("retry_backoff", provider = provider, attempt = attempt, error = type(e).__name__):
+                time.sleep(delay)
+
+def _charge(provider: str, prompt_tokens: int, output: str, billed: dict, attributes: dict):
+    # Account for a response, in the tokens the provider billed or, where it
+    # does not report them (Replicate, streams stopped early), in counted 
+    # tokens
+    if not billed:
+        billed = {"input_tokens": prompt_tokens, "output_tokens": num_tokens_from_string(output, "cl100k_base")}
+    cost = _account(provider, billed["input_tokens"], billed["output_tokens"])
+    attributes.update(tokens_in = billed["input_tokens"], tokens_out = billed["output_tokens"], cost = cost)
+
+def generate(provider: str, prompt: str, api_key: str, max_tokens: int = 1024, temperature: float = 0.0, use_cache: bool = True, 
+             json_mode: bool = False, system: str = None) -> str:
+    # Send a prompt to a provider, paced by its rate limiter and retried on
+    # throttling (see _paced_request). Successful responses are stored in 
+    # the persistent cache; use_cache = False forces a fresh query and 
+    # overwrites the cached entry.
+    with trf.span("llm_request", provider = provider, stream = False) as attributes:
+        key = cache_key(provider, PROVIDER_MODELS[provider] + (":json" if json_mode else ""), _cache_prompt(prompt, system), temperature, max_tokens)
+        if use_cache:
+            output = _traced_cache_get(key)
+            if output is not None:
+                attributes["cache_hit"] = True
+                _account(provider, 0, 0, cached = True)
+                return output
+
+        prompt_tokens = num_tokens_from_string(_cache_prompt(prompt, system), "cl100k_base")
+        billed = {}
+        output = _paced_request(provider, prompt_tokens + max_tokens, 
+                                lambda: call_provider(provider, prompt, api_key, max_tokens, temperature, json_mode, system, billed))
+        cache_put(key, provider, PROVIDER_MODELS[provider], temperature, output)
+        _charge(provider, prompt_tokens, output, billed, attributes)
+        return output
+
+def generate_stream(provider: str, prompt: str, api_key: str, max_tokens: int = 1024, temperature: float = 0.0, 
+                    use_cache: bool = True, on_text = None, stop = None, json_mode: bool = False, system: str = None) -> str:
+    # Like generate, but streams the response: on_text(text so far) is 
+    # called as pieces arrive, and generation is abandoned as soon as 
+    # stop(text so far) is true. Responses cut short by stop are cached 
+    # separately from complete ones, which also serve stopped requests.
+    with trf.span("llm_request", provider = provider, stream = True) as attributes:
+        model = PROVIDER_MODELS[provider] + (":json" if json_mode else "")
+        full_key = cache_key(provider, model, _cache_prompt(prompt, system), temperature, max_tokens)
+        stopped_key = cache_key(provider, model + ":stopped", _cache_prompt(prompt, system), temperature, max_tokens)
+        if use_cache:
+            for key in [full_key] if stop is None else [full_key, stopped_key]:
+                output = _traced_cache_get(key)
+                if output is not None:
+                    attributes["cache_hit"] = True
+                    _account(provider, 0, 0, cached = True)
+                    if on_text is not None:
+                        on_text(output)
+                    return output
+
+        billed = {}
+
+        def request():
+            output = ""
+            billed.clear()
+            started = time.perf_counter()
+            stream = stream_provider(provider, prompt, api_key, max_tokens, temperature, json_mode, system, billed)
+            try:
+                for piece in stream:
+                    if output == "":
+                        attributes["first_token_seconds"] = time.perf_counter() - started
+                    output += piece
+                    if on_text is not None:
+                        on_text(output)
+                    if stop is not None and stop(output):
+                        return output, True
+            finally:
+                stream.close()
+            return output, False
+
+        prompt_tokens = num_tokens_from_string(_cache_prompt(prompt, system), "cl100k_base")
+        output, stopped = _paced_request(provider, prompt_tokens + max_tokens, request)
+        if stopped:
+            _record(provider, "stopped_early")
+        cache_put(stopped_key if stopped else full_key, provider, PROVIDER_MODELS[provider], temperature, output)
+        attributes["stopped_early"] = stopped
+        _charge(provider, prompt_tokens, output, billed, attributes)
+        return output
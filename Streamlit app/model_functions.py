@@ -0,0 +1,125 @@
+import pandas as pd
+import numpy as np
+import os
+import re
+
+from joblib import dump, load
+from sklearn.pipeline import Pipeline
+from sklearn.preprocessing import MinMaxScaler
+from sklearn.impute import KNNImputer
+
+import dataset_functions as dsf
+
+# Classifiers trained in Models.ipynb, saved with save_classifier as
+# <cert prefix>_<kind>_model_weights.pkl (e.g. tco_logit_model_weights.pkl):
+# one pipeline of the MinMaxScaler + KNNImputer preprocessing fitted on the
+# training features and the fitted classifier. Nothing is fitted at scoring
+# time, so a product's score does not depend on the dataset or batch it is
+# scored in.
+MODELS_DIR = "./Models"
+CERT_PREFIXES = {"Energy Star": "es", "TCO": "tco"}
+CLASSIFIER_KINDS = {"logit": "Logit", "svm": "SVM", "knn": "KNN", "rf": "Random Forest", "xgb": "XGBoost", "ada": "AdaBoost"}
+
+KNN_NEIGHBORS = 5
+
+# Label of the certified class in the training data
+POSITIVE_CLASS = 1
+
+def classifier_path(cert: str, kind: str) -> str:
+    return MODELS_DIR + "/" + CERT_PREFIXES[cert] + "_" + kind + "_model_weights.pkl"
+
+def available_classifiers(cert: str) -> list:
+    # Kinds of the classifiers saved for cert as pipelines, e.g. 
+    # ["logit", "svm"]. Bare estimators (without their preprocessing) are
+    # not offered.
+    if not os.path.exists(MODELS_DIR) or cert not in CERT_PREFIXES:
+        return []
+    pattern = re.compile("^" + CERT_PREFIXES[cert] + "_(.+)_model_weights\\.pkl$")
+    kinds = sorted(m.group(1) for m in map(pattern.match, os.listdir(MODELS_DIR)) if m is not None)
+    return [kind for kind in kinds if isinstance(dsf.cached_load(classifier_path(cert, kind), _load), Pipeline)]
+
+def make_preprocessor() -> Pipeline:
+    # Unfitted preprocessing for save_classifier. It keeps DataFrame output
+    # so the classifier is fitted on named features.
+    preprocessor = Pipeline([("scale", MinMaxScaler()), ("impute", KNNImputer(n_neighbors = KNN_NEIGHBORS, keep_empty_features = True))])
+    return preprocessor.set_output(transform = "pandas")
+
+def save_classifier(cert: str, kind: str, classifier, preprocessor):
+    # Save a classifier with the preprocessing fitted on its training 
+    # features (see make_preprocessor), as one pipeline. The preprocessing
+    # must be fitted on a DataFrame so the feature columns are known.
+    if not hasattr(preprocessor, "feature_names_in_"):
+        raise ValueError("The preprocessing was not fitted on a DataFrame, its feature columns are unknown.")
+    if POSITIVE_CLASS not in list(classifier.classes_):
+        raise ValueError("The classifier's classes {} do not include the certified label {}.".format(list(classifier.classes_), POSITIVE_CLASS))
+    os.makedirs(MODELS_DIR, exist_ok = True)
+    dump(Pipeline([("preprocess", preprocessor), ("classify", classifier)]), classifier_path(cert, kind))
+
+def _load(file_path: str):
+    return load(file_path)
+
+def load_classifier(cert: str, kind: str) -> Pipeline:
+    # Unpickled once and shared until the file changes. Raises ValueError
+    # for files that are not a pipeline saved with save_classifier.
+    path = classifier_path(cert, kind)
+    classifier = dsf.cached_load(path, _load)
+    if not isinstance(classifier, Pipeline) or not hasattr(classifier, "feature_names_in_"):
+        raise ValueError("{} is not a classifier saved with its preprocessing; save it with save_classifier.".format(path))
+    return classifier
+
+def positive_class_index(model, cert: str, kind: str) -> int:
+    # Column of the certified class in predict_proba
+    classes = list(model.classes_)
+    if POSITIVE_CLASS not in classes:
+        raise ValueError("{} has classes {}, not the certified label {}.".format(classifier_path(cert, kind), classes, POSITIVE_CLASS))
+    return classes.index(POSITIVE_CLASS)
+
+def feature_matrix(products: pd.DataFrame, features: list) -> pd.DataFrame:
+    # Classifier features as numbers; missing columns and values that are
+    # not numbers are left for the imputer.
+    X = pd.DataFrame(index = products.index)
+    for col in features:
+        if col in products.columns:
+            X[col] = pd.to_numeric(products[col].replace({True: 1, False: 0}), errors = "coerce")
+        else:
+            X[col] = np.nan
+    return X.astype(float)
+
+def score_products(products: pd.DataFrame, cert: str, kind: str) -> pd.DataFrame:
+    # Certification prediction for every product. score is the predicted
+    # probability of certification, or the decision function for
+    # classifiers without probabilities (SVM).
+    model = load_classifier(cert, kind)
+    features = list(model.feature_names_in_)
+    X = feature_matrix(products, features)
+
+    positive = positive_class_index(model, cert, kind)
+    if hasattr(model, "predict_proba"):
+        score = model.predict_proba(X)[:, positive]
+    else:
+        # Binary decision functions are positive for classes_[1]
+        score = model.decision_function(X) * (1 if positive == 1 else -1)
+
+    return pd.DataFrame({"id": products["id"].to_numpy(),
+                         "name": products["name"].to_numpy(),
+                         "cert": cert,
+                         "model": CLASSIFIER_KINDS.get(kind, kind),
+                         "prediction": model.predict(X) == POSITIVE_CLASS,
+                         "score": score})
+
+def classifier_columns(dataset_path: str, cert: str, kind: str) -> list:
+    # Dataset columns needed to score with a classifier: id, name and the
+    # features present in the dataset.
+    features = list(load_classifier(cert, kind).feature_names_in_)
+    available = set(dsf.dataset_columns(dataset_path))
+    return ["id", "name"] + [col for col in features if col in available and col not in ["id", "name"]]
+
+def score_dataset_rows(dataset_path: str, rows: list, cert: str, kind: str) -> pd.DataFrame:
+    products = dsf.load_products(dataset_path, rows, classifier_columns(dataset_path, cert, kind))
+    return score_products(products, cert, kind)
+
+def score_dataset(dataset_path: str, cert: str, kind: str, chunk_size: int = 10000):
+    # Score a whole dataset in chunks, reading only the columns the 
+    # classifier needs. Yields one DataFrame of scores per chunk.
+    for chunk in dsf.iter_product_chunks(dataset_path, chunk_size, classifier_columns(dataset_path, cert, kind)):
+        yield score_products(chunk, cert, kind)
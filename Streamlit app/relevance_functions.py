@@ -0,0 +1,103 @@
+import pandas as pd
+import numpy as np
+import os
+
+from sklearn.feature_extraction.text import TfidfVectorizer
+
+import dataset_functions as dsf
+
+# Which dataset columns bear on each certification mandate, as read by
+# cef.load_mandate_relevance. Mandates (title and description) and the
+# approved columns of a data dictionary (name, unit and definition) are
+# embedded as TF-IDF vectors over one vocabulary, and all mandate x column
+# cosine similarities come out of a single sparse matrix product. Each
+# mandate keeps its RELEVANCE_TOP_COLUMNS most similar columns scoring at
+# least RELEVANCE_MIN_SCORE, best first.
+RELEVANCE_TOP_COLUMNS = 25
+RELEVANCE_MIN_SCORE = 0.05
+RELEVANCE_COLUMNS = ["Certification", "Mandate Number", "Column Name Raw", "Column Name", "Relevance"]
+
+# Columns identifying the product rather than describing it; the ".unit"
+# twins of the ranked columns come along with them.
+RELEVANCE_EXCLUDED_COLUMNS = dsf.PRODUCT_BASE_COLUMNS + ["level_0", "index"]
+
+# A column's name counts this many times in its text, so a column named
+# after a mandate's subject ranks above one merely mentioning it.
+COLUMN_NAME_WEIGHT = 3
+
+def mandate_texts(mandates_df: pd.DataFrame) -> pd.Series:
+    return mandates_df["Mandate title"].fillna("").astype(str) + ". " + mandates_df["Mandate Description"].fillna("").astype(str)
+
+def ranked_columns(data_dictionary: pd.DataFrame) -> pd.DataFrame:
+    # The approved attribute columns of a data dictionary
+    raw_names = data_dictionary["Column Name Raw"].astype(str)
+    keep = (data_dictionary["Approved"].astype(str).str.lower() == "true") & ~raw_names.str.endswith(".unit") & ~raw_names.isin(RELEVANCE_EXCLUDED_COLUMNS)
+    return data_dictionary[keep].reset_index(drop = True)
+
+def column_texts(columns: pd.DataFrame) -> pd.Series:
+    names = columns["Column Name"].fillna("").astype(str) + ". "
+    return names * COLUMN_NAME_WEIGHT + columns["Column Unit"].fillna("").astype(str) + ". " + columns["Column Definition"].fillna("").astype(str)
+
+def _embed(dictionary_path: str, mandates_path: str, mandates_modified: float) -> dict:
+    # Mandates, ranked columns and their L2-normalized TF-IDF matrices
+    mandates_df = pd.read_csv(mandates_path)
+    columns = ranked_columns(pd.read_csv(dictionary_path))
+    texts = pd.concat([mandate_texts(mandates_df), column_texts(columns)], ignore_index = True)
+
+    vectorizer = TfidfVectorizer(stop_words = "english", sublinear_tf = True, ngram_range = (1, 2))
+    matrix = vectorizer.fit_transform(texts).tocsr()
+    return {"mandates": mandates_df,
+            "columns": columns,
+            "mandate_matrix": matrix[:mandates_df.shape[0]],
+            "column_matrix": matrix[mandates_df.shape[0]:]}
+
+def load_embeddings(mandates_path: str, dictionary_path: str) -> dict:
+    # Computed once and shared until either file changes
+    return dsf.cached_load(dictionary_path, _embed, mandates_path, os.path.getmtime(mandates_path))
+
+def rank_mandate_columns(mandates_path: str, dictionary_path: str, top_k: int = RELEVANCE_TOP_COLUMNS,
+                         min_score: float = RELEVANCE_MIN_SCORE) -> pd.DataFrame:
+    # One row per (mandate, relevant column), mandates in file order and
+    # each mandate's columns from most to least similar.
+    embeddings = load_embeddings(mandates_path, dictionary_path)
+    mandates_df, columns = embeddings["mandates"], embeddings["columns"]
+    if columns.empty:
+        return pd.DataFrame([], columns = RELEVANCE_COLUMNS)
+
+    similarity = (embeddings["mandate_matrix"] @ embeddings["column_matrix"].T).toarray()
+
+    # Only the top_k columns of each mandate are sorted
+    top_k = min(top_k, similarity.shape[1])
+    top = np.argpartition(-similarity, top_k - 1, axis = 1)[:, :top_k]
+    top = np.take_along_axis(top, np.argsort(-np.take_along_axis(similarity, top, axis = 1), axis = 1, kind = "stable"), axis = 1)
+    scores = np.take_along_axis(similarity, top, axis = 1)
+
+    mandate_rows, ranks = np.nonzero(scores >= min_score)
+    column_rows = top[mandate_rows, ranks]
+    return pd.DataFrame({"Certification": mandates_df["Certification"].to_numpy()[mandate_rows],
+                         "Mandate Number": mandates_df["Mandate Number"].to_numpy()[mandate_rows],
+                         "Column Name Raw": columns["Column Name Raw"].to_numpy()[column_rows],
+                         "Column Name": columns["Column Name"].to_numpy()[column_rows],
+                         "Relevance": scores[mandate_rows, ranks].round(4)}, columns = RELEVANCE_COLUMNS)
+
+def write_mandate_relevance(relevance_path: str, mandates_path: str, dictionary_path: str):
+    relevance = rank_mandate_columns(mandates_path, dictionary_path)
+    os.makedirs(os.path.dirname(relevance_path), exist_ok = True)
+    with dsf.replacing(relevance_path) as temp_path:
+        relevance.to_csv(temp_path, index = False)
+
+def ensure_mandate_relevance(relevance_path: str, mandates_path: str, dictionary_path: str) -> str:
+    # Path of the relevance file, ranked from the data dictionary if it is
+    # missing, or if it was ranked here (it has a Relevance column) and is
+    # older than the dictionary or the mandates. A relevance file made
+    # elsewhere is left as it is.
+    if not os.path.exists(dictionary_path):
+        return relevance_path
+    if os.path.exists(relevance_path):
+        if "Relevance" not in pd.read_csv(relevance_path, nrows = 0).columns:
+            return relevance_path
+        modified = os.path.getmtime(relevance_path)
+        if modified >= os.path.getmtime(dictionary_path) and modified >= os.path.getmtime(mandates_path):
+            return relevance_path
+    write_mandate_relevance(relevance_path, mandates_path, dictionary_path)
+    return relevance_path
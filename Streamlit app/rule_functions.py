@@ -0,0 +1,105 @@
+import pandas as pd
+import numpy as np
+import os
+
+import dataset_functions as dsf
+
+# Mandates that are plain thresholds on product attributes are decided by
+# rules instead of an LLM. Each row of the rules file is one predicate:
+#     Certification, Mandate Number, Column Name Raw, Operator, Value, Unit
+# A mandate with several rows passes only if all of them pass.
+RULES_PATH = "./Product Certification/certification_mandate_rules.csv"
+
+# Operators on numbers; "present" only requires the attribute to be reported.
+RULE_OPERATORS = {">=": np.greater_equal, ">": np.greater, "<=": np.less_equal, "<": np.less,
+                  "==": np.equal, "!=": np.not_equal}
+
+# unit: (base unit, factor to the base unit). Values are converted to the
+# rule's unit through the common base unit; units missing here cannot be
+# compared, so the rule is left undecided.
+UNIT_CONVERSIONS = {"g": ("g", 1), "kg": ("g", 1000), "lbs": ("g", 453.59237), "oz": ("g", 28.349523125),
+                    "mm": ("m", 0.001), "cm": ("m", 0.01), "m": ("m", 1), "\"": ("m", 0.0254), "in": ("m", 0.0254),
+                    "ppi": ("ppi", 1),
+                    "cd/m²": ("cd/m²", 1), "cd/m2": ("cd/m²", 1), "nit": ("cd/m²", 1), "nits": ("cd/m²", 1),
+                    "W": ("W", 1), "kW": ("W", 1000), "Wh": ("Wh", 1),
+                    "s": ("s", 1), "ms": ("s", 0.001), "min": ("s", 60), "h": ("s", 3600),
+                    "MB": ("B", 1000 ** 2), "GB": ("B", 1000 ** 3), "TB": ("B", 1000 ** 4),
+                    "°C": ("°C", 1)}
+
+def _read_rules(file_path: str) -> pd.DataFrame:
+    rules = pd.read_csv(file_path, dtype = {"Mandate Number": str, "Value": str, "Unit": str})
+    rules["Operator"] = rules["Operator"].str.strip()
+    return rules
+
+def load_mandate_rules(file_path: str = RULES_PATH) -> pd.DataFrame:
+    # The rules table, shared until the file changes. Without a rules file
+    # every mandate goes to the LLM.
+    if not os.path.exists(file_path):
+        return pd.DataFrame([], columns = ["Certification", "Mandate Number", "Column Name Raw", "Operator", "Value", "Unit"])
+    return dsf.cached_load(file_path, _read_rules)
+
+def rule_columns(rules: pd.DataFrame) -> list:
+    return list(pd.unique(rules["Column Name Raw"].dropna()))
+
+def unit_factors(units: pd.Series, target_unit: str) -> np.ndarray:
+    # Factor converting values in units to target_unit; NaN where the
+    # conversion is unknown. A missing unit is taken to be target_unit.
+    if pd.isna(target_unit):
+        return np.ones(len(units))
+    target_base, target_factor = UNIT_CONVERSIONS.get(target_unit, (target_unit, 1))
+    factors = {unit: factor / target_factor for unit, (base, factor) in UNIT_CONVERSIONS.items() if base == target_base}
+    factors[target_unit] = 1.0
+    return units.map(factors).where(units.notna(), 1.0).to_numpy(dtype = float)
+
+def evaluate_rule(products: pd.DataFrame, rule: pd.Series):
+    # Evaluate one predicate for every product. Returns (decided, passed,
+    # text): a product is undecided when the attribute is missing, not a
+    # number, or in a unit that cannot be converted.
+    col = rule["Column Name Raw"]
+    target_unit = rule["Unit"]
+    n = products.shape[0]
+    if col not in products.columns:
+        return np.zeros(n, dtype = bool), np.zeros(n, dtype = bool), np.full(n, "", dtype = object)
+
+    raw = products[col]
+    if col + ".unit" in products.columns:
+        units = products[col + ".unit"]
+    else:
+        units = pd.Series(np.nan, index = products.index, dtype = object)
+    unit_text = np.where(units.notna(), " " + units.to_numpy(dtype = object).astype(str).astype(object), "")
+    text = col.rsplit(".", 1)[0] + ": " + raw.to_numpy(dtype = object).astype(str).astype(object) + unit_text
+
+    if rule["Operator"] == "present":
+        decided = np.ones(n, dtype = bool)
+        passed = raw.notna().to_numpy()
+        return decided, passed, text + np.where(passed, " (reported)", " (not reported)")
+
+    value = float(rule["Value"])
+    values = pd.to_numeric(raw, errors = "coerce").to_numpy(dtype = float) * unit_factors(units, target_unit)
+    decided = ~np.isnan(values)
+    with np.errstate(invalid = "ignore"):
+        passed = decided & RULE_OPERATORS[rule["Operator"]](values, value)
+
+    target_text = " {} {}{}".format(rule["Operator"], rule["Value"], "" if pd.isna(target_unit) else " " + target_unit)
+    return decided, passed, text + target_text + np.where(passed, ": passed", ": failed")
+
+def evaluate_mandate_rules(products: pd.DataFrame, rules: pd.DataFrame) -> dict:
+    # {(Certification, Mandate Number): (decisions, explanations)} for every
+    # mandate with rules. decisions holds "True"/"False" per product, or None
+    # when the rules cannot decide and the LLM has to be asked. A single
+    # failed predicate fails the mandate even if others are undecided.
+    results = {}
+    for (cert, number), mandate_rules in rules.groupby(["Certification", "Mandate Number"], sort = False):
+        n = products.shape[0]
+        all_decided = np.ones(n, dtype = bool)
+        any_failed = np.zeros(n, dtype = bool)
+        explanations = np.full(n, "", dtype = object)
+        for _, rule in mandate_rules.iterrows():
+            decided, passed, text = evaluate_rule(products, rule)
+            all_decided &= decided
+            any_failed |= decided & ~passed
+            explanations = explanations + text + "\n"
+
+        decisions = np.where(any_failed, "False", np.where(all_decided, "True", None))
+        results[(cert, str(number))] = (decisions, explanations)
+    return results
@@ -0,0 +1,68 @@
+import json
+import time
+
+import pytest
+
+import cert_eval_functions as cef
+import llm_functions as llm
+
+def fake_estimate(group_jobs, reasoning = True):
+    return llm.request_cost("Cohere", group_jobs[0]["tokens"], cef.ESTIMATED_REPLY_TOKENS)
+
+def fake_evaluate(group_jobs, LLM_token, reasoning = True, on_text = None):
+    # A response a little cheaper than estimated, as replies usually are
+    time.sleep(0.01)
+    llm._account("Cohere", group_jobs[0]["tokens"], cef.ESTIMATED_REPLY_TOKENS // 2)
+    verdict = {"recommendation": "True", "confidence": 0.9, "reasoning": "", "cited_attributes": []}
+    return [("", json.dumps(verdict), "True", verdict) for _ in group_jobs]
+
+def budget_jobs(monkeypatch, limit: float) -> tuple:
+    monkeypatch.setattr(cef, "estimate_unit_cost", fake_estimate)
+    monkeypatch.setattr(cef, "evaluate_mandate_group", fake_evaluate)
+    budget = cef.Budget(limit)
+    return [{"model": "Cohere", "rule": None, "budget": budget, "tokens": 300 + 37 * (i % 9)} for i in range(26)], budget
+
+def skipped_jobs(monkeypatch, concurrency: int, limit: float) -> tuple:
+    jobs, budget = budget_jobs(monkeypatch, limit)
+    results = dict(cef.evaluate_mandate_jobs(jobs, {"Cohere": ""}, provider_concurrency = {"Cohere": concurrency}))
+    return sorted(i for i, result in results.items() if cef.is_skipped(result)), budget
+
+def test_same_mandates_skipped_whatever_the_concurrency(monkeypatch):
+    sequential, sequential_budget = skipped_jobs(monkeypatch, 1, 0.0015)
+    concurrent, concurrent_budget = skipped_jobs(monkeypatch, 8, 0.0015)
+    assert 0 < len(sequential) < 26
+    assert concurrent == sequential
+    assert concurrent_budget.spent == pytest.approx(sequential_budget.spent)
+    assert sequential_budget.spent <= 0.0015
+
+def test_cached_responses_are_never_refused():
+    budget = cef.Budget(0.001)
+    assert budget.reserve(0.001)
+    assert budget.reserve(0.0)
+    assert budget.reserve(0.0005, block = False) is None
+    budget.settle(0.001, 0.001)
+    budget.settle(0.0, 0.0)
+    assert budget.reserve(0.0005) is False
+
+def test_product_budget_draws_on_parent():
+    dataset = cef.Budget(0.002)
+    product = cef.Budget(0.0015, dataset)
+    other = cef.Budget(0.0015, dataset)
+    assert product.reserve(0.0015)
+    product.settle(0.0015, 0.0015)
+    assert other.reserve(0.001) is False
+    assert other.reserve(0.0005)
+    assert dataset.refused == 1
+
+def test_stopping_early_gives_back_unstarted_reservations(monkeypatch):
+    jobs, budget = budget_jobs(monkeypatch, 1.0)
+    evaluation = cef.evaluate_mandate_jobs(jobs, {"Cohere": ""}, provider_concurrency = {"Cohere": 1})
+    next(evaluation)
+    assert budget.reserved > 0
+    evaluation.close()
+    # The unit still running settles its own reservation
+    deadline = time.monotonic() + 5
+    while budget.in_flight and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert budget.in_flight == 0
+    assert budget.reserved == pytest.approx(0.0)
@@ -0,0 +1,50 @@
+import cert_eval_functions as cef
+
+# Verdict of each model for each job: (recommendation, confidence)
+ANSWERS = [{"GPT-3.5": ("True", 0.9)},
+           {"GPT-3.5": ("N/A", 0.9), "LLaMA2": ("False", 0.8)},
+           {"GPT-3.5": ("True", 0.4), "LLaMA2": ("False", 0.5), "Cohere": ("False", 0.6)}]
+
+def fake_evaluate(group_jobs, LLM_token, reasoning = True, on_text = None):
+    results = []
+    for job in group_jobs:
+        job["asked"].append(job["model"])
+        recommendation, confidence = ANSWERS[job["n"]][job["model"]]
+        verdict = {"recommendation": recommendation, "confidence": confidence, "reasoning": "", "cited_attributes": []}
+        results.append(("", "{}", recommendation, verdict))
+    return results
+
+def cascade(monkeypatch) -> tuple:
+    monkeypatch.setattr(cef, "evaluate_mandate_group", fake_evaluate)
+    monkeypatch.setattr(cef, "job_fingerprint", lambda job: job["model"])
+    tiers = cef.cascade_tiers(["Cohere", "GPT-3.5", "LLaMA2"])
+    asked = [[] for _ in ANSWERS]
+    jobs = [{"model": tiers[0], "rule": None, "n": n, "asked": asked[n]} for n in range(len(ANSWERS))]
+    results = dict(cef.evaluate_cascade(jobs, {model: "" for model in tiers}, tiers))
+    return jobs, results, asked
+
+def test_tiers_go_from_cheapest_to_dearest():
+    assert cef.cascade_tiers(["Cohere", "Other", "LLaMA2", "GPT-3.5"]) == ["GPT-3.5", "LLaMA2", "Cohere", "Other"]
+
+def test_uncertain_verdicts_are_escalated(monkeypatch):
+    jobs, results, asked = cascade(monkeypatch)
+    assert asked[1] == ["GPT-3.5", "LLaMA2"]
+    assert jobs[1]["model"] == "LLaMA2" and results[1][2] == "False"
+    # The last tier decides whatever its confidence
+    assert asked[2] == ["GPT-3.5", "LLaMA2", "Cohere"]
+    assert jobs[2]["model"] == "Cohere" and results[2][3]["confidence"] == 0.6
+
+def test_confident_verdicts_stop_the_cascade(monkeypatch):
+    jobs, results, asked = cascade(monkeypatch)
+    assert asked[0] == ["GPT-3.5"]
+    assert jobs[0]["model"] == "GPT-3.5" and results[0][2] == "True"
+
+def test_skipped_and_unreadable_responses():
+    assert not cef.needs_escalation(("", cef.BUDGET_SKIPPED_RESPONSE, None, None))
+    assert cef.needs_escalation(("", "not JSON", None, None))
+
+def test_generation_stops_once_the_confidence_is_complete():
+    assert not cef.verdict_complete('{"recommendation": "TRUE"')
+    assert not cef.verdict_complete('{"recommendation": "TRUE", "confidence": 0.8')
+    assert cef.verdict_complete('{"recommendation": "TRUE", "confidence": 0.85,')
+    assert cef.verdict_complete('{"recommendation": "MORE INFO NEEDED", "confidence": 0.3}')
@@ -0,0 +1,40 @@
+import io
+import os
+
+import pyarrow as pa
+
+import cert_eval_functions as cef
+import data_dictionary_functions as ddf
+
+CSV = """id,name,category_label,Weight.94,Weight.94.unit,Touchscreen.95
+1,Laptop A,Notebooks,1.2,kg,True
+2,Laptop B,Notebooks,,,
+3,Laptop C,Notebooks,2.5,kg,False
+"""
+
+def test_chunks_without_values_do_not_change_column_types(tmp_path):
+    file_path = str(tmp_path / "dataset.feather")
+    columns, _, warnings = ddf.ingest_dataset(io.BytesIO(CSV.encode("utf-8")), ".csv", file_path, chunk_size = 1)
+    assert warnings == []
+    assert columns == ["id", "name", "category_label", "Weight.94", "Weight.94.unit", "Touchscreen.95"]
+
+    table = pa.ipc.open_file(file_path).read_all()
+    assert table.schema.field("Weight.94").type == pa.float64()
+    assert table.schema.field("Weight.94.unit").type == pa.string()
+    assert table.schema.field("Touchscreen.95").type == pa.bool_()
+    assert table.column("Touchscreen.95").to_pylist() == [True, None, False]
+
+def test_newest_dataset_entry_wins_over_legacy_rows(tmp_path):
+    # Rows written before add_file_to_master appended were kept newest first
+    master_path = str(tmp_path / "file_list.csv")
+    with open(master_path, "w") as f:
+        f.write("file_folder,file_name,file_description,upload_time\n"
+                "Notebooks,./Datasets/Notebooks/v2.csv,Second,56:53.7\n"
+                "Notebooks,./Datasets/Notebooks/v1.csv,First,12:10.2\n")
+    assert cef.get_dataset_file(master_path, "Notebooks") == "./Datasets/Notebooks/v2.csv"
+
+    ddf.add_file_to_master(master_path, "Notebooks", "./Datasets/Notebooks/v3.feather", "Third")
+    ddf.add_file_to_master(master_path, "Monitors", "./Datasets/Monitors/v1.feather", "Monitors")
+    os.utime(master_path, (os.path.getmtime(master_path) + 1,) * 2)
+    assert cef.get_dataset_file(master_path, "Notebooks") == "./Datasets/Notebooks/v3.feather"
+    assert ddf.dataset_entry(master_path, "Notebooks")["file_description"] == "Third"
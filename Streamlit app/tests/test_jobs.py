@@ -0,0 +1,62 @@
+import sqlite3
+import time
+
+import pytest
+
+import job_functions as jf
+
+def secrets_in_queue(path: str) -> list:
+    with sqlite3.connect(path) as con:
+        return [row[0] for row in con.execute("SELECT secrets FROM jobs ORDER BY id")]
+
+def test_jobs_are_claimed_in_order_and_their_keys_erased(tmp_path):
+    path = str(tmp_path / "jobs.sqlite")
+    first = jf.submit_job("certify_catalog", {"dataset_name": "Notebooks"}, {"Cohere": "key-1"}, path = path)
+    second = jf.submit_job("certify_catalog", {"dataset_name": "Monitors"}, {"Cohere": "key-2"}, path = path)
+
+    job, secrets = jf.claim_job(101, path = path)
+    assert job["id"] == first and job["status"] == "running" and job["params"] == {"dataset_name": "Notebooks"}
+    assert secrets == {"Cohere": "key-1"}
+    assert "secrets" not in jf.get_job(first, path = path)
+    assert secrets_in_queue(path) == [None, '{"Cohere": "key-2"}']
+
+    job, secrets = jf.claim_job(102, path = path)
+    assert job["id"] == second and secrets == {"Cohere": "key-2"}
+    assert jf.claim_job(103, path = path) is None
+    assert secrets_in_queue(path) == [None, None]
+
+def test_cancelled_jobs_are_not_claimed(tmp_path):
+    path = str(tmp_path / "jobs.sqlite")
+    queued = jf.submit_job("recommend", {}, {"GPT-3.5": "key"}, path = path)
+    jf.cancel_job(queued, path = path)
+    assert jf.get_job(queued, path = path)["status"] == "cancelled"
+    assert secrets_in_queue(path) == [None]
+    assert jf.claim_job(101, path = path) is None
+
+    running = jf.submit_job("recommend", {}, {"GPT-3.5": "key"}, path = path)
+    jf.claim_job(101, path = path)
+    jf.cancel_job(running, path = path)
+    with pytest.raises(jf.JobCancelled):
+        jf.report_progress(running, 1, 2, path = path)
+    jf.finish_job(running, "cancelled", path = path)
+    assert jf.get_job(running, path = path)["status"] == "cancelled"
+
+def test_jobs_of_stopped_workers_fail(tmp_path):
+    path = str(tmp_path / "jobs.sqlite")
+    stale = jf.submit_job("certify_catalog", {}, {"Cohere": "key"}, path = path)
+    live = jf.submit_job("certify_catalog", {}, {"Cohere": "key"}, path = path)
+    jf.claim_job(101, path = path)
+    jf.claim_job(102, path = path)
+    with sqlite3.connect(path) as con:
+        con.execute("UPDATE jobs SET heartbeat = ? WHERE id = ?", (time.time() - jf.STALE_SECONDS - 1, stale))
+    jf.worker_heartbeat(102, path = path)
+
+    assert jf.claim_job(103, path = path) is None
+    failed = jf.get_job(stale, path = path)
+    assert failed["status"] == "failed" and "submit it again" in failed["error"]
+    assert jf.get_job(live, path = path)["status"] == "running"
+
+    # A failed job is submitted again as a new job
+    retry = jf.submit_job(failed["kind"], failed["params"], {"Cohere": "key"}, path = path)
+    job, secrets = jf.claim_job(103, path = path)
+    assert job["id"] == retry and secrets == {"Cohere": "key"}
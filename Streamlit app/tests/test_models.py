@@ -0,0 +1,50 @@
+import joblib
+import numpy as np
+import pandas as pd
+import pytest
+from sklearn.linear_model import LogisticRegression
+from sklearn.svm import SVC
+
+import model_functions as mf
+
+def training_data() -> tuple:
+    rng = np.random.default_rng(0)
+    x = pd.DataFrame({"Power.1": rng.uniform(10, 200, 60), "Weight.2": rng.uniform(1, 4, 60)})
+    y = (x["Power.1"] < 100).astype(int)
+    return x, y
+
+def save(cert: str, kind: str, model, x: pd.DataFrame, y: pd.Series):
+    # As Models.ipynb saves them for the app
+    preprocessor = mf.make_preprocessor().fit(x)
+    mf.save_classifier(cert, kind, model.fit(preprocessor.transform(x), y), preprocessor)
+
+def products() -> pd.DataFrame:
+    return pd.DataFrame({"id": [1, 2, 3], "name": ["a", "b", "c"],
+                         "Power.1": [20.0, None, 180.0], "Weight.2": ["2", "3", "n/a"]})
+
+def test_saved_pipelines_score_products_independently_of_the_batch(tmp_path, monkeypatch):
+    monkeypatch.setattr(mf, "MODELS_DIR", str(tmp_path))
+    x, y = training_data()
+    save("TCO", "logit", LogisticRegression(), x, y)
+    save("TCO", "svm", SVC(), x, y)
+    assert mf.available_classifiers("TCO") == ["logit", "svm"]
+
+    for kind in ["logit", "svm"]:
+        scores = mf.score_products(products(), "TCO", kind)
+        assert scores["prediction"].tolist()[::2] == [True, False]
+        alone = mf.score_products(products().iloc[[2]], "TCO", kind)
+        assert alone["score"].iloc[0] == pytest.approx(scores["score"].iloc[2])
+
+def test_bare_estimators_are_not_offered(tmp_path, monkeypatch):
+    monkeypatch.setattr(mf, "MODELS_DIR", str(tmp_path))
+    x, y = training_data()
+    joblib.dump(LogisticRegression().fit(x, y), mf.classifier_path("TCO", "logit"))
+    assert mf.available_classifiers("TCO") == []
+    with pytest.raises(ValueError, match = "save_classifier"):
+        mf.score_products(products(), "TCO", "logit")
+
+def test_classifiers_without_the_certified_label_are_refused(tmp_path, monkeypatch):
+    monkeypatch.setattr(mf, "MODELS_DIR", str(tmp_path))
+    x, y = training_data()
+    with pytest.raises(ValueError, match = "certified label"):
+        save("TCO", "logit", LogisticRegression(), x, y.map({0: "no", 1: "yes"}))
@@ -0,0 +1,38 @@
+import pandas as pd
+
+import cert_eval_functions as cef
+
+def inputs() -> tuple:
+    products = pd.DataFrame({"id": ["p1"], "name": ["Laptop A"], "category_id": [1], "category_label": ["Notebooks"],
+                             "Sustainability certificates.42513": [""]})
+    mandates = pd.DataFrame({"Certification": ["TCO", "TCO"], "Mandate Number": [1, 2],
+                             "Mandate title": ["Battery life", "Recycled plastic"],
+                             "Mandate Description": ["The battery lasts 500 cycles.", "Plastic parts contain recycled content."]})
+    return products, mandates
+
+def save_results(file_path: str, jobs: list):
+    rec = pd.DataFrame([], columns = cef.RECOMMENDATION_COLUMNS)
+    verdict = {"recommendation": "True", "confidence": 0.9, "reasoning": "", "cited_attributes": []}
+    for job in jobs:
+        cef.log_response(rec, job["product"], job["mandate_df"], "", "{}", "True", job["model"], verdict, job["fingerprint"], cef.job_tier(job))
+    cef.save_recommendation(file_path, rec)
+
+def statuses(file_path: str, **mode) -> list:
+    products, mandates = inputs()
+    return cef.reevaluation_plan(cef.build_mandate_jobs(products, mandates, {}, ["TCO"], ["Cohere"], **mode), file_path)["status"].tolist()
+
+def test_results_are_reused_only_in_the_same_prompt_mode(tmp_path):
+    file_path = str(tmp_path / "product_mandate_recommendation.csv")
+    products, mandates = inputs()
+    save_results(file_path, cef.build_mandate_jobs(products, mandates, {}, ["TCO"], ["Cohere"], reasoning = True, group_mandates = False))
+
+    assert statuses(file_path, reasoning = True, group_mandates = False) == ["unchanged", "unchanged"]
+    assert statuses(file_path, reasoning = False, group_mandates = False) == ["changed", "changed"]
+    assert statuses(file_path, reasoning = True, group_mandates = True) == ["changed", "changed"]
+
+def test_rule_decisions_do_not_depend_on_the_prompt_mode():
+    products, mandates = inputs()
+    job = cef.build_mandate_jobs(products, mandates, {}, ["TCO"], ["Cohere"])[0]
+    rule_job = dict(job, rule = (True, "Battery cycles >= 500"))
+    assert cef.job_fingerprint(dict(rule_job, reasoning = False)) == cef.job_fingerprint(dict(rule_job, group_mandates = True))
+    assert cef.job_fingerprint(dict(job, reasoning = False)) != cef.job_fingerprint(job)
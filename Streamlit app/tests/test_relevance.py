@@ -0,0 +1,31 @@
+import os
+
+import pandas as pd
+
+import data_dictionary_functions as ddf
+import relevance_functions as rlf
+
+def write_files(tmp_path) -> tuple:
+    mandates_path, dictionary_path = str(tmp_path / "mandates.csv"), str(tmp_path / "dictionary.csv")
+    pd.DataFrame({"Certification": ["EPEAT", "EPEAT"], "Mandate Number": [1, 2],
+                  "Mandate title": ["Battery life", "Recycled plastic"],
+                  "Mandate Description": ["The battery lasts at least 500 charge cycles.", "Plastic parts contain recycled content."]}).to_csv(mandates_path, index = False)
+    pd.DataFrame({"Column Name Raw": ["id", "Battery cycles.1", "Plastic.2"], "Column Name": ["id", "Battery cycles", "Plastic"],
+                  "Column Unit": ["", "cycles", "%"], "Column Definition": ["ID Column for the product.", "", ""],
+                  "Approved": [True, False, True]}).to_csv(dictionary_path, index = False)
+    return mandates_path, dictionary_path
+
+def test_approving_a_definition_changes_the_ranking(tmp_path):
+    mandates_path, dictionary_path = write_files(tmp_path)
+    before = rlf.rank_mandate_columns(mandates_path, dictionary_path)
+    assert "Battery cycles.1" not in before["Column Name Raw"].tolist()
+
+    data_dictionary = pd.read_csv(dictionary_path)
+    approved = ddf.approve_definition(data_dictionary, "Battery cycles", "Number of charge cycles the battery lasts.")
+    assert not data_dictionary["Approved"][1]
+    approved.to_csv(dictionary_path, index = False)
+    os.utime(dictionary_path, (os.path.getmtime(dictionary_path) + 1,) * 2)
+
+    after = rlf.rank_mandate_columns(mandates_path, dictionary_path)
+    battery = after[after["Mandate Number"] == 1]
+    assert battery["Column Name Raw"].iloc[0] == "Battery cycles.1"
@@ -0,0 +1,57 @@
+import os
+
+import pandas as pd
+import pyarrow as pa
+
+import dataset_functions as dsf
+
+def trigram_text(code: int) -> str:
+    return "".join(dsf.SEARCH_ALPHABET[c] for c in [code // (37 * 37), code // 37 % 37, code % 37])
+
+def expected_trigrams(text: str) -> set:
+    # pg_trgm: every word padded with two spaces before and one after
+    return {("  " + word + " ")[i:i + 3] for word in text.split() for i in range(len(word) + 1)}
+
+def test_trigrams_of_each_text_are_those_of_its_words():
+    texts = ["thinkpad x1", "a", "hp 14"]
+    rows, grams = dsf.search_trigrams(texts)
+    assert list(rows) == sorted(rows)
+    for row, text in enumerate(texts):
+        found = [trigram_text(code) for code in grams[rows == row]]
+        assert len(found) == len(set(found))
+        assert set(found) == expected_trigrams(text)
+
+def write_dataset(file_path: str, names: list):
+    products = pd.DataFrame({"id": [str(100 + i) for i in range(len(names))], "name": names, "category_label": ["Notebooks"] * len(names)})
+    schema = pa.schema([pa.field(c, pa.string()) for c in products.columns])
+    dsf.write_columnar_chunks([products], schema, file_path)
+
+def test_products_are_ranked_by_shared_trigrams(tmp_path):
+    file_path = str(tmp_path / "products.feather")
+    write_dataset(file_path, ["Lenovo ThinkPad X1 Carbon", "Lenovo ThinkPad", "HP EliteBook 840", "Dell XPS 13"])
+
+    page, total = dsf.search_products(file_path, "thinkpad")
+    assert total == 2
+    # Both contain every trigram; the shorter name is closer
+    assert page["name"].tolist() == ["Lenovo ThinkPad", "Lenovo ThinkPad X1 Carbon"]
+    assert page.index.tolist() == [1, 0]
+    assert page["score"].tolist() == [1.0, 1.0]
+
+    page, total = dsf.search_products(file_path, "thinkpad", limit = 1, offset = 1)
+    assert total == 2 and page["name"].tolist() == ["Lenovo ThinkPad X1 Carbon"]
+    assert dsf.search_products(file_path, "elitbook")[0]["name"].tolist() == ["HP EliteBook 840"]
+    # Ids 100-103 share "  1" and " 10" with "102"
+    page, total = dsf.search_products(file_path, "102")
+    assert total == 4 and page["name"].iloc[0] == "HP EliteBook 840"
+    assert dsf.search_products(file_path, "!!")[1] == 0
+
+def test_index_is_rebuilt_when_the_dataset_changes(tmp_path):
+    file_path = str(tmp_path / "products.feather")
+    write_dataset(file_path, ["Dell XPS 13"])
+    index_path = dsf.ensure_search_index(file_path)
+    assert dsf.search_products(file_path, "macbook")[1] == 0
+
+    write_dataset(file_path, ["Dell XPS 13", "Apple MacBook Air"])
+    os.utime(file_path, (os.path.getmtime(index_path) + 1,) * 2)
+    assert dsf.ensure_search_index(file_path) == index_path
+    assert dsf.search_products(file_path, "macbook")[0]["name"].tolist() == ["Apple MacBook Air"]
@@ -0,0 +1,34 @@
+import json
+
+import cert_eval_functions as cef
+
+def test_json_verdicts_are_typed():
+    verdict = cef.parse_response('Here is my assessment: {"recommendation": "MORE INFO NEEDED", "confidence": 85, '
+                                 '"reasoning": "No battery data.", "cited_attributes": "Battery cycles, Weight"}')
+    assert verdict == {"recommendation": "N/A", "confidence": 0.85, "reasoning": "No battery data.",
+                       "cited_attributes": ["Battery cycles", "Weight"]}
+
+def test_python_dicts_and_verdict_lines_are_accepted():
+    verdict = cef.parse_response("{'Recommendation': True, 'Confidence': '0.7', 'Reasoning': 'Meets it.'}")
+    assert verdict["recommendation"] == "True" and verdict["confidence"] == 0.7
+
+    verdict = cef.parse_response("Recommendation: FALSE\nConfidence: 0.6\nReasoning: Too heavy.")
+    assert verdict == {"recommendation": "False", "confidence": 0.6, "reasoning": "Too heavy.", "cited_attributes": []}
+
+def test_responses_without_a_verdict():
+    assert cef.parse_response('{"recommendation": "maybe", "confidence": 0.5}') is None
+    assert cef.parse_response("I cannot tell.") is None
+
+def test_group_verdicts_are_matched_on_mandate_numbers():
+    reply = json.dumps({"verdicts": [{"mandate": "3", "recommendation": "FALSE", "confidence": 0.8},
+                                     {"mandate": "1", "recommendation": "TRUE", "confidence": 0.9},
+                                     {"mandate": "9", "recommendation": "TRUE", "confidence": 0.9}]})
+    verdicts, entries = cef.parse_group_response(reply, [1, 2, 3])
+    assert [v and v["recommendation"] for v in verdicts] == ["True", None, "False"]
+    assert json.loads(entries[0])["mandate"] == "1" and entries[1] is None
+
+def test_group_verdicts_without_numbers_are_matched_on_position():
+    reply = json.dumps({"verdicts": [{"recommendation": "TRUE"}, {"recommendation": "unsure"}]})
+    verdicts, entries = cef.parse_group_response(reply, [4, 5])
+    assert verdicts[0]["recommendation"] == "True" and verdicts[1] is None
+    assert cef.parse_group_response("not JSON", [4, 5]) == ([None, None], [None, None])
@@ -0,0 +1,161 @@
+import pandas as pd
+import numpy as np
+import os
+import json
+import time
+import threading
+import itertools
+import contextvars
+import contextlib
+
+# Span-level timing of a recommendation. While a trace is active (see
+# start_trace), every span() opened on the same thread, or on a thread
+# started through in_context(), is recorded with its parent, start time,
+# duration and attributes (model, mandate, tokens, cache hits...). Outside
+# a trace spans cost next to nothing and record nothing.
+# Traces are saved as JSON lines, one span per line, and can be exported in
+# the Chrome trace event format (chrome://tracing, Perfetto).
+TRACES_DIR = "./Traces"
+
+SPAN_COLUMNS = ["id", "parent", "name", "start", "duration", "thread", "attributes"]
+
+_trace = contextvars.ContextVar("trace", default = None)
+_span = contextvars.ContextVar("span", default = None)
+
+class Trace:
+    def __init__(self, name: str, attributes: dict):
+        self.name = name
+        self.attributes = attributes
+        self.spans = []
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+
+    def add(self, record: dict):
+        with self.lock:
+            self.spans.append(record)
+
+def active() -> bool:
+    return _trace.get() is not None
+
+@contextlib.contextmanager
+def start_trace(name: str, **attributes):
+    # Record the spans opened inside the block; the root span is name.
+    trace = Trace(name, attributes)
+    token = _trace.set(trace)
+    try:
+        with span(name, **attributes):
+            yield trace
+    finally:
+        _trace.reset(token)
+
+@contextlib.contextmanager
+def span(name: str, **attributes):
+    # Time the block as a child of the current span. Yields the span's
+    # attributes, which the block may add to; an exception leaving the
+    # block is recorded as the "error" attribute.
+    trace = _trace.get()
+    if trace is None:
+        yield {}
+        return
+
+    record = {"id": next(trace.ids), "parent": _span.get(), "name": name, "start": time.time(), "duration": None,
+              "thread": threading.get_ident(), "attributes": attributes}
+    token = _span.set(record["id"])
+    started = time.perf_counter()
+    try:
+        yield attributes
+    except BaseException as e:
+        attributes["error"] = type(e).__name__
+        raise
+    finally:
+        record["duration"] = time.perf_counter() - started
+        _span.reset(token)
+        trace.add(record)
+
+def record_span(name: str, duration: float, **attributes):
+    # A span that has just ended after duration seconds, e.g. time spent
+    # sleeping inside a call that cannot be wrapped
+    trace = _trace.get()
+    if trace is not None:
+        trace.add({"id": next(trace.ids), "parent": _span.get(), "name": name, "start": time.time() - duration, "duration": duration,
+                   "thread": threading.get_ident(), "attributes": attributes})
+
+def in_context(function):
+    # function, run in a copy of the caller's trace context: spans it opens
+    # on a pool thread are children of the caller's current span.
+    context = contextvars.copy_context()
+    return lambda *args, **kwargs: context.run(function, *args, **kwargs)
+
+def trace_path(name: str) -> str:
+    return TRACES_DIR + "/" + name + ".jsonl"
+
+def write_trace(trace: Trace, file_path: str):
+    os.makedirs(os.path.dirname(file_path), exist_ok = True)
+    with open(file_path + ".tmp", "w") as f:
+        for record in sorted(trace.spans, key = lambda record: record["start"]):
+            f.write(json.dumps(record, default = str) + "\n")
+    os.replace(file_path + ".tmp", file_path)
+
+def read_trace(file_path: str) -> pd.DataFrame:
+    with open(file_path) as f:
+        return pd.DataFrame([json.loads(line) for line in f if line.strip()], columns = SPAN_COLUMNS)
+
+def chrome_trace(spans: pd.DataFrame) -> dict:
+    # Complete ("X") events in microseconds, one timeline row per thread
+    threads = {thread: n for n, thread in enumerate(pd.unique(spans["thread"]))}
+    return {"traceEvents": [{"name": row["name"], "ph": "X", "pid": 1, "tid": threads[row["thread"]],
+                             "ts": row["start"] * 1e6, "dur": row["duration"] * 1e6,
+                             "args": dict(row["attributes"], span = row["id"], parent = row["parent"])}
+                            for _, row in spans.iterrows()],
+            "displayTimeUnit": "ms"}
+
+def _attribute(spans: pd.DataFrame, key: str, default = 0) -> pd.Series:
+    return spans["attributes"].map(lambda attributes: attributes.get(key, default))
+
+def stage_summary(spans: pd.DataFrame) -> pd.DataFrame:
+    # Time per stage (span name), slowest first. Durations are wall clock:
+    # a span's time includes its children's, and spans on different
+    # threads overlap.
+    if spans.empty:
+        return pd.DataFrame([], columns = ["stage", "calls", "total_seconds", "mean_seconds", "p50_seconds", "p95_seconds",
+                                           "max_seconds", "tokens_in", "tokens_out", "cache_hits"])
+    spans = spans.assign(tokens_in = _attribute(spans, "tokens_in"), tokens_out = _attribute(spans, "tokens_out"),
+                         cache_hit = _attribute(spans, "cache_hit", False).astype(bool))
+    stages = spans.groupby("name").agg(calls = ("id", "size"), total_seconds = ("duration", "sum"), mean_seconds = ("duration", "mean"),
+                                       p50_seconds = ("duration", lambda d: np.percentile(d, 50)),
+                                       p95_seconds = ("duration", lambda d: np.percentile(d, 95)),
+                                       max_seconds = ("duration", "max"), tokens_in = ("tokens_in", "sum"),
+                                       tokens_out = ("tokens_out", "sum"), cache_hits = ("cache_hit", "sum"))
+    return stages.sort_values("total_seconds", ascending = False).rename_axis("stage").reset_index()
+
+def mandate_summary(spans: pd.DataFrame) -> pd.DataFrame:
+    # One row per evaluated mandate: its time, the time spent in provider
+    # requests and waiting on rate limits or retries below it, tokens and
+    # cache hits.
+    columns = ["cert", "mandate", "model", "seconds", "request_seconds", "wait_seconds", "tokens_in", "tokens_out", "cache_hits", "requests"]
+    mandates = spans[spans["name"].isin(["evaluate_mandate", "evaluate_mandate_group"])]
+    if mandates.empty:
+        return pd.DataFrame([], columns = columns)
+
+    # Each span is charged to its nearest mandate ancestor
+    parents = dict(zip(spans["id"], spans["parent"]))
+    mandate_ids = set(mandates["id"])
+    def owner(span_id):
+        while span_id is not None and span_id not in mandate_ids:
+            span_id = parents.get(span_id)
+        return span_id
+    spans = spans.assign(owner = spans["id"].map(owner))
+
+    rows = []
+    for _, mandate in mandates.iterrows():
+        below = spans[(spans["owner"] == mandate["id"]) & (spans["id"] != mandate["id"])]
+        requests = below[below["name"] == "llm_request"]
+        waits = below[below["name"].isin(["rate_limit_wait", "retry_backoff"])]
+        attributes = mandate["attributes"]
+        rows.append([attributes.get("cert"), attributes.get("mandate"), attributes.get("model"), mandate["duration"],
+                     requests["duration"].sum(), waits["duration"].sum(),
+                     int(_attribute(requests, "tokens_in").sum()) if not requests.empty else 0,
+                     int(_attribute(requests, "tokens_out").sum()) if not requests.empty else 0,
+                     int(_attribute(requests, "cache_hit", False).astype(bool).sum()) if not requests.empty else 0,
+                     requests.shape[0]])
+    return pd.DataFrame(rows, columns = columns).sort_values("seconds", ascending = False, ignore_index = True)